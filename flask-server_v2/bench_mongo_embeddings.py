@@ -0,0 +1,81 @@
+"""Document size and insert throughput of memory documents per embedding format.
+
+Usage:
+    python bench_mongo_embeddings.py [--dim 1536] [--docs 2000] [--batch 100]
+
+Sizes are of the BSON-encoded document, the same shape StoryMemory writes,
+and need no server. Insert throughput is measured with insert_many into a
+scratch collection (dropped afterwards) when MongoDB is reachable.
+"""
+import argparse
+import time
+from datetime import datetime
+
+import bson
+import numpy as np
+from bson.objectid import ObjectId
+
+from memory_service import get_memory_service
+from mongo_embeddings import MONGO_EMBEDDING_DIMS, MONGO_EMBEDDING_MODES, decode_embedding, encode_embedding
+
+
+def make_doc(vector, mode: str, dims: int) -> dict:
+    return {
+        "_id": ObjectId(),
+        "story_id": "benchmark",
+        "content": "A scene of about a hundred words. " * 15,
+        **encode_embedding(vector, mode, dims),
+        "embedding_model": "text-embedding-3-small",
+        "metadata": {"type": "scene", "episode": 1, "scene": 2},
+        "timestamp": datetime.utcnow()
+    }
+
+
+def cosine_error(vector, doc) -> float:
+    """1 - cosine similarity between ``vector`` and what ``doc`` decodes to, over shared dims"""
+    decoded = decode_embedding(doc)
+    if decoded is None:
+        return float("nan")
+    a = np.asarray(vector[:len(decoded)])
+    b = np.asarray(decoded)
+    return 1.0 - float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--dims", type=int, default=MONGO_EMBEDDING_DIMS, help="Dimensions kept by reduced")
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(args.docs, args.dim))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).tolist()
+
+    db = get_memory_service().mongo_db()
+    if db is None:
+        print("MongoDB is not reachable; reporting document sizes only\n")
+
+    print(f"{'mode':<8} {'doc bytes':>10} {'vs list':>8} {'cos err':>9} {'docs/s':>9}")
+    baseline = None
+    for mode in MONGO_EMBEDDING_MODES:
+        docs = [make_doc(vector, mode, args.dims) for vector in vectors]
+        size = float(np.mean([len(bson.encode(doc)) for doc in docs[:100]]))
+        baseline = baseline or size
+        error = float(np.mean([cosine_error(vector, doc) for vector, doc in zip(vectors[:100], docs[:100])]))
+
+        throughput = "-"
+        if db is not None:
+            collection = db[f"bench_memory_{mode}"]
+            collection.drop()
+            start = time.perf_counter()
+            for i in range(0, len(docs), args.batch):
+                collection.insert_many(docs[i:i + args.batch], ordered=False)
+            throughput = f"{len(docs) / (time.perf_counter() - start):.0f}"
+            collection.drop()
+        print(f"{mode:<8} {size:>10.0f} {size / baseline:>8.2f} {error:>9.2e} {throughput:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare add and query latency of the NumPy vector index with ChromaDB.
+
+Usage:
+    python bench_vector_index.py [--sizes 1000,10000,100000] [--dim 384] [--queries 200] [--k 5]
+
+Vectors are random unit vectors. Adds go in batches of --batch; queries are
+timed one at a time, the way StoryMemory.retrieve issues them. Chroma runs
+with a persistent client in a temporary directory, like StoryMemory uses it.
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from vector_index import NumpyVectorIndex
+
+try:
+    import chromadb
+except ImportError:
+    chromadb = None
+
+
+def random_vectors(n: int, dim: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def time_adds(add, vectors: np.ndarray, batch: int) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(vectors), batch):
+        chunk = vectors[i:i + batch]
+        ids = [str(j) for j in range(i, i + len(chunk))]
+        add(ids, chunk.tolist(), [f"document {j}" for j in ids], [{"n": int(j)} for j in ids])
+    return time.perf_counter() - start
+
+
+def time_queries(query, queries: np.ndarray, k: int) -> np.ndarray:
+    latencies = []
+    for vector in queries:
+        start = time.perf_counter()
+        query([vector.tolist()], k)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def report(name: str, size: int, add_seconds: float, latencies: np.ndarray) -> None:
+    print(f"{name:<14} {size:>8} {add_seconds * 1e6 / size:>12.1f} "
+          f"{np.percentile(latencies, 50) * 1e3:>10.3f} {np.percentile(latencies, 95) * 1e3:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'backend':<14} {'vectors':>8} {'add us/vec':>12} {'query p50':>10} {'query p95':>10}  (ms)")
+    for size in [int(value) for value in args.sizes.split(",")]:
+        vectors = random_vectors(size, args.dim, seed=size)
+        queries = random_vectors(args.queries, args.dim, seed=size + 1)
+
+        for dtype in ("float32", "int8"):
+            index = NumpyVectorIndex(args.dim, dtype)
+            add_seconds = time_adds(index.add, vectors, args.batch)
+            latencies = time_queries(lambda q, k: index.query(q, n_results=k), queries, args.k)
+            report(f"numpy-{dtype}", size, add_seconds, latencies)
+
+        if chromadb is None:
+            print(f"{'chroma':<14} {size:>8}  skipped (chromadb is not installed)")
+            continue
+        with tempfile.TemporaryDirectory() as path:
+            client = chromadb.PersistentClient(path=path)
+            collection = client.create_collection(name="bench", metadata={"hnsw:space": "cosine"})
+            add_seconds = time_adds(
+                lambda ids, embeddings, documents, metadatas: collection.add(
+                    ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas),
+                vectors, args.batch
+            )
+            latencies = time_queries(lambda q, k: collection.query(query_embeddings=q, n_results=k),
+                                     queries, args.k)
+            report("chroma", size, add_seconds, latencies)
+
+
+if __name__ == "__main__":
+    main()
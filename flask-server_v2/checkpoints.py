@@ -0,0 +1,359 @@
+"""Persist the output of each pipeline stage so a failed run can be resumed.
+
+Checkpoints are grouped by run id. Each run also keeps a small manifest with
+the hash of the inputs it was started with, so a resume only reuses stages
+produced from the same inputs. Two backends are available: JSON files on
+local disk (the default) and a MongoDB collection.
+
+The same stores also back ``StageMemo``, which keys stage outputs on a hash
+of the stage's own inputs so they can be reused across runs.
+
+A run id is claimed for as long as its run is in progress (``claim_run``), so
+two identical runs started together in one process don't write over, or
+delete, each other's checkpoints.
+
+Runs untouched for ``STORYFORGE_CHECKPOINT_TTL`` seconds, and memoized outputs
+older than that, are pruned in the background (see ``prune_checkpoints``).
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from memory_service import get_memory_service
+
+CHECKPOINT_BACKEND = os.getenv("STORYFORGE_CHECKPOINTS", "disk")  # disk, mongo or off
+CHECKPOINT_DIR = os.getenv("STORYFORGE_CHECKPOINT_DIR", ".checkpoints")
+CHECKPOINT_TTL = float(os.getenv("STORYFORGE_CHECKPOINT_TTL", str(7 * 24 * 3600)))  # seconds; 0 keeps everything
+
+MANIFEST = "__manifest__"
+MEMO_PREFIX = "memo:"  # Run id prefix of StageMemo entries
+
+_active_runs = set()  # Run ids with a pipeline in progress in this process
+_active_runs_lock = threading.Lock()
+
+
+def input_hash(inputs: Dict[str, Any]) -> str:
+    """Stable hash of JSON-serializable pipeline inputs"""
+    payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def claim_run(run_id: str) -> str:
+    """Reserve ``run_id`` until ``release_run``; if a run in progress holds it, a unique variant of it"""
+    with _active_runs_lock:
+        if run_id in _active_runs:
+            claimed = f"{run_id}-{uuid.uuid4().hex[:8]}"
+            print(f"Run {run_id} is already in progress; checkpointing this one as {claimed}")
+            run_id = claimed
+        _active_runs.add(run_id)
+        return run_id
+
+
+def release_run(run_id: str) -> None:
+    with _active_runs_lock:
+        _active_runs.discard(run_id)
+
+
+class CheckpointStore(ABC):
+    """Interface shared by the checkpoint backends"""
+
+    @abstractmethod
+    def load(self, run_id: str, stage: str) -> Tuple[bool, Any]:
+        """Return (found, value) for a stage of a run"""
+
+    @abstractmethod
+    def save(self, run_id: str, stage: str, value: Any) -> None:
+        """Store ``value`` as the output of a stage of a run"""
+
+    @abstractmethod
+    def stages(self, run_id: str) -> List[str]:
+        """Names of the stages saved for a run"""
+
+    @abstractmethod
+    def delete(self, run_id: str) -> None:
+        """Remove every checkpoint of a run"""
+
+    @abstractmethod
+    def prune(self, max_age: float) -> int:
+        """Remove runs untouched and memo entries unchanged for ``max_age`` seconds.
+
+        Runs in progress in this process are kept. Returns how many
+        checkpoints were removed.
+        """
+
+    def manifest(self, run_id: str) -> Optional[Dict[str, Any]]:
+        found, value = self.load(run_id, MANIFEST)
+        return value if found else None
+
+    def begin(self, run_id: str, inputs_digest: str, resume: bool) -> bool:
+        """Prepare a run. Returns True if existing checkpoints may be reused."""
+        manifest = self.manifest(run_id)
+        reuse = resume and manifest is not None and manifest.get("input_hash") == inputs_digest
+        if resume and manifest is not None and not reuse:
+            print(f"Checkpoints for run {run_id} were made from different inputs; starting over")
+        if not reuse:
+            self.delete(run_id)
+        self.save(run_id, MANIFEST, {
+            "input_hash": inputs_digest,
+            "started_at": datetime.utcnow().isoformat(),
+            "completed": False
+        })
+        return reuse
+
+    def finish(self, run_id: str, inputs_digest: str) -> None:
+        self.save(run_id, MANIFEST, {
+            "input_hash": inputs_digest,
+            "finished_at": datetime.utcnow().isoformat(),
+            "completed": True
+        })
+
+
+class DiskCheckpointStore(CheckpointStore):
+    """One JSON file per stage under ``<root>/<run_id>/``"""
+
+    def __init__(self, root: str = CHECKPOINT_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _run_dir(self, run_id: str) -> str:
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9_.-]', '_', run_id))
+
+    def _path(self, run_id: str, stage: str) -> str:
+        # Stage names like "scenes:2" aren't valid file names everywhere
+        return os.path.join(self._run_dir(run_id), stage.replace(":", "__") + ".json")
+
+    def load(self, run_id: str, stage: str) -> Tuple[bool, Any]:
+        path = self._path(run_id, stage)
+        if not os.path.exists(path):
+            return False, None
+        try:
+            with open(path) as f:
+                return True, json.load(f)
+        except Exception as e:
+            print(f"Error reading checkpoint {path}: {e}")
+            return False, None
+
+    def save(self, run_id: str, stage: str, value: Any) -> None:
+        path = self._path(run_id, stage)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(value, f, default=str)
+            os.replace(tmp_path, path)  # Never leave a half-written checkpoint behind
+        except Exception as e:
+            print(f"Error writing checkpoint {path}: {e}")
+
+    def stages(self, run_id: str) -> List[str]:
+        run_dir = self._run_dir(run_id)
+        if not os.path.isdir(run_dir):
+            return []
+        return sorted(
+            name[:-len(".json")].replace("__", ":") for name in os.listdir(run_dir)
+            if name.endswith(".json") and not name.startswith(MANIFEST)
+        )
+
+    def delete(self, run_id: str) -> None:
+        run_dir = self._run_dir(run_id)
+        if not os.path.isdir(run_dir):
+            return
+        for name in os.listdir(run_dir):
+            try:
+                os.remove(os.path.join(run_dir, name))
+            except OSError as e:
+                print(f"Error removing checkpoint {name}: {e}")
+
+    def prune(self, max_age: float) -> int:
+        if not os.path.isdir(self.root):
+            return 0
+        cutoff = time.time() - max_age
+        with _active_runs_lock:
+            active = {self._run_dir(run_id) for run_id in _active_runs}
+        memo_dir = self._run_dir(MEMO_PREFIX)
+        removed = 0
+        for name in os.listdir(self.root):
+            run_dir = os.path.join(self.root, name)
+            if run_dir in active or not os.path.isdir(run_dir):
+                continue
+            try:
+                ages = {path: os.path.getmtime(path)
+                        for path in (os.path.join(run_dir, f) for f in os.listdir(run_dir))}
+            except OSError as e:
+                print(f"Error scanning checkpoints in {run_dir}: {e}")
+                continue
+            if run_dir.startswith(memo_dir):
+                # Memo entries are independent, so each one expires on its own
+                expired = [path for path, mtime in ages.items() if mtime < cutoff]
+            else:
+                expired = list(ages) if all(mtime < cutoff for mtime in ages.values()) else []
+            for path in expired:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    print(f"Error removing checkpoint {path}: {e}")
+            if len(expired) == len(ages):
+                try:
+                    os.rmdir(run_dir)
+                except OSError:
+                    pass  # Written to meanwhile
+        return removed
+
+
+class MongoCheckpointStore(CheckpointStore):
+    """Checkpoints as documents in the ``checkpoints`` collection"""
+
+    def __init__(self, uri: str = 'mongodb://localhost:27017/', db_name: str = 'storyforge',
+                 client: Optional[MongoClient] = None):
+        self.client = client if client is not None else MongoClient(uri, serverSelectionTimeoutMS=5000)
+        self.collection = self.client[db_name]['checkpoints']
+        self.collection.create_index([("run_id", 1), ("stage", 1)], unique=True)
+
+    def load(self, run_id: str, stage: str) -> Tuple[bool, Any]:
+        try:
+            doc = self.collection.find_one({"run_id": run_id, "stage": stage})
+        except Exception as e:
+            print(f"Error reading checkpoint {run_id}/{stage}: {e}")
+            return False, None
+        if doc is None:
+            return False, None
+        return True, json.loads(doc["value"])
+
+    def save(self, run_id: str, stage: str, value: Any) -> None:
+        try:
+            # Stored as a JSON string so keys and values round-trip exactly
+            self.collection.replace_one(
+                {"run_id": run_id, "stage": stage},
+                {"run_id": run_id, "stage": stage, "value": json.dumps(value, default=str),
+                 "saved_at": datetime.utcnow()},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error writing checkpoint {run_id}/{stage}: {e}")
+
+    def stages(self, run_id: str) -> List[str]:
+        return sorted(
+            doc["stage"] for doc in self.collection.find({"run_id": run_id}, {"stage": 1})
+            if doc["stage"] != MANIFEST
+        )
+
+    def delete(self, run_id: str) -> None:
+        try:
+            self.collection.delete_many({"run_id": run_id})
+        except Exception as e:
+            print(f"Error deleting checkpoints for {run_id}: {e}")
+
+    def prune(self, max_age: float) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        removed = 0
+        try:
+            removed += self.collection.delete_many({
+                "run_id": {"$regex": f"^{re.escape(MEMO_PREFIX)}"}, "saved_at": {"$lt": cutoff}
+            }).deleted_count
+            # A run's manifest is rewritten whenever it starts or finishes
+            with _active_runs_lock:
+                active = set(_active_runs)
+            stale = [
+                run_id for run_id in self.collection.distinct("run_id", {"stage": MANIFEST, "saved_at": {"$lt": cutoff}})
+                if run_id not in active
+            ]
+            if stale:
+                removed += self.collection.delete_many({"run_id": {"$in": stale}}).deleted_count
+        except Exception as e:
+            print(f"Error pruning checkpoints: {e}")
+        return removed
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def get_checkpoint_store() -> Optional[CheckpointStore]:
+    """Return the configured checkpoint store, or None when checkpointing is off"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None and CHECKPOINT_BACKEND != "off":
+            if CHECKPOINT_BACKEND == "mongo":
+                try:
+                    # Borrow the pooled client StoryMemory uses rather than opening another
+                    service = get_memory_service()
+                    client = service.mongo_client()
+                    if client is None:
+                        raise ConnectionError("MongoDB is unreachable")
+                    _default_store = MongoCheckpointStore(db_name=service.db_name, client=client)
+                except Exception as e:
+                    print(f"Error connecting checkpoint store to MongoDB, using disk instead: {e}")
+                    _default_store = DiskCheckpointStore()
+            else:
+                _default_store = DiskCheckpointStore()
+        store = _default_store
+    if store is not None:
+        prune_checkpoints(store)
+    return store
+
+
+def prune_checkpoints(store: CheckpointStore, max_age: float = CHECKPOINT_TTL) -> None:
+    """Prune ``store`` in a background thread, at most once an hour (or once per ``max_age``)"""
+    global _last_prune
+    if max_age <= 0:
+        return
+    with _default_store_lock:
+        if _last_prune and time.monotonic() - _last_prune < min(max_age, 3600):
+            return
+        _last_prune = time.monotonic()
+
+    def prune():
+        removed = store.prune(max_age)
+        if removed:
+            print(f"Pruned {removed} checkpoints older than {max_age:g}s")
+
+    threading.Thread(target=prune, name="storyforge-checkpoint-prune", daemon=True).start()
+
+
+class StageMemo:
+    """Stage outputs keyed by a hash of the stage's actual inputs.
+
+    Unlike run checkpoints these are shared between runs: any run that feeds
+    a stage the same inputs as an earlier one gets the earlier output back.
+    Stored in the checkpoint store under the pseudo run id ``memo:<stage>``.
+    """
+
+    def __init__(self, store: CheckpointStore):
+        self.store = store
+
+    def lookup(self, stage: str, inputs: Dict[str, Any], max_age: Optional[float] = None) -> Tuple[bool, Any]:
+        """Return (found, value); with ``max_age``, outputs older than that many seconds are not found"""
+        found, entry = self.store.load(f"{MEMO_PREFIX}{stage}", input_hash(inputs))
+        if not found:
+            return False, None
+        if not (isinstance(entry, dict) and entry.get("__memo__")):
+            # Saved before memo entries were timestamped
+            return (False, None) if max_age is not None else (True, entry)
+        if max_age is not None and time.time() - entry["saved_at"] > max_age:
+            return False, None
+        return True, entry["value"]
+
+    def save(self, stage: str, inputs: Dict[str, Any], value: Any) -> None:
+        self.store.save(f"{MEMO_PREFIX}{stage}", input_hash(inputs),
+                        {"__memo__": 1, "saved_at": time.time(), "value": value})
+
+    def forget(self, stage: str) -> None:
+        """Drop every memoized output of ``stage``"""
+        self.store.delete(f"{MEMO_PREFIX}{stage}")
+
+
+def get_stage_memo() -> Optional[StageMemo]:
+    """Return the memo backed by the configured checkpoint store, or None when it is off"""
+    store = get_checkpoint_store()
+    return StageMemo(store) if store is not None else None
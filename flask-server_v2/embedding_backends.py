@@ -0,0 +1,187 @@
+"""Embedding backends for StoryMemory.
+
+Two backends share the same interface: the OpenAI embeddings API and a local
+SentenceTransformer model running on the CPU, which works fully offline. Both
+check the persistent embedding cache first and send cache misses through a
+micro-batcher, so concurrent callers share one request (or one forward pass).
+
+Every backend has a ``model_id`` naming the model that produced its vectors.
+StoryMemory records it, with the vector dimension, on each collection so
+vectors from different backends are never mixed.
+
+Select the backend with STORYFORGE_EMBEDDING_BACKEND: "openai", "local" or
+"auto" (the default: OpenAI when an API client is configured, else local).
+"""
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import get_embedding_cache
+from rate_limiter import call_with_retries
+from token_budget import count_tokens
+
+EMBEDDING_BACKEND = os.getenv("STORYFORGE_EMBEDDING_BACKEND", "auto")  # auto, openai or local
+OPENAI_EMBEDDING_MODEL = os.getenv("STORYFORGE_OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+LOCAL_EMBEDDING_MODEL = os.getenv("STORYFORGE_LOCAL_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("STORYFORGE_LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_THREADS = int(os.getenv("STORYFORGE_LOCAL_EMBEDDING_THREADS", "0"))  # 0 leaves torch's default
+LOCAL_EMBEDDING_BATCH_DELAY_MS = float(os.getenv("STORYFORGE_LOCAL_EMBEDDING_BATCH_DELAY_MS", "2"))
+
+OPENAI_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+
+def model_slug(model_id: str) -> str:
+    """``model_id`` reduced to characters that are safe in collection and file names"""
+    return re.sub(r'[^A-Za-z0-9_-]+', '-', model_id).strip('-').lower()
+
+
+class EmbeddingBackend(ABC):
+    """Cached, micro-batched embeddings from one model"""
+
+    name = "base"
+
+    def __init__(self, model_id: str, **batcher_options):
+        self.model_id = model_id
+        self.batcher = EmbeddingBatcher(lambda texts, model: self._embed_and_cache(texts), **batcher_options)
+
+    @property
+    def dimension(self) -> Optional[int]:
+        """Length of the vectors, if known without embedding anything"""
+        return None
+
+    @abstractmethod
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts directly, without the cache or batcher"""
+
+    def _embed_and_cache(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch and cache it as soon as it arrives, so prefetched texts are there for embed()"""
+        vectors = self.embed_batch(texts)
+        cache = get_embedding_cache()
+        if cache is not None and len(vectors) == len(texts):
+            for text, vector in zip(texts, vectors):
+                cache.set(self.model_id, text, vector)
+        return vectors
+
+    def embed(self, text: str) -> List[float]:
+        """Embedding of ``text``, from the cache when possible"""
+        cache = get_embedding_cache()
+        if cache is not None and isinstance(text, str):
+            cached = cache.get(self.model_id, text)
+            if cached is not None:
+                return cached
+        return self.batcher.embed(text, self.model_id)
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings of ``texts``, with every cache miss sent in the same batch"""
+        cache = get_embedding_cache()
+        vectors = [cache.get(self.model_id, text) if cache is not None else None for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.batcher.embed_many([texts[i] for i in missing], self.model_id)
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        return vectors
+
+    def prefetch(self, texts: List[str]) -> None:
+        """Start embedding texts that will be needed shortly; they are cached when the batch returns"""
+        cache = get_embedding_cache()
+        if cache is not None:
+            texts = [text for text in texts if isinstance(text, str) and cache.get(self.model_id, text) is None]
+        self.batcher.prefetch(texts, self.model_id)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self.batcher.flush(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "model": self.model_id, "dimension": self.dimension,
+                "batches": self.batcher.stats()}
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """Embeddings from the OpenAI API, one list-input request per batch"""
+
+    name = "openai"
+
+    def __init__(self, client, model: str = OPENAI_EMBEDDING_MODEL):
+        super().__init__(model, count_tokens=count_tokens)
+        self.client = client
+        self.model = model
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return OPENAI_DIMENSIONS.get(self.model)
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = call_with_retries(
+            "embeddings",
+            lambda: self.client.embeddings.create(input=texts, model=self.model),
+            tokens=sum(count_tokens(text, self.model) for text in texts)
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """SentenceTransformer on the local CPU, loaded the first time it is used"""
+
+    name = "local"
+
+    def __init__(self, model: str = LOCAL_EMBEDDING_MODEL, batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+                 threads: int = LOCAL_EMBEDDING_THREADS, device: str = "cpu"):
+        super().__init__(f"sentence-transformers/{model}", max_batch=batch_size,
+                         max_delay_ms=LOCAL_EMBEDDING_BATCH_DELAY_MS,
+                         count_tokens=lambda text, model: 0)  # Batches are bounded by size only
+        self.model = model
+        self.batch_size = batch_size
+        self.threads = threads
+        self.device = device
+        self._encoder = None
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+                if self.threads > 0:
+                    import torch
+                    torch.set_num_threads(self.threads)
+                print(f"Loading local embedding model {self.model}...")
+                self._encoder = SentenceTransformer(self.model, device=self.device)
+            return self._encoder
+
+    @property
+    def dimension(self) -> Optional[int]:
+        if self._encoder is None:
+            return None
+        return self._encoder.get_sentence_embedding_dimension()
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        encoder = self._load()
+        vectors = encoder.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                 normalize_embeddings=True, show_progress_bar=False)
+        return vectors.tolist()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_embedding_backend(openai_client=None) -> Optional[EmbeddingBackend]:
+    """Return the process-wide embedding backend chosen by STORYFORGE_EMBEDDING_BACKEND
+
+    Returns None only when the OpenAI backend is requested without a client.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if EMBEDDING_BACKEND == "local" or (EMBEDDING_BACKEND == "auto" and openai_client is None):
+                _backend = LocalEmbeddingBackend()
+            elif openai_client is not None:
+                _backend = OpenAIEmbeddingBackend(openai_client)
+        return _backend
@@ -0,0 +1,211 @@
+"""Micro-batching of embedding requests.
+
+Texts submitted from any thread are collected for a few milliseconds (or
+until a batch is full) and sent as one list-input embeddings request per
+model; each caller gets its own vector back through a Future. A text that is
+already waiting for a batch is not sent twice, so callers can prefetch the
+embeddings they will need shortly and pick them up later.
+
+A caller waits at most EMBEDDING_WAIT_SECONDS for its vector. If the worker
+thread has died in the meantime, the caller embeds its text itself rather
+than waiting for a batch that will never be sent.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from rate_limiter import estimate_tokens
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("STORYFORGE_EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_DELAY_MS = float(os.getenv("STORYFORGE_EMBEDDING_BATCH_DELAY_MS", "10"))
+# The API rejects requests above 300k tokens; stay well below it
+EMBEDDING_BATCH_TOKENS = int(os.getenv("STORYFORGE_EMBEDDING_BATCH_TOKENS", "100000"))
+EMBEDDING_WAIT_SECONDS = float(os.getenv("STORYFORGE_EMBEDDING_WAIT_SECONDS", "120"))
+WORKER_CHECK_SECONDS = 1.0  # How often a waiting caller checks that the worker is still alive
+
+
+class EmbeddingBatcher:
+    """Collects embedding requests into batches sent by a background thread
+
+    ``embed_batch(texts, model)`` must return one vector per text, in order.
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str], str], List[List[float]]],
+                 max_batch: int = EMBEDDING_BATCH_SIZE, max_delay_ms: float = EMBEDDING_BATCH_DELAY_MS,
+                 max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+                 count_tokens: Callable[[str, str], int] = lambda text, model: estimate_tokens(text)):
+        self.embed_batch = embed_batch
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_batch_tokens = max_batch_tokens
+        self.count_tokens = count_tokens
+
+        self._cond = threading.Condition()
+        self._queue = []  # (model, text) waiting for a batch, oldest first
+        self._pending = {}  # (model, text) -> Future, until its batch finishes
+        self._thread = None
+        self._flushing = 0  # Callers in flush(); batches go out without waiting
+        self.counters = {"requests": 0, "coalesced": 0, "batches": 0, "texts": 0, "errors": 0}
+
+    def submit(self, text: str, model: str) -> Future:
+        """Queue ``text`` for embedding; returns a Future of its vector"""
+        if not isinstance(text, str) or not text:
+            # Never let one bad input fail everyone else's batch
+            future = Future()
+            future.set_exception(TypeError(f"Can only embed non-empty strings, got {type(text).__name__}"))
+            return future
+
+        key = (model, text)
+        with self._cond:
+            self.counters["requests"] += 1
+            future = self._pending.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future
+            future = Future()
+            self._pending[key] = future
+            self._queue.append(key)
+            self._ensure_worker()
+            self._cond.notify_all()
+            return future
+
+    def embed(self, text: str, model: str, timeout: Optional[float] = EMBEDDING_WAIT_SECONDS) -> List[float]:
+        """Embed ``text``, waiting for the batch it ends up in
+
+        Raises TimeoutError if no vector arrived within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return self._wait(text, model, self.submit(text, model), deadline, timeout)
+
+    def embed_many(self, texts: List[str], model: str,
+                   timeout: Optional[float] = EMBEDDING_WAIT_SECONDS) -> List[List[float]]:
+        """Embed ``texts`` together, holding on to every Future until all have arrived"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        futures = [self.submit(text, model) for text in texts]
+        return [self._wait(text, model, future, deadline, timeout) for text, future in zip(texts, futures)]
+
+    def _wait(self, text: str, model: str, future: Future, deadline: Optional[float],
+              timeout: Optional[float]) -> List[float]:
+        while True:
+            wait = WORKER_CHECK_SECONDS
+            if deadline is not None:
+                wait = min(wait, max(0.0, deadline - time.monotonic()))
+            try:
+                return future.result(wait)
+            except FutureTimeoutError:
+                pass
+            with self._cond:
+                worker_dead = self._thread is None or not self._thread.is_alive()
+            if worker_dead:
+                return self._embed_directly(text, model, future)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"No embedding after {timeout:g}s")
+
+    def _embed_directly(self, text: str, model: str, future: Future) -> List[float]:
+        """Embed one text on the calling thread, for when the worker has died"""
+        key = (model, text)
+        with self._cond:
+            owner = self._pending.get(key) is future
+            if owner:
+                if key in self._queue:
+                    self._queue.remove(key)
+                del self._pending[key]
+                self._cond.notify_all()
+        if not owner:
+            return future.result()  # Finished, or another caller is embedding it
+        print("Embedding batcher worker is not running; embedding directly")
+        try:
+            vector = self.embed_batch([text], model)[0]
+        except Exception as e:
+            future.set_exception(e)  # Other callers waiting on the same text
+            raise
+        future.set_result(vector)
+        return vector
+
+    def prefetch(self, texts: List[str], model: str) -> None:
+        """Start embedding ``texts`` without waiting for them"""
+        for text in texts:
+            if isinstance(text, str) and text:
+                self.submit(text, model)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every submitted text has been embedded (or failed)
+
+        Returns False if ``timeout`` seconds passed first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def _ensure_worker(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="storyforge-embedding-batcher", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self) -> Tuple[str, List[str]]:
+        """Block until a batch is due, then take it off the queue"""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # Give other callers a moment to join, unless the batch is already full
+            due = time.monotonic() + self.max_delay
+            while len(self._queue) < self.max_batch and not self._flushing:
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            model = self._queue[0][0]
+            texts, tokens, rest = [], 0, []
+            for key in self._queue:
+                text_tokens = self.count_tokens(key[1], model) if key[0] == model else 0
+                if key[0] != model or len(texts) >= self.max_batch or (
+                        texts and tokens + text_tokens > self.max_batch_tokens):
+                    rest.append(key)
+                    continue
+                texts.append(key[1])
+                tokens += text_tokens
+            self._queue = rest
+            return model, texts
+
+    def _run(self) -> None:
+        while True:
+            model, texts = self._next_batch()
+            try:
+                vectors = self.embed_batch(texts, model)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(vectors)}")
+                outcome = [(vector, None) for vector in vectors]
+            except Exception as e:
+                outcome = [(None, e)] * len(texts)
+
+            with self._cond:
+                self.counters["batches"] += 1
+                self.counters["texts"] += len(texts)
+                for text, (vector, error) in zip(texts, outcome):
+                    future = self._pending.pop((model, text))
+                    if error is not None:
+                        self.counters["errors"] += 1
+                        future.set_exception(error)
+                    else:
+                        future.set_result(vector)
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self.counters)
+            stats["queued"] = len(self._queue)
+            stats["average_batch"] = stats["texts"] / stats["batches"] if stats["batches"] else 0.0
+            return stats
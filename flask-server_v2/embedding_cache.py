@@ -0,0 +1,179 @@
+"""Persistent cache of text embeddings.
+
+Vectors are keyed on a hash of the embedding model and the exact text, so
+fixed strings (retrieval queries, perspective previews) and re-runs of the
+same story are only ever embedded once. They are stored as float16, half the
+size of float32 and a quarter of a JSON list, which costs nothing measurable
+in cosine similarity. Lookups go through a small in-memory LRU and then a
+SQLite database trimmed to a maximum number of least recently used entries.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+EMBEDDING_CACHE_ENABLED = os.getenv("STORYFORGE_EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_CACHE_PATH = os.getenv("STORYFORGE_EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("STORYFORGE_EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("STORYFORGE_EMBEDDING_CACHE_MEMORY_ENTRIES", "2048"))
+
+
+def embedding_key(model: str, text: str) -> str:
+    """Stable key for the embedding of ``text`` by ``model``"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def pack_vector(vector: List[float]) -> bytes:
+    return np.asarray(vector, dtype=np.float16).tobytes()
+
+
+def unpack_vector(blob: bytes) -> List[float]:
+    return np.frombuffer(blob, dtype=np.float16).astype(np.float32).tolist()
+
+
+class EmbeddingCache:
+    """Two-tier (memory LRU + SQLite) cache of float16 embeddings"""
+
+    def __init__(self, path: Optional[str] = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+                 max_memory_entries: int = EMBEDDING_CACHE_MEMORY_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_memory_entries = max_memory_entries
+
+        self._memory = OrderedDict()  # key -> packed vector
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+        self._conn = None
+        if path:
+            try:
+                self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT NOT NULL, dims INTEGER NOT NULL, "
+                    "vector BLOB NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings(accessed_at)")
+                self._conn.commit()
+            except Exception as e:
+                print(f"Error opening embedding cache at {path}: {e}")
+                self._conn = None
+
+    def _remember(self, key: str, blob: bytes) -> None:
+        self._memory[key] = blob
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Return the cached embedding of ``text`` by ``model`` or None"""
+        key = embedding_key(model, text)
+        with self._lock:
+            blob = self._memory.get(key)
+            if blob is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return unpack_vector(blob)
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        self._conn.execute("UPDATE embeddings SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                        self._conn.commit()
+                        self._remember(key, row[0])
+                        self.counters["disk_hits"] += 1
+                        return unpack_vector(row[0])
+                except Exception as e:
+                    print(f"Error reading embedding cache: {e}")
+
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, model: str, text: str, vector: List[float]) -> None:
+        """Store the embedding of ``text`` by ``model``"""
+        if not vector:
+            return
+        key = embedding_key(model, text)
+        blob = pack_vector(vector)
+        with self._lock:
+            self._remember(key, blob)
+            self.counters["writes"] += 1
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dims, vector, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, len(vector), blob, time.time())
+                )
+                self._conn.commit()
+                self._writes_since_evict += 1
+                if self._writes_since_evict >= 100:
+                    self._evict_disk()
+            except Exception as e:
+                print(f"Error writing embedding cache: {e}")
+
+    def _evict_disk(self) -> None:
+        """Drop least recently used rows beyond ``max_entries``"""
+        self._writes_since_evict = 0
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            evicted = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY accessed_at ASC LIMIT ?)", (excess,)
+            ).rowcount
+            self._conn.commit()
+            self.counters["evictions"] += evicted
+
+    def evict(self) -> None:
+        """Run disk eviction now"""
+        with self._lock:
+            if self._conn is not None:
+                self._evict_disk()
+
+    def clear(self) -> None:
+        """Remove every cached embedding"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM embeddings")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters plus current tier sizes"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            if self._conn is not None:
+                count, size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+                ).fetchone()
+                stats["disk_entries"] = count
+                stats["disk_bytes"] = size
+            return stats
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Return the process-wide embedding cache, or None when caching is disabled"""
+    global _default_cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
@@ -0,0 +1,156 @@
+"""Incremental BM25 index over StoryMemory's chunks.
+
+Dense retrieval is poor at exact lookups ("everything about Mira") and needs
+an embedding round trip per query. This index keeps an inverted list of
+term -> {chunk: term frequency} that is updated on every add, so a lexical
+query is a few dictionary lookups and works with no embedding backend at
+all. StoryMemory fuses its ranking with the vector ranking through
+reciprocal rank fusion.
+
+Every add appends one JSON line per new document (its text, metadata and
+term frequencies) to a log next to the vector index, so a write costs the
+size of the batch rather than of the whole index. Opening the index replays
+the log into postings without tokenizing anything again.
+"""
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from vector_index import metadata_matches
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # The usual reciprocal rank fusion constant; larger flattens the rank bonus
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from had has have he her his in is it its of on or she that the their "
+    "them they this to was were with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def token_jaccard(texts: List[str]) -> List[List[float]]:
+    """Pairwise Jaccard similarity of the token sets of ``texts``, a cheap stand-in for cosine similarity"""
+    token_sets = [set(tokenize(text)) for text in texts]
+    return [
+        [len(a & b) / len(a | b) if a | b else 1.0 for b in token_sets]
+        for a in token_sets
+    ]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> Dict[str, float]:
+    """Fused score of every id in ``rankings`` (each a list of ids, best first)"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return dict(scores)
+
+
+class BM25Index:
+    """Append-only BM25 index with metadata filters"""
+
+    def __init__(self, path: Optional[str] = None, k1: float = BM25_K1, b: float = BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+
+        self._lock = threading.Lock()
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._lengths = []
+        self._total_length = 0
+        self._positions = {}
+        self._postings = defaultdict(dict)  # term -> {position: term frequency}
+
+    @classmethod
+    def open(cls, path: str) -> "BM25Index":
+        """Replay the log at ``path``, or start an empty one there"""
+        index = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # A line cut short by a crash
+                        index._index(entry["id"], entry["document"], entry["metadata"], entry["terms"])
+            except Exception as e:
+                print(f"Error loading lexical index {path}: {e}")
+        return index
+
+    def count(self) -> int:
+        return len(self._ids)
+
+    def _index(self, doc_id: str, document: str, metadata: Dict[str, Any], terms: Dict[str, int]) -> bool:
+        if doc_id in self._positions:
+            return False
+        position = len(self._ids)
+        for term, frequency in terms.items():
+            self._postings[term][position] = frequency
+        self._positions[doc_id] = position
+        self._ids.append(doc_id)
+        self._documents.append(document)
+        self._metadatas.append(metadata)
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+        return True
+
+    def add(self, ids: List[str], documents: List[str], metadatas: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Index documents and append them to the log; ids that are already present are skipped"""
+        with self._lock:
+            lines = []
+            for doc_id, document, metadata in zip(ids, documents, metadatas or [{}] * len(ids)):
+                terms = dict(Counter(tokenize(document)))
+                if self._index(doc_id, document, metadata, terms):
+                    lines.append(json.dumps({"id": doc_id, "document": document, "metadata": metadata,
+                                             "terms": terms}) + "\n")
+            if not lines or not self.path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.writelines(lines)
+            except Exception as e:
+                print(f"Error appending to lexical index {self.path}: {e}")
+
+    def query(self, text: str, n_results: int = 10,
+              where: Optional[Dict[str, Any]] = None) -> Dict[str, List[Any]]:
+        """Top documents for ``text`` by BM25, as {ids, documents, metadatas, scores}"""
+        result = {"ids": [], "documents": [], "metadatas": [], "scores": []}
+        with self._lock:
+            total = len(self._ids)
+            if not total:
+                return result
+            average_length = self._total_length / total or 1.0
+            scores = defaultdict(float)
+            for term in set(tokenize(text)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[position] / average_length)
+                    scores[position] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+            candidates = scores.items()
+            if where:
+                candidates = [item for item in candidates if metadata_matches(self._metadatas[item[0]], where)]
+            for position, score in heapq.nlargest(n_results, candidates, key=lambda item: item[1]):
+                result["ids"].append(self._ids[position])
+                result["documents"].append(self._documents[position])
+                result["metadatas"].append(self._metadatas[position])
+                result["scores"].append(score)
+            return result
@@ -0,0 +1,196 @@
+"""Content-addressed cache for StoryForge LLM responses.
+
+Responses are keyed on a hash of everything that determines a completion
+(system prompt, prompt, model, temperature, max_tokens). Lookups go through a
+small in-memory LRU first and then an on-disk SQLite database in WAL mode,
+which is trimmed by age (TTL) and by total size.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+
+LLM_CACHE_ENABLED = os.getenv("STORYFORGE_LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = os.getenv("STORYFORGE_LLM_CACHE_PATH", ".llm_cache.sqlite3")
+LLM_CACHE_TTL = float(os.getenv("STORYFORGE_LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+LLM_CACHE_MAX_MB = float(os.getenv("STORYFORGE_LLM_CACHE_MAX_MB", "256"))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("STORYFORGE_LLM_CACHE_MEMORY_ENTRIES", "256"))
+
+
+def make_cache_key(system_prompt: str, prompt: str, model: str, temperature: float,
+                   max_tokens: Union[int, str]) -> str:
+    """Hash the inputs of a completion into a stable cache key.
+
+    ``max_tokens`` may also be a label such as "stage:scene:1" for calls whose
+    limit comes from a tuned budget.
+    """
+    payload = json.dumps(
+        [system_prompt, prompt, model, float(temperature), max_tokens],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Two-tier (memory LRU + SQLite) cache of completion text"""
+
+    def __init__(self, path: Optional[str] = LLM_CACHE_PATH, max_memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024), ttl_seconds: float = LLM_CACHE_TTL):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._memory = OrderedDict()  # key -> (value, created_at)
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+        self._conn = None
+        if path:
+            try:
+                self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+                self._conn.commit()
+            except Exception as e:
+                print(f"Error opening LLM cache at {path}: {e}")
+                self._conn = None
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for ``key`` or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None:
+                        value, created_at = row
+                        if not self._expired(created_at, now):
+                            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                            self._conn.commit()
+                            self._remember(key, value, created_at)
+                            self.counters["disk_hits"] += 1
+                            return value
+                        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self._conn.commit()
+                except Exception as e:
+                    print(f"Error reading LLM cache: {e}")
+
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """Store a response under ``key``"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self.counters["writes"] += 1
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value.encode("utf-8")), now, now)
+                )
+                self._conn.commit()
+                self._writes_since_evict += 1
+                if self._writes_since_evict >= 50:
+                    self._evict_disk(now)
+            except Exception as e:
+                print(f"Error writing LLM cache: {e}")
+
+    def _evict_disk(self, now: float) -> None:
+        """Drop expired rows, then least recently used rows until under the size limit"""
+        self._writes_since_evict = 0
+        evicted = 0
+        if self.ttl_seconds > 0:
+            evicted += self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+            ).rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_disk_bytes:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC").fetchall()
+            doomed = []
+            for key, size in rows:
+                if total <= self.max_disk_bytes:
+                    break
+                doomed.append((key,))
+                total -= size
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            evicted += len(doomed)
+        self._conn.commit()
+        self.counters["evictions"] += evicted
+
+    def evict(self) -> None:
+        """Run disk eviction now"""
+        with self._lock:
+            if self._conn is not None:
+                self._evict_disk(time.time())
+
+    def clear(self) -> None:
+        """Remove every cached response"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters plus current tier sizes"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            if self._conn is not None:
+                count, size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+                stats["disk_entries"] = count
+                stats["disk_bytes"] = size
+            return stats
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """Return the process-wide response cache, or None when caching is disabled"""
+    global _default_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMResponseCache()
+        return _default_cache
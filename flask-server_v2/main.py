@@ -1,8 +1,9 @@
 import json
+import sys
 import time
 import traceback
 from typing import Dict, Any
-from storyforge import storyforge_pipeline
+from storyforge import apply_pipeline_event, iter_storyforge_pipeline, new_pipeline_result
 import os
 from pymongo import MongoClient
 from dotenv import load_dotenv
@@ -65,6 +66,27 @@ def save_results_to_database(results: Dict[str, Any], input_id) -> None:
         if 'client' in locals():
             client.close()
 
+def describe_event(event: Dict[str, Any]) -> str:
+    """One-line summary of a pipeline event"""
+    kind = event["type"]
+    if kind == "perspectives":
+        return f"{len(event['perspectives'])} perspectives ready"
+    if kind == "flash_cards":
+        return f"Flash cards ready for perspective {event['index'] + 1}"
+    if kind == "story_bible":
+        return f"Story bible ready: {event['story_bible'].get('title', 'Untitled')}"
+    if kind == "episode_outline":
+        return f"Episode {event['index'] + 1} outlined: {event['episode'].get('title', 'Untitled')}"
+    if kind == "scene":
+        return f"Episode {event['episode_index'] + 1}, scene {event['scene_index'] + 1} written"
+    if kind == "full_story":
+        return f"Story compiled ({len(event['full_story'])} characters)"
+    if kind == "story_files":
+        return f"Story written to {event['story_files']['markdown']}"
+    if kind == "done":
+        return "Pipeline finished" if event["success"] else f"Pipeline failed: {event['error']}"
+    return f"{kind.replace('_', ' ').capitalize()} ready"
+
 def main():
     try:
         # Fetch query from database
@@ -77,7 +99,14 @@ def main():
         # Run the pipeline
         print("\nRunning StoryForge pipeline...")
         start_time = time.time()
-        result = storyforge_pipeline(user_query)
+        # Pass --resume to pick up a previous run of the same query where it stopped
+        result = new_pipeline_result()
+        # The story itself is streamed to files rather than held in the result
+        story_path = os.path.join("stories", datetime.utcnow().strftime("story_%Y%m%d_%H%M%S"))
+        for event in iter_storyforge_pipeline(user_query, resume="--resume" in sys.argv[1:], story_path=story_path):
+            # Report progress as each piece arrives rather than after the whole run
+            print(f"[{time.time() - start_time:6.1f}s] {describe_event(event)}")
+            apply_pipeline_event(result, event)
         elapsed_time = time.time() - start_time
         print(result)
         print(elapsed_time)
@@ -91,12 +120,13 @@ def main():
         if result.get("success"):
             print("\nResults:")
             print(f"- Generated {len(result['episodes'])} episodes")
-            print(f"- Full story length: {len(result['full_story'])} characters")
+            print(f"- Story written to {result['story_files'].get('text')} and {result['story_files'].get('markdown')}")
             if result.get("cover_image_url"):
                 print(f"- Cover image URL: {result['cover_image_url']}")
 
             print("\nSample from the story:")
-            print(result['full_story'][:500] + "...")
+            with open(result['story_files']['text'], encoding="utf-8") as f:
+                print(f.read(500) + "...")
         else:
             print("\nPipeline failed with error:")
             print(result.get("error", "Unknown error"))
@@ -0,0 +1,130 @@
+"""Process-wide database clients for StoryMemory and the checkpoint store.
+
+Opening a Chroma PersistentClient and a MongoClient per pipeline run is
+slow: each Mongo client starts its own connection pool and monitor threads,
+and the old per-run ``ping`` blocked for the full server selection timeout
+whenever MongoDB was down. The service here creates one pooled MongoClient
+and one Chroma client, lazily, and hands them out to every caller.
+
+pymongo clients are thread-safe; Chroma's local client is not documented as
+such, so callers hold ``chroma_lock`` around every Chroma call. ``close()``
+flushes the write-behind queues and releases both clients (it is registered
+with atexit); the next caller reopens them.
+"""
+import atexit
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from pymongo import MongoClient
+
+from memory_writer import flush_all
+
+MONGO_URI = os.getenv("STORYFORGE_MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.getenv("STORYFORGE_MONGO_DB", "storyforge")
+MONGO_MAX_POOL_SIZE = int(os.getenv("STORYFORGE_MONGO_MAX_POOL_SIZE", "20"))
+CHROMA_PATH = os.getenv("STORYFORGE_CHROMA_PATH", ".chromadb")
+# After a failed connection, callers are told MongoDB is unavailable for this
+# long instead of each waiting out the server selection timeout again
+MONGO_RETRY_SECONDS = float(os.getenv("STORYFORGE_MONGO_RETRY_SECONDS", "30"))
+
+
+class MemoryService:
+    """Shared, lazily opened MongoDB and Chroma clients"""
+
+    def __init__(self, mongo_uri: str = MONGO_URI, db_name: str = MONGO_DB,
+                 max_pool_size: int = MONGO_MAX_POOL_SIZE, chroma_path: str = CHROMA_PATH):
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.max_pool_size = max_pool_size
+        self.chroma_path = chroma_path
+
+        self.chroma_lock = threading.RLock()  # Held around every call on the Chroma client
+        self._lock = threading.Lock()
+        self._mongo = None
+        self._mongo_checked = False  # Whether the current client answered a ping
+        self._mongo_failed_at = None
+        self._chroma = None
+        self._chroma_failed = False
+        self.counters = {"mongo_connects": 0, "mongo_failures": 0, "chroma_opens": 0}
+
+    def mongo_client(self) -> Optional[MongoClient]:
+        """The pooled MongoClient, or None while MongoDB is unreachable"""
+        with self._lock:
+            if self._mongo_checked:
+                return self._mongo
+            if self._mongo_failed_at is not None and time.monotonic() - self._mongo_failed_at < MONGO_RETRY_SECONDS:
+                return None
+            try:
+                if self._mongo is None:
+                    self._mongo = MongoClient(self.mongo_uri, maxPoolSize=self.max_pool_size,
+                                              serverSelectionTimeoutMS=5000)
+                self._mongo.admin.command('ping')
+                self._mongo[self.db_name]['memory'].create_index("story_id")
+                self._mongo_checked = True
+                self._mongo_failed_at = None
+                self.counters["mongo_connects"] += 1
+                return self._mongo
+            except Exception as e:
+                print(f"Error initializing MongoDB: {e}")
+                self._mongo_failed_at = time.monotonic()
+                self.counters["mongo_failures"] += 1
+                return None
+
+    def mongo_db(self):
+        """The StoryForge database, or None while MongoDB is unreachable"""
+        client = self.mongo_client()
+        return client[self.db_name] if client is not None else None
+
+    def chroma_client(self):
+        """The shared Chroma client, or None if it could not be opened"""
+        with self._lock:
+            if self._chroma is None and not self._chroma_failed:
+                try:
+                    import chromadb
+                    self._chroma = chromadb.PersistentClient(path=self.chroma_path)
+                    self.counters["chroma_opens"] += 1
+                except Exception as e:
+                    print(f"Error initializing ChromaDB: {e}")
+                    self._chroma_failed = True
+            return self._chroma
+
+    def close(self) -> None:
+        """Write out queued memory stores, then release both clients; later calls open new ones"""
+        if not flush_all(timeout=30):
+            print("Closing the memory service with memory writes still pending")
+        with self._lock:
+            if self._mongo is not None:
+                try:
+                    self._mongo.close()
+                except Exception as e:
+                    print(f"Error closing MongoDB client: {e}")
+            self._mongo = None
+            self._mongo_checked = False
+            self._mongo_failed_at = None
+            with self.chroma_lock:
+                self._chroma = None  # PersistentClient has no close(); it persists on every write
+                self._chroma_failed = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["mongo_connected"] = self._mongo_checked
+            stats["mongo_max_pool_size"] = self.max_pool_size
+            stats["chroma_open"] = self._chroma is not None
+            return stats
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_memory_service() -> MemoryService:
+    """Return the process-wide memory service, closed automatically at exit"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = MemoryService()
+            atexit.register(_service.close)
+        return _service
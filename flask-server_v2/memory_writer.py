@@ -0,0 +1,141 @@
+"""Write-behind queue for StoryMemory.store.
+
+Items submitted from any thread are written by a background thread in
+batches, so the caller doesn't wait for the embedding, MongoDB and vector
+index round trips. The queue is bounded: when it is full, ``submit`` blocks
+until the writer catches up. ``flush`` waits for everything submitted so
+far; ``flush_all`` does that for every queue in the process and runs when
+the memory service closes.
+
+The worker thread exits after a while without work and is started again by
+the next ``submit``, so idle stories don't keep threads around.
+"""
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, List, Optional
+
+MEMORY_WRITE_BEHIND = os.getenv("STORYFORGE_MEMORY_WRITE_BEHIND", "1") != "0"
+MEMORY_QUEUE_SIZE = int(os.getenv("STORYFORGE_MEMORY_QUEUE_SIZE", "1000"))
+MEMORY_WRITE_BATCH = int(os.getenv("STORYFORGE_MEMORY_WRITE_BATCH", "64"))
+MEMORY_WRITE_DELAY_MS = float(os.getenv("STORYFORGE_MEMORY_WRITE_DELAY_MS", "50"))
+WORKER_IDLE_SECONDS = 10.0
+
+_queues = weakref.WeakSet()
+
+
+class WriteBehindQueue:
+    """Bounded queue drained in batches by ``write_batch(items)`` on a background thread"""
+
+    def __init__(self, write_batch: Callable[[List[Any]], None], max_queue: int = MEMORY_QUEUE_SIZE,
+                 max_batch: int = MEMORY_WRITE_BATCH, max_delay_ms: float = MEMORY_WRITE_DELAY_MS,
+                 name: str = "storyforge-memory-writer"):
+        self.write_batch = write_batch
+        self.max_queue = max(1, max_queue)
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000.0
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._in_flight = 0  # Items taken by the worker and not yet written
+        self._thread = None
+        self._flushing = 0  # Callers in flush(); batches go out without waiting
+        self.counters = {"submitted": 0, "written": 0, "batches": 0, "errors": 0, "full_waits": 0}
+        _queues.add(self)
+
+    def submit(self, item: Any) -> None:
+        """Queue ``item`` for writing, waiting for room if the queue is full"""
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.counters["full_waits"] += 1
+                while len(self._queue) >= self.max_queue:
+                    self._ensure_worker()
+                    self._cond.wait()
+            self._queue.append(item)
+            self.counters["submitted"] += 1
+            self._ensure_worker()
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        """Items submitted but not yet written"""
+        with self._cond:
+            return len(self._queue) + self._in_flight
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every submitted item has been written (or failed)
+
+        Returns False if ``timeout`` seconds passed first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._queue or self._in_flight:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def _ensure_worker(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _next_batch(self) -> Optional[List[Any]]:
+        """Block until a batch is due and take it, or return None after idling too long"""
+        with self._cond:
+            idle_until = time.monotonic() + WORKER_IDLE_SECONDS
+            while not self._queue:
+                remaining = idle_until - time.monotonic()
+                if remaining <= 0:
+                    self._thread = None
+                    return None
+                self._cond.wait(remaining)
+            # Let a few more stores arrive, unless the batch is full or someone is waiting
+            due = time.monotonic() + self.max_delay
+            while len(self._queue) < self.max_batch and not self._flushing:
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            self._in_flight = len(batch)
+            self._cond.notify_all()  # Room for producers blocked on a full queue
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            failed = False
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                print(f"Error writing {len(batch)} memories: {e}")
+                failed = True
+            with self._cond:
+                self.counters["batches"] += 1
+                self.counters["errors" if failed else "written"] += len(batch)
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self.counters)
+            stats["queued"] = len(self._queue) + self._in_flight
+            return stats
+
+
+def flush_all(timeout: Optional[float] = None) -> bool:
+    """Flush every write-behind queue in the process; False if any timed out"""
+    flushed = True
+    for write_queue in list(_queues):
+        flushed = write_queue.flush(timeout) and flushed
+    return flushed
@@ -0,0 +1,89 @@
+"""Rewrite the embeddings on existing memory documents into another format.
+
+Usage:
+    python migrate_mongo_embeddings.py [--mode float16] [--collection memory] [--batch 500] [--dry-run]
+
+The mode defaults to STORYFORGE_MONGO_EMBEDDINGS (see mongo_embeddings.py).
+Documents already in that mode are left alone. Conversions that would need
+information the document no longer has (anything out of "omit", or out of
+"reduced" into a full-size format) are skipped and counted; re-embed those
+documents' content instead.
+"""
+import argparse
+import time
+
+from pymongo import UpdateOne
+
+from memory_service import get_memory_service
+from mongo_embeddings import (MONGO_EMBEDDING_DIMS, MONGO_EMBEDDING_MODE, MONGO_EMBEDDING_MODES,
+                              decode_embedding, embedding_mode, encode_embedding)
+
+
+def embedding_bytes(embedding) -> int:
+    """Payload size of a stored embedding (BSON doubles are 8 bytes each)"""
+    if embedding is None:
+        return 0
+    return len(embedding) * 8 if isinstance(embedding, list) else len(embedding)
+
+
+def migrate(collection, mode: str, dims: int = MONGO_EMBEDDING_DIMS, batch: int = 500,
+            dry_run: bool = False) -> dict:
+    """Convert every document in ``collection``; returns counts by outcome"""
+    counts = {"converted": 0, "unchanged": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    updates = []
+
+    def write():
+        if updates and not dry_run:
+            collection.bulk_write(updates, ordered=False)
+        updates.clear()
+
+    projection = {"embedding": 1, "embedding_format": 1}
+    for doc in collection.find({}, projection, batch_size=batch):
+        current = embedding_mode(doc)
+        if current == mode:
+            counts["unchanged"] += 1
+            continue
+        if current == "omit" or (current == "reduced" and mode != "omit"):
+            counts["skipped"] += 1
+            continue
+
+        fields = encode_embedding(decode_embedding(doc), mode, dims)
+        counts["bytes_before"] += embedding_bytes(doc["embedding"])
+        counts["bytes_after"] += embedding_bytes(fields.get("embedding"))
+        unset = {key: "" for key in ("embedding", "embedding_format") if key not in fields}
+        update = {"$set": fields} if fields else {}
+        if unset:
+            update["$unset"] = unset
+        updates.append(UpdateOne({"_id": doc["_id"]}, update))
+        counts["converted"] += 1
+        if len(updates) >= batch:
+            write()
+    write()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", default=MONGO_EMBEDDING_MODE, choices=MONGO_EMBEDDING_MODES)
+    parser.add_argument("--dims", type=int, default=MONGO_EMBEDDING_DIMS, help="Dimensions kept by --mode reduced")
+    parser.add_argument("--collection", default="memory", help="memory or memory_archive")
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="Count what would change without writing")
+    args = parser.parse_args()
+
+    db = get_memory_service().mongo_db()
+    if db is None:
+        raise SystemExit("MongoDB is not reachable")
+
+    start = time.perf_counter()
+    counts = migrate(db[args.collection], args.mode, args.dims, args.batch, args.dry_run)
+    elapsed = time.perf_counter() - start
+    verb = "Would convert" if args.dry_run else "Converted"
+    print(f"{verb} {counts['converted']} documents to {args.mode} in {elapsed:.1f}s "
+          f"({counts['unchanged']} already {args.mode}, {counts['skipped']} skipped)")
+    if counts["converted"]:
+        print(f"Embedding bytes: {counts['bytes_before']:,} -> {counts['bytes_after']:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""How embeddings are stored on StoryMemory's MongoDB documents.
+
+Retrieval reads vectors from the vector index, so the copy on each Mongo
+document is only a backup. Stored as a list of BSON doubles, a 1536-dim
+vector adds about 30 KB per document. STORYFORGE_MONGO_EMBEDDINGS selects a
+more compact format:
+
+    list     BSON array of doubles (the original format)
+    float16  little-endian float16 Binary blob, 2 bytes per dimension
+    int8     int8 Binary blob plus one float scale, 1 byte per dimension
+    reduced  the first STORYFORGE_MONGO_EMBEDDING_DIMS dimensions, renormalised,
+             as float16. Only meaningful for models trained to allow it
+             (OpenAI's text-embedding-3 family); for others it loses recall.
+    omit     no embedding on the document at all
+
+Blob formats are described by an ``embedding_format`` subdocument, so
+documents written in different modes can live in one collection and
+``decode_embedding`` reads any of them. migrate_mongo_embeddings.py rewrites
+existing documents into the current mode.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from bson.binary import Binary
+
+MONGO_EMBEDDING_MODES = ("list", "float16", "int8", "reduced", "omit")
+MONGO_EMBEDDING_MODE = os.getenv("STORYFORGE_MONGO_EMBEDDINGS", "float16")
+MONGO_EMBEDDING_DIMS = int(os.getenv("STORYFORGE_MONGO_EMBEDDING_DIMS", "256"))
+
+
+def encode_embedding(vector: List[float], mode: str = MONGO_EMBEDDING_MODE,
+                     dims: int = MONGO_EMBEDDING_DIMS) -> Dict[str, Any]:
+    """Fields to set on a memory document for ``vector`` (empty for "omit")"""
+    if mode not in MONGO_EMBEDDING_MODES:
+        raise ValueError(f"Unknown Mongo embedding mode '{mode}', expected one of {', '.join(MONGO_EMBEDDING_MODES)}")
+    if mode == "omit" or not vector:
+        return {}
+    if mode == "list":
+        return {"embedding": list(vector)}
+
+    values = np.asarray(vector, dtype=np.float32)
+    if mode == "int8":
+        scale = float(np.abs(values).max()) / 127.0 or 1.0
+        blob = np.round(values / scale).astype(np.int8).tobytes()
+        return {"embedding": Binary(blob),
+                "embedding_format": {"encoding": "int8", "dims": len(values), "scale": scale}}
+
+    fields = {"encoding": "float16", "dims": len(values)}
+    if mode == "reduced" and dims < len(values):
+        values = values[:dims]
+        norm = float(np.linalg.norm(values))
+        if norm:
+            values = values / norm
+        fields = {"encoding": "float16", "dims": dims, "reduced_from": fields["dims"]}
+    return {"embedding": Binary(values.astype("<f2").tobytes()), "embedding_format": fields}
+
+
+def decode_embedding(doc: Dict[str, Any]) -> Optional[List[float]]:
+    """The embedding stored on ``doc`` in any format, or None if it has none"""
+    embedding = doc.get("embedding")
+    if embedding is None:
+        return None
+    fmt = doc.get("embedding_format")
+    if fmt is None:
+        return list(embedding)  # Plain list from the original format
+    if fmt["encoding"] == "int8":
+        return (np.frombuffer(embedding, dtype=np.int8).astype(np.float32) * fmt["scale"]).tolist()
+    return np.frombuffer(embedding, dtype="<f2").astype(np.float32).tolist()
+
+
+def embedding_mode(doc: Dict[str, Any]) -> str:
+    """Which of MONGO_EMBEDDING_MODES ``doc`` was written in"""
+    if doc.get("embedding") is None:
+        return "omit"
+    fmt = doc.get("embedding_format")
+    if fmt is None:
+        return "list"
+    if "reduced_from" in fmt:
+        return "reduced"
+    return fmt["encoding"]
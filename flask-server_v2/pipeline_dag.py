@@ -0,0 +1,174 @@
+"""Small dependency-graph executor for the StoryForge pipeline.
+
+Stages are plain callables that receive the results of every completed
+stage. A stage runs as soon as all of its dependencies have finished, on a
+bounded thread pool, so independent work (e.g. flash cards for different
+perspectives) overlaps. Stages may add further stages while running, which
+is how per-perspective and per-episode fan-out is expressed when the number
+of items is only known at runtime. Dependencies may name stages that will be
+added later.
+
+Given a checkpoint store, every stage result is saved as it completes, and a
+resumed run restores finished stages instead of running them again; stages
+added with ``checkpoint=False`` are always run. Fan-out goes through each
+stage's ``expand`` hook rather than its main function, so that it happens for
+restored stages too.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class StageError(Exception):
+    """Raised by DAGExecutor.run when a stage fails"""
+
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"Stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class _Stage:
+    def __init__(self, name: str, fn: Callable[[Dict[str, Any]], Any], deps: List[str],
+                 expand: Optional[Callable[[Any], None]], checkpoint: bool = True):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.expand = expand
+        self.checkpoint = checkpoint
+
+
+class DAGExecutor:
+    """Run stages in dependency order with at most ``max_workers`` at a time"""
+
+    def __init__(self, max_workers: int = 4, on_stage_done: Optional[Callable[[str, Any], None]] = None,
+                 checkpoints=None, run_id: Optional[str] = None, resume: bool = False):
+        self.max_workers = max_workers
+        self.on_stage_done = on_stage_done
+        self.checkpoints = checkpoints if run_id else None
+        self.run_id = run_id
+        self.resume = resume
+        self.restored = []  # stages taken from checkpoints instead of being run
+        self.results = {}
+        self.started = set()  # stages handed to the pool, finished or not
+        self.timings = {}  # stage -> seconds
+        self.dependencies = {}  # stage -> dependency names
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def add(self, name: str, fn: Callable[[Dict[str, Any]], Any], deps: Iterable[str] = (),
+            expand: Optional[Callable[[Any], None]] = None, checkpoint: bool = True) -> None:
+        """Register a stage. Safe to call from inside a running stage.
+
+        ``expand`` is called with the stage's result (computed or restored)
+        and may add further stages. With ``checkpoint=False`` the result is
+        neither saved nor restored, for outputs that go stale.
+        """
+        with self._lock:
+            if name in self._stages or name in self.results:
+                raise ValueError(f"Stage '{name}' already exists")
+            self._stages[name] = _Stage(name, fn, list(deps), expand, checkpoint)
+            self.dependencies[name] = list(deps)
+
+    def started_stages(self) -> List[str]:
+        """Stages that are running or have finished; they can no longer be dropped"""
+        with self._lock:
+            return sorted(self.started)
+
+    def cancel(self) -> None:
+        """Start no further stages; run() raises once the running ones finish"""
+        self._cancelled.set()
+
+    def _ready(self, running: set) -> List[_Stage]:
+        with self._lock:
+            return [
+                stage for name, stage in self._stages.items()
+                if name not in running and all(dep in self.results for dep in stage.deps)
+            ]
+
+    def _run_stage(self, stage: _Stage) -> Any:
+        if self.checkpoints is not None and self.resume and stage.checkpoint:
+            found, value = self.checkpoints.load(self.run_id, stage.name)
+            if found:
+                with self._lock:
+                    self.restored.append(stage.name)
+                if stage.expand is not None:
+                    stage.expand(value)
+                return value
+
+        start = time.monotonic()
+        try:
+            value = stage.fn(self.results)
+        finally:
+            self.timings[stage.name] = time.monotonic() - start
+        if self.checkpoints is not None and stage.checkpoint:
+            self.checkpoints.save(self.run_id, stage.name, value)
+        if stage.expand is not None:
+            stage.expand(value)
+        return value
+
+    def run(self) -> Dict[str, Any]:
+        """Run every stage; returns the results keyed by stage name"""
+        running = {}  # future -> stage
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="storyforge-stage") as pool:
+            while True:
+                if failure is None and not self._cancelled.is_set():
+                    for stage in self._ready(set(s.name for s in running.values())):
+                        if len(running) >= self.max_workers:
+                            break
+                        with self._lock:
+                            self.started.add(stage.name)
+                        running[pool.submit(self._run_stage, stage)] = stage
+
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    with self._lock:
+                        del self._stages[stage.name]
+                    try:
+                        value = future.result()
+                    except BaseException as e:
+                        if failure is None:
+                            failure = StageError(stage.name, e)
+                        continue
+                    self.results[stage.name] = value
+                    if self.on_stage_done is not None:
+                        try:
+                            self.on_stage_done(stage.name, value)
+                        except Exception as e:
+                            print(f"Error in stage callback for {stage.name}: {e}")
+
+        if failure is not None:
+            raise failure
+        if self._cancelled.is_set() and self._stages:
+            raise RuntimeError("Pipeline cancelled")
+        if self._stages:
+            missing = {
+                name: [dep for dep in stage.deps if dep not in self.results]
+                for name, stage in self._stages.items()
+            }
+            raise RuntimeError(f"Stages with unresolved dependencies: {missing}")
+        return self.results
+
+    def critical_path_seconds(self) -> float:
+        """Duration of the longest dependency chain among finished stages.
+
+        This is the best wall-clock time the graph could achieve with
+        unlimited workers; compare with ``sum(self.timings.values())``.
+        """
+        memo = {}
+
+        def finish(name: str) -> float:
+            if name not in memo:
+                deps = self.dependencies.get(name, [])
+                memo[name] = self.timings.get(name, 0.0) + max((finish(d) for d in deps), default=0.0)
+            return memo[name]
+
+        return max((finish(name) for name in self.timings), default=0.0)
@@ -0,0 +1,369 @@
+"""Token-bucket scheduling for OpenAI requests.
+
+Each request kind (chat, embeddings, images) gets its own limiter with a
+requests-per-minute bucket and, where it applies, a tokens-per-minute bucket.
+Callers reserve the estimated cost of a request before sending it. Waiters
+are served in arrival order, so a large request is not starved by a stream
+of small ones. After a 429 the limiter pauses for the server's Retry-After.
+``call_with_retries`` wraps a blocking request in all of that; the OpenAI
+clients are created with their own retries off, so every attempt goes
+through a limiter.
+
+Set STORYFORGE_RATE_LIMIT_DB to a file path to share bucket state between
+processes (e.g. several gunicorn workers) through SQLite. Arrival order is
+then only guaranteed within each process.
+"""
+import asyncio
+import email.utils
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+RATE_LIMIT_DB = os.getenv("STORYFORGE_RATE_LIMIT_DB")
+
+# Per-minute limits for each kind of request. 0 disables a bucket.
+RATE_LIMITS = {
+    "chat": {
+        "rpm": int(os.getenv("STORYFORGE_CHAT_RPM", "500")),
+        "tpm": int(os.getenv("STORYFORGE_CHAT_TPM", "30000")),
+    },
+    "embeddings": {
+        "rpm": int(os.getenv("STORYFORGE_EMBEDDINGS_RPM", "3000")),
+        "tpm": int(os.getenv("STORYFORGE_EMBEDDINGS_TPM", "1000000")),
+    },
+    "images": {
+        "rpm": int(os.getenv("STORYFORGE_IMAGES_RPM", "5")),
+        "tpm": 0,
+    },
+}
+
+POLL_INTERVAL = 0.05  # seconds between checks while queued behind another request
+MAX_RETRIES = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for rate-limit reservations (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Read the Retry-After hint from an OpenAI API error, if there is one"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            parsed = email.utils.parsedate_to_datetime(value)
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    return None
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether another attempt may succeed: connection errors, timeouts, 409, 429 and 5xx"""
+    status = getattr(error, "status_code", None)
+    return status is None or status in (408, 409, 429) or status >= 500
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None, base: float = 2.0, cap: float = 60.0) -> float:
+    """Seconds to wait before retry number ``attempt`` (0-based).
+
+    Honours Retry-After when given and adds jitter either way, so workers that
+    failed together don't all retry at the same instant.
+    """
+    if retry_after is not None:
+        return min(cap, retry_after) + random.uniform(0, min(2.0, 0.25 * retry_after + 0.1))
+    return random.uniform(base / 2, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """Bucket that refills continuously up to ``capacity`` over one minute"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until ``amount`` is available (0 if it is available now)"""
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    """RPM + TPM limiter for one kind of request"""
+
+    def __init__(self, name: str, rpm: int, tpm: int = 0, state_path: Optional[str] = None):
+        self.name = name
+        self.buckets = {}
+        if rpm:
+            self.buckets["requests"] = TokenBucket(rpm)
+        if tpm:
+            self.buckets["tokens"] = TokenBucket(tpm)
+        self.paused_until = 0.0  # wall-clock time, so it can be shared between processes
+
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self.counters = {"acquired": 0, "waited": 0, "wait_seconds": 0.0, "rate_limited": 0}
+
+        self._conn = None
+        if state_path:
+            try:
+                self._conn = sqlite3.connect(state_path, check_same_thread=False, timeout=10, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS buckets ("
+                    "limiter TEXT NOT NULL, bucket TEXT NOT NULL, level REAL NOT NULL, updated REAL NOT NULL, "
+                    "PRIMARY KEY (limiter, bucket))"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pauses (limiter TEXT PRIMARY KEY, paused_until REAL NOT NULL)"
+                )
+            except Exception as e:
+                print(f"Error opening shared rate-limit state at {state_path}: {e}")
+                self._conn = None
+
+    # -- bucket state -------------------------------------------------------
+
+    def _load_shared(self) -> None:
+        """Replace local bucket state with the shared copy (inside a transaction)"""
+        now_wall = time.time()
+        now = time.monotonic()
+        for name, level, updated in self._conn.execute(
+            "SELECT bucket, level, updated FROM buckets WHERE limiter = ?", (self.name,)
+        ):
+            bucket = self.buckets.get(name)
+            if bucket is not None:
+                # Shared timestamps are wall-clock; convert to this process's monotonic clock
+                bucket.level = level
+                bucket.updated = now - max(0.0, now_wall - updated)
+        row = self._conn.execute("SELECT paused_until FROM pauses WHERE limiter = ?", (self.name,)).fetchone()
+        if row:
+            self.paused_until = max(self.paused_until, row[0])
+
+    def _save_shared(self) -> None:
+        now_wall = time.time()
+        now = time.monotonic()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO buckets (limiter, bucket, level, updated) VALUES (?, ?, ?, ?)",
+            [(self.name, name, b.level, now_wall - (now - b.updated)) for name, b in self.buckets.items()]
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO pauses (limiter, paused_until) VALUES (?, ?)", (self.name, self.paused_until)
+        )
+
+    def _take(self, tokens: int) -> float:
+        pause = self.paused_until - time.time()
+        if pause > 0:
+            return pause
+
+        now = time.monotonic()
+        wanted = {"requests": 1, "tokens": tokens}
+        wait = 0.0
+        for name, bucket in self.buckets.items():
+            bucket.refill(now)
+            wait = max(wait, bucket.wait_time(wanted[name]))
+        if wait > 0:
+            return wait
+
+        for name, bucket in self.buckets.items():
+            bucket.level -= min(wanted[name], bucket.capacity)
+        return 0.0
+
+    def _try_take(self, tokens: int) -> float:
+        """Take one request and ``tokens`` tokens if available; otherwise return seconds to wait"""
+        if self._conn is None:
+            return self._take(tokens)
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._load_shared()
+            wait = self._take(tokens)
+            if wait == 0:
+                self._save_shared()
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return wait
+
+    # -- public API ---------------------------------------------------------
+
+    def _enter(self):
+        ticket = object()
+        with self._lock:
+            self._queue.append(ticket)
+        return ticket
+
+    def _poll(self, ticket, tokens: int) -> float:
+        """0 when ``ticket`` got its reservation, otherwise how long to sleep before asking again"""
+        with self._lock:
+            if self._queue[0] is not ticket:
+                return POLL_INTERVAL
+            try:
+                wait = self._try_take(tokens)
+            except Exception as e:
+                print(f"Error in rate limiter {self.name}: {e}")
+                wait = 0.0
+            if wait == 0:
+                self._queue.popleft()
+            return wait
+
+    def _leave(self, ticket) -> None:
+        with self._lock:
+            try:
+                self._queue.remove(ticket)
+            except ValueError:
+                pass
+
+    def _record(self, waited: float) -> None:
+        with self._lock:
+            self.counters["acquired"] += 1
+            if waited > 0.01:
+                self.counters["waited"] += 1
+                self.counters["wait_seconds"] += waited
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until one request and ``tokens`` tokens can be spent"""
+        ticket = self._enter()
+        start = time.monotonic()
+        try:
+            while True:
+                wait = self._poll(ticket, tokens)
+                if wait == 0:
+                    break
+                time.sleep(min(wait, 1.0))
+        except BaseException:
+            self._leave(ticket)
+            raise
+        self._record(time.monotonic() - start)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """asyncio version of ``acquire``"""
+        ticket = self._enter()
+        start = time.monotonic()
+        try:
+            while True:
+                # With shared state a poll is an SQLite transaction, which must not block the event loop
+                if self._conn is not None:
+                    wait = await asyncio.to_thread(self._poll, ticket, tokens)
+                else:
+                    wait = self._poll(ticket, tokens)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait, 1.0))
+        except BaseException:
+            self._leave(ticket)
+            raise
+        self._record(time.monotonic() - start)
+
+    def settle(self, reserved: int, used: Optional[int]) -> None:
+        """Correct the token bucket once the real usage of a request is known"""
+        bucket = self.buckets.get("tokens")
+        if bucket is None or used is None:
+            return
+        with self._lock:
+            bucket.level = min(bucket.capacity, bucket.level + reserved - used)
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "UPDATE buckets SET level = MIN(?, level + ?) WHERE limiter = ? AND bucket = 'tokens'",
+                        (bucket.capacity, reserved - used, self.name)
+                    )
+                except Exception as e:
+                    print(f"Error sharing rate-limit usage: {e}")
+
+    def penalize(self, seconds: float) -> None:
+        """Stop admitting requests for ``seconds`` after the server rate-limited us"""
+        with self._lock:
+            self.counters["rate_limited"] += 1
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "INSERT INTO pauses (limiter, paused_until) VALUES (?, ?) "
+                        "ON CONFLICT(limiter) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)",
+                        (self.name, self.paused_until)
+                    )
+                except Exception as e:
+                    print(f"Error sharing rate-limit pause: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.counters,
+                "queued": len(self._queue),
+                "levels": {name: round(b.level, 1) for name, b in self.buckets.items()},
+            }
+
+
+def call_with_retries(kind: str, request: Callable[[], Any], tokens: int = 0,
+                      max_retries: int = MAX_RETRIES) -> Any:
+    """Send a blocking ``request`` through the ``kind`` limiter, retrying transient failures
+
+    Every attempt reserves one request and ``tokens`` tokens first. A 429
+    pauses the whole limiter for the server's Retry-After, so other callers
+    back off too. The last error is raised once the attempts run out.
+    """
+    limiter = get_rate_limiter(kind)
+    for attempt in range(max_retries):
+        limiter.acquire(tokens)
+        try:
+            return request()
+        except Exception as e:
+            if attempt == max_retries - 1 or not is_retryable_error(e):
+                raise
+            retry_after = retry_after_seconds(e)
+            if is_rate_limit_error(e):
+                limiter.penalize(retry_after if retry_after is not None else backoff_delay(attempt))
+            retry_delay = backoff_delay(attempt, retry_after)
+            print(f"Attempt {attempt+1}/{max_retries} - {kind} request failed: {e}; "
+                  f"retrying in {retry_delay:.1f} seconds...")
+            time.sleep(retry_delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(kind: str) -> RateLimiter:
+    """Return the process-wide limiter for ``kind`` ("chat", "embeddings" or "images")"""
+    with _limiters_lock:
+        limiter = _limiters.get(kind)
+        if limiter is None:
+            limits = RATE_LIMITS[kind]
+            limiter = RateLimiter(kind, limits["rpm"], limits["tpm"], state_path=RATE_LIMIT_DB)
+            _limiters[kind] = limiter
+        return limiter
+
+
+def rate_limit_stats() -> Dict[str, Any]:
+    with _limiters_lock:
+        return {kind: limiter.stats() for kind, limiter in _limiters.items()}
@@ -1,7 +1,8 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 from storyforge import StoryForgeLLM, process_user_query, generate_story_bible
 import storyforge
+from token_budget import EPISODE_TARGET_WORDS
 import json
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
@@ -18,6 +19,9 @@ CORS(app)  # Enable CORS for all routes
 
 llm = StoryForgeLLM()  # Initialize the LLM client
 
+# How long a generated story bible is reused for identical requests
+STORY_BIBLE_MEMO_SECONDS = float(os.getenv("STORYFORGE_STORY_BIBLE_MEMO_SECONDS", "86400"))
+
 # Root route for testing
 @app.route('/', methods=['GET'])
 def home():
@@ -28,11 +32,48 @@ def home():
             {"path": "/generate", "method": "POST", "description": "Generate perspectives from a user query"},
             {"path": "/generate-story-bible", "method": "POST", "description": "Generate a story bible from a perspective"},
             {"path": "/generate_episode", "method": "POST", "description": "Generate an episode based on a story bible"},
+            {"path": "/generate_episode/stream", "method": "POST", "description": "Stream an episode as Server-Sent Events"},
             {"path": "/generate-episode-pdf", "method": "POST", "description": "Generate a PDF for an episode"},
-            {"path": "/generate-story-bible-pdf", "method": "POST", "description": "Generate a PDF for a story bible"}
+            {"path": "/generate-story-bible-pdf", "method": "POST", "description": "Generate a PDF for a story bible"},
+            {"path": "/metrics", "method": "GET", "description": "LLM cache, request coalescing, rate limiter, token budget and stage latency counters"},
+            {"path": "/stories/<story_id>/memory", "method": "DELETE", "description": "Delete a story's memories"},
+            {"path": "/stories/<story_id>/memory/archive", "method": "POST", "description": "Move a story's memories to the archive"}
         ]
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "llm_cache": llm.cache_stats(),
+        "singleflight": {
+            "llm": storyforge.llm_flight.stats(),
+            "embeddings": storyforge.embedding_flight.stats()
+        },
+        "embedding_backend": storyforge.embedding_backend_stats(),
+        "embedding_cache": storyforge.embedding_cache_stats(),
+        "rate_limits": storyforge.rate_limit_stats(),
+        "token_budgets": storyforge.get_token_budgeter().stats(),
+        "stage_latency": storyforge.get_stage_latency_model().stats(),
+        "memory_service": storyforge.get_memory_service().stats(),
+        "story_memory": storyforge.story_memory_stats()
+    })
+
+@app.route('/stories/<story_id>/memory', methods=['DELETE'])
+def drop_story_memory(story_id):
+    try:
+        dropped = storyforge.get_story_memory(story_id).drop()
+        return jsonify({"success": True, "story_id": story_id, "dropped": dropped})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/stories/<story_id>/memory/archive', methods=['POST'])
+def archive_story_memory(story_id):
+    try:
+        archived = storyforge.get_story_memory(story_id).archive()
+        return jsonify({"success": True, "story_id": story_id, "archived": archived})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 # Members API Route
 
 @app.route("/generate", methods=["POST"])
@@ -69,6 +110,7 @@ def create_story_bible():
         perspective = data.get('perspective', {})
         parameters = data.get('parameters', {})
         prompt = data.get('prompt', '')
+        regenerate = bool(data.get('regenerate', False))  # Ask for a fresh bible instead of the memoized one
         
         if not perspective:
             return jsonify({"error": "No perspective provided"}), 400
@@ -89,13 +131,32 @@ def create_story_bible():
             "importance": importance
         })
             
-        # Generate the story bible using the selected perspective and parameters
-        story_bible = generate_story_bible(
-            llm=llm, 
-            perspective=perspective,
-            parameters=parameters,
-            importance=importance,
-            original_query=prompt
+        # Generate the story bible using the selected perspective and parameters,
+        # reusing an earlier one when none of these inputs changed
+        stages = storyforge.new_stage_report()
+        story_bible = storyforge.memoized_stage(
+            "story_bible",
+            {"perspective": perspective, "parameters": parameters, "importance": importance, "query": prompt},
+            lambda: generate_story_bible(
+                llm=llm, 
+                perspective=perspective,
+                parameters=parameters,
+                importance=importance,
+                original_query=prompt
+            ),
+            stages,
+            is_valid=lambda value: value != storyforge.get_default_story_bible(perspective, parameters),
+            max_age=STORY_BIBLE_MEMO_SECONDS,
+            refresh=regenerate,
+            # A regenerated or expired bible must not come back from the LLM response cache
+            recompute=lambda: generate_story_bible(
+                llm=llm,
+                perspective=perspective,
+                parameters=parameters,
+                importance=importance,
+                original_query=prompt,
+                use_cache=False
+            )
         )
         
         if not story_bible:
@@ -106,7 +167,8 @@ def create_story_bible():
         # Return the story bible to the frontend
         return jsonify({
             "success": True,
-            "storyBible": story_bible
+            "storyBible": story_bible,
+            "stages": stages
         })
     except Exception as e:
         print("Error in create_story_bible:", str(e))  # Debug log
@@ -150,6 +212,71 @@ def generate_episode():
         print(f"Error generating episode: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/generate_episode/stream', methods=['POST'])
+def generate_episode_stream():
+    """
+    Stream a story episode as Server-Sent Events.
+    
+    Takes the same request body as /generate_episode and emits:
+    - title: {"title": ...} as soon as the EPISODE TITLE line is complete
+    - token: {"text": ...} for every piece of generated text
+    - episode: the same payload /generate_episode returns, once at the end
+    - error: {"error": ...} if generation fails part way
+    """
+    data = request.json or {}
+    story_bible = data.get('storyBible')
+    episode_number = data.get('episodeNumber', 1)
+    previous_episodes = data.get('previousEpisodes', [])
+    
+    if not story_bible:
+        return jsonify({'error': 'Story bible is required'}), 400
+    
+    prompt = craft_episode_prompt(story_bible, episode_number, previous_episodes)
+    
+    def events():
+        received = []
+        head = ""  # Text scanned for the title line until it is found
+        title_sent = False
+        try:
+            for piece in storyforge.generate_episode_stream(prompt):
+                received.append(piece)
+                yield sse_event("token", {"text": piece})
+                
+                if not title_sent and len(head) < 2000:
+                    head += piece
+                    title = find_streamed_title(head)
+                    if title:
+                        title_sent = True
+                        yield sse_event("title", {"title": title})
+            
+            yield sse_event("episode", parse_episode_response(''.join(received)))
+        except Exception as e:
+            print(f"Error streaming episode: {str(e)}")
+            yield sse_event("error", {"error": str(e)})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Don't let a proxy buffer the stream
+        }
+    )
+
+def find_streamed_title(text):
+    """Return the episode title once its line has fully arrived, otherwise None"""
+    for line in text.split('\n')[:-1]:  # The last line may still be incomplete
+        for indicator in EPISODE_TITLE_INDICATORS:
+            if indicator in line:
+                title_parts = line.split(":", 1)
+                if len(title_parts) > 1 and title_parts[1].strip():
+                    return clean_episode_title(title_parts[1])
+    return None
+
 @app.route('/generate-episode-pdf', methods=['POST'])
 def generate_episode_pdf():
     try:
@@ -647,7 +774,7 @@ def craft_episode_prompt(story_bible, episode_number, previous_episodes, origina
     
     Format the episode as a well-structured narrative that could be read as a standalone 
     story while fitting into the larger story arc. Include dialogue formatting with 
-    character names followed by their lines. Make the episode approximately 1500-2000 words.
+    character names followed by their lines. Make the episode approximately {EPISODE_TARGET_WORDS[0]}-{EPISODE_TARGET_WORDS[1]} words.
     
     IMPORTANT: The episode MUST end with a clear hook that makes readers eager for the next installment.
     The hook should be the last paragraph of the episode and should be clearly marked with "HOOK:" at the beginning.
@@ -659,6 +786,12 @@ def craft_episode_prompt(story_bible, episode_number, previous_episodes, origina
     
     return prompt
 
+EPISODE_TITLE_INDICATORS = ["EPISODE TITLE:", "Title:", "Episode Title:"]
+
+def clean_episode_title(title):
+    """Clean title of any markdown formatting or quotes"""
+    return title.replace('*', '').replace('_', '').replace('"', '').replace("'", "").strip()
+
 def parse_episode_response(response):
     """Parse the AI response into a structured episode format"""
     
@@ -669,11 +802,9 @@ def parse_episode_response(response):
     content = response
     
     # Try to find the title in the response
-    title_indicators = ["EPISODE TITLE:", "Title:", "Episode Title:"]
-    
     for i, line in enumerate(lines):
         # Check for explicit title markers
-        for indicator in title_indicators:
+        for indicator in EPISODE_TITLE_INDICATORS:
             if indicator in line:
                 title_parts = line.split(":", 1)
                 if len(title_parts) > 1:
@@ -695,7 +826,7 @@ def parse_episode_response(response):
             content = '\n'.join(lines[1:]).strip()
     
     # Clean title of any markdown formatting or quotes
-    title = title.replace('*', '').replace('_', '').replace('"', '').replace("'", "").strip()
+    title = clean_episode_title(title)
     
     # Ensure there's a hook at the end
     if not any(hook_phrase in content.lower() for hook_phrase in ["hook:", "to be continued", "what happens next", "little did they know", "but that was just the beginning"]):
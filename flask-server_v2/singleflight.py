@@ -0,0 +1,87 @@
+"""Coalesce identical in-flight calls so they share one upstream request.
+
+The first caller for a key runs the function; callers that arrive with the
+same key while it is still running wait for it and receive the same result
+(or exception). Once the call finishes the key is released, so later calls
+run normally (and usually hit the response cache instead).
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread-based single-flight group for blocking calls"""
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = {"calls": 0, "executions": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run ``fn`` unless an identical call is already in flight, in which case wait for it"""
+        with self._lock:
+            self.counters["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.counters["executions"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.counters, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """asyncio single-flight group. All callers must share one event loop."""
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._tasks = {}
+        self.counters = {"calls": 0, "executions": 0, "coalesced": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await ``fn()`` unless an identical call is already in flight, in which case share its result"""
+        self.counters["calls"] += 1
+        task = self._tasks.get(key)
+        if task is None:
+            self.counters["executions"] += 1
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.counters["coalesced"] += 1
+        # Shield so one caller going away doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "in_flight": len(self._tasks)}
@@ -0,0 +1,203 @@
+"""Per-stage latency estimates and deadline planning for the StoryForge pipeline.
+
+Every pipeline run records how long each stage took, normalised per unit of
+work (per episode for outlines, per "wave" of concurrently written scenes,
+scaled by scene length, for scenes). The estimates are exponentially weighted
+moving averages, persisted between runs, and start from rough defaults.
+
+Given a deadline, plan_for_deadline estimates the pipeline's critical path
+and degrades the run step by step until it fits: a faster model for outlines,
+shorter scenes, fewer scenes per episode, and finally no cover image.
+"""
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from token_budget import SCENE_TARGET_WORDS
+
+STAGE_LATENCY_PATH = os.getenv("STORYFORGE_STAGE_LATENCY_PATH", ".stage_latency.json")
+
+EWMA_ALPHA = 0.3
+DEADLINE_SAFETY = 0.9  # Plan to finish within 90% of the deadline
+
+DEFAULT_OUTLINE_MODEL = "gpt-4o"
+FAST_OUTLINE_MODEL = os.getenv("STORYFORGE_FAST_OUTLINE_MODEL", "gpt-4o-mini")
+SHORTER_SCENE_WORDS = (350, 250)  # Tried in order once the outline model is already fast
+MIN_SCENES = 1
+
+# stage -> seconds per unit before the stage has been observed
+DEFAULT_STAGE_SECONDS = {
+    "perspectives": 10.0,
+    "flash_cards": 12.0,
+    "story_bible": 35.0,
+    "episodes": 4.0,         # Per episode
+    "scenes": 25.0,          # Per wave of concurrent scenes at SCENE_TARGET_WORDS
+    "cover_image": 15.0,
+    "consistency_check": 1.0,
+}
+
+# Share of a stage's time saved by the fast outline model, used until it has been observed
+FAST_OUTLINE_FACTOR = {"episodes": 0.5, "scenes": 0.85}
+
+
+def latency_key(stage: str, outline_model: str = DEFAULT_OUTLINE_MODEL) -> str:
+    """Estimates for stages that write outlines are kept per outline model"""
+    if stage in FAST_OUTLINE_FACTOR and outline_model != DEFAULT_OUTLINE_MODEL:
+        return f"{stage}@{outline_model}"
+    return stage
+
+
+def scene_units(num_scenes: int, scene_words: int, parallel: bool, concurrency: int) -> float:
+    """Units of work in one episode's scenes stage"""
+    waves = math.ceil(num_scenes / max(1, concurrency)) if parallel else num_scenes
+    return waves * scene_words / SCENE_TARGET_WORDS
+
+
+class StageLatencyModel:
+    """EWMA of seconds per unit for each pipeline stage"""
+
+    def __init__(self, path: Optional[str] = STAGE_LATENCY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._seconds = {}  # key -> seconds per unit
+        self._observations = {}  # key -> count
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+                self._seconds = dict(saved.get("seconds", {}))
+                self._observations = dict(saved.get("observations", {}))
+            except Exception as e:
+                print(f"Error loading stage latencies from {path}: {e}")
+
+    def estimate(self, key: str, units: float = 1.0) -> float:
+        """Expected seconds for ``units`` of the stage named by ``key``"""
+        with self._lock:
+            per_unit = self._seconds.get(key)
+        if per_unit is None:
+            stage, _, model = key.partition("@")
+            per_unit = self.estimate(stage) if model else DEFAULT_STAGE_SECONDS.get(stage, 0.0)
+            if model:
+                per_unit *= FAST_OUTLINE_FACTOR.get(stage, 1.0)
+        return per_unit * units
+
+    def observe(self, key: str, seconds: float, units: float = 1.0) -> None:
+        """Record that ``units`` of the stage took ``seconds``"""
+        if units <= 0 or seconds <= 0:
+            return
+        per_unit = seconds / units
+        with self._lock:
+            previous = self._seconds.get(key)
+            self._seconds[key] = per_unit if previous is None else (
+                EWMA_ALPHA * per_unit + (1 - EWMA_ALPHA) * previous
+            )
+            self._observations[key] = self._observations.get(key, 0) + 1
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            data = {"seconds": dict(self._seconds), "observations": dict(self._observations)}
+        try:
+            with open(self.path, "w") as f:
+                json.dump(data, f)
+        except Exception as e:
+            print(f"Error saving stage latencies to {self.path}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                key: {"seconds_per_unit": round(seconds, 3), "observations": self._observations.get(key, 0)}
+                for key, seconds in self._seconds.items()
+            }
+
+
+def estimate_pipeline_seconds(model: StageLatencyModel, settings: Dict[str, Any], num_episodes: int,
+                              max_workers: int, parallel_scenes: bool, scene_concurrency: int,
+                              done: Iterable[str] = ()) -> float:
+    """Estimated wall-clock seconds of the pipeline's critical path
+
+    ``settings`` holds num_scenes, scene_words, outline_model and cover_image.
+    Stages named in ``done`` have already finished and cost nothing.
+    """
+    done = set(done)
+
+    def cost(stage, units=1.0):
+        if stage in done:
+            return 0.0
+        return model.estimate(latency_key(stage, settings["outline_model"]), units)
+
+    # Episodes are written concurrently, a few at a time
+    rounds = math.ceil(num_episodes / max(1, max_workers))
+    scenes = rounds * cost("scenes", scene_units(settings["num_scenes"], settings["scene_words"],
+                                                 parallel_scenes, scene_concurrency))
+    text = cost("story_bible") + cost("episodes", num_episodes) + scenes
+    path = cost("perspectives") + max(cost("flash_cards"), text) + cost("consistency_check")
+    if settings["cover_image"]:
+        path = max(path, cost("cover_image"))
+    return path
+
+
+def plan_for_deadline(model: StageLatencyModel, deadline_s: float, settings: Dict[str, Any],
+                      num_episodes: int, max_workers: int, parallel_scenes: bool, scene_concurrency: int,
+                      done: Iterable[str] = ()) -> Tuple[Dict[str, Any], float]:
+    """Degrade ``settings`` until the estimated run fits in ``deadline_s`` seconds
+
+    Returns the new settings and their estimate. When even the cheapest
+    settings don't fit, those are returned with their (too long) estimate.
+    """
+    done = list(done)
+    budget = deadline_s * DEADLINE_SAFETY
+
+    def estimate(candidate):
+        return estimate_pipeline_seconds(model, candidate, num_episodes, max_workers,
+                                         parallel_scenes, scene_concurrency, done)
+
+    settings = dict(settings)
+    current = estimate(settings)
+    for step in _degradation_steps(settings):
+        if current <= budget:
+            break
+        candidate = dict(settings)
+        step(candidate)
+        # Skip steps that don't shorten the critical path (e.g. fewer scenes
+        # while the cover image is what takes longest)
+        candidate_estimate = estimate(candidate)
+        if candidate_estimate < current:
+            settings, current = candidate, candidate_estimate
+    return settings, current
+
+
+def _degradation_steps(settings: Dict[str, Any]) -> List:
+    """Each step makes the run cheaper, least noticeable first"""
+    steps = []
+    if settings["outline_model"] != FAST_OUTLINE_MODEL:
+        steps.append(lambda s: s.update(outline_model=FAST_OUTLINE_MODEL))
+    for words in SHORTER_SCENE_WORDS:
+        if words < settings["scene_words"]:
+            steps.append(lambda s, words=words: s.update(scene_words=words))
+    for num_scenes in range(settings["num_scenes"] - 1, MIN_SCENES - 1, -1):
+        steps.append(lambda s, num_scenes=num_scenes: s.update(num_scenes=num_scenes))
+    if settings["cover_image"]:
+        steps.append(lambda s: s.update(cover_image=False))
+    return steps
+
+
+def applied_degradations(requested: Dict[str, Any], planned: Dict[str, Any]) -> Dict[str, Any]:
+    """The settings that ``planned`` changed from ``requested``"""
+    return {key: value for key, value in planned.items() if requested.get(key) != value}
+
+
+_latency_model = None
+_latency_model_lock = threading.Lock()
+
+
+def get_stage_latency_model() -> StageLatencyModel:
+    """Return the process-wide latency model"""
+    global _latency_model
+    with _latency_model_lock:
+        if _latency_model is None:
+            _latency_model = StageLatencyModel()
+        return _latency_model
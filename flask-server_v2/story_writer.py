@@ -0,0 +1,128 @@
+"""Write compiled stories straight to text sinks.
+
+A sink is anything with a ``write(str)`` method: an open file, an
+``io.StringIO``, a GridFS upload opened with an encoding, and so on. The
+story is rendered piece by piece, so the full text never has to exist as one
+string unless the caller asks for it. Markdown and plain text can be written
+in the same pass over the episodes, which may be a generator.
+
+Plain text uses the layout compile_story has always produced.
+"""
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO
+
+STORY_TITLE = "COMPLETE STORY"
+EMPTY_STORY = "No story content available."
+PARTIAL_STORY_NOTE = "\n\n[Error occurred during story compilation. Partial content shown.]"
+
+FORMATS = ("text", "markdown")
+
+
+def _scene_details(outline: Any) -> Iterator[tuple]:
+    if not isinstance(outline, dict):
+        return
+    setting = outline.get('setting', '')
+    characters = outline.get('characters', [])
+    tone = outline.get('tone', '')
+    if setting:
+        yield "Setting", setting
+    if characters:
+        yield "Characters", ', '.join(characters)
+    if tone:
+        yield "Tone", tone
+
+
+def render_header(fmt: str) -> Iterator[str]:
+    yield f"# {STORY_TITLE}\n" if fmt == "markdown" else f"# {STORY_TITLE}\n\n"
+
+
+def render_episode(fmt: str, index: int, episode_data: Any) -> Iterator[str]:
+    """Pieces of one episode (with its scenes) in ``fmt``; nothing for invalid data"""
+    if not isinstance(episode_data, dict):
+        return
+    episode = episode_data.get("episode", {})
+    scenes = episode_data.get("scenes", [])
+    if not isinstance(episode, dict) or not isinstance(scenes, list):
+        return
+
+    title = episode.get('title', f'Episode {index+1}')
+    objective = episode.get('objective', '')
+    if fmt == "markdown":
+        yield f"\n## Episode {index+1}: {title}\n\n"
+        if objective:
+            yield f"*Objective: {objective}*\n"
+    else:
+        yield f"\n\nEPISODE {index+1}: {title}\n"
+        yield f"{'=' * 50}\n\n"
+        if objective:
+            yield f"Objective: {objective}\n\n"
+
+    for j, scene in enumerate(scenes):
+        if not isinstance(scene, dict):
+            continue
+        content = scene.get('content', '')
+        details = list(_scene_details(scene.get('outline', {})))
+        if fmt == "markdown":
+            yield f"\n### Scene {j+1}\n\n"
+            for label, value in details:
+                yield f"- **{label}:** {value}\n"
+            if details:
+                yield "\n"
+        else:
+            yield f"\nScene {j+1}\n"
+            yield f"{'-' * 30}\n"
+            for label, value in details:
+                yield f"{label}: {value}\n"
+            yield "\n"
+        yield (content + "\n") if content else "[Scene content missing]\n"
+
+
+def write_story(episodes_with_scenes: Iterable[Dict[str, Any]], text: Optional[TextIO] = None,
+                markdown: Optional[TextIO] = None) -> int:
+    """Write the story to the given sinks in one pass over ``episodes_with_scenes``
+
+    Returns the number of episodes written. If no episode is given at all the
+    sinks receive a short placeholder instead.
+    """
+    sinks = [(fmt, sink) for fmt, sink in (("text", text), ("markdown", markdown)) if sink is not None]
+    written = 0
+    started = False
+    try:
+        for i, episode_data in enumerate(episodes_with_scenes):
+            if not started:
+                started = True
+                for fmt, sink in sinks:
+                    for piece in render_header(fmt):
+                        sink.write(piece)
+            for fmt, sink in sinks:
+                for piece in render_episode(fmt, i, episode_data):
+                    sink.write(piece)
+            written += 1
+    except Exception as e:
+        print(f"Error compiling story: {e}")
+        for _, sink in sinks:
+            sink.write(PARTIAL_STORY_NOTE)
+        return written
+
+    if not started:
+        for _, sink in sinks:
+            sink.write(EMPTY_STORY)
+    return written
+
+
+def iter_story(episodes_with_scenes: Iterable[Dict[str, Any]], fmt: str = "markdown") -> Iterator[str]:
+    """The story as a stream of text pieces, e.g. for a streamed HTTP response"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown story format '{fmt}', expected one of {FORMATS}")
+    started = False
+    try:
+        for i, episode_data in enumerate(episodes_with_scenes):
+            if not started:
+                started = True
+                yield from render_header(fmt)
+            yield from render_episode(fmt, i, episode_data)
+    except Exception as e:
+        print(f"Error compiling story: {e}")
+        yield PARTIAL_STORY_NOTE
+        return
+    if not started:
+        yield EMPTY_STORY
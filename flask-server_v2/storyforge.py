@@ -1,24 +1,49 @@
-from typing import List, Dict, Any, Union, Optional
+from typing import List, Dict, Any, Union, Optional, Callable, Iterator
 import json
 import time
 import traceback
 from datetime import datetime
 import os
 import re
+import hashlib
 import warnings
 import requests
-from io import BytesIO
+from io import BytesIO, StringIO
 from PIL import Image
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from sentence_transformers import SentenceTransformer
 import base64
+import shutil
+import atexit
 
 # Import necessary libraries for OpenAI and ChromaDB
-from openai import OpenAI
-import chromadb
-from chromadb.config import Settings
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from llm_cache import LLMResponseCache, get_llm_cache, make_cache_key
+from singleflight import AsyncSingleFlight, SingleFlight
+from rate_limiter import (backoff_delay, call_with_retries, get_rate_limiter, is_rate_limit_error,
+                          is_retryable_error, retry_after_seconds)
+from token_budget import SCENE_TARGET_WORDS, count_tokens, get_token_budgeter
+from embedding_backends import EmbeddingBackend, get_embedding_backend, model_slug
+from embedding_cache import embedding_key, get_embedding_cache
+from vector_index import VECTOR_INDEX_BACKEND, VECTOR_INDEX_DIR, NumpyVectorIndex, mmr_select
+from memory_service import MemoryService, get_memory_service
+from memory_writer import MEMORY_WRITE_BEHIND, WriteBehindQueue
+from mongo_embeddings import encode_embedding
+from text_chunker import chunk_text
+from lexical_index import BM25Index, reciprocal_rank_fusion, token_jaccard
+from story_writer import write_story
+from stage_latency import (DEFAULT_OUTLINE_MODEL, applied_degradations, get_stage_latency_model, latency_key,
+                           plan_for_deadline, scene_units)
+from pipeline_dag import DAGExecutor
+from checkpoints import (CheckpointStore, claim_run, get_checkpoint_store, get_stage_memo, input_hash,
+                         release_run)
 
 # Suppress specific warnings
 warnings.filterwarnings('ignore')
@@ -27,34 +52,238 @@ load_dotenv()
 # Access the OPENAI_API_KEY
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 try:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    # Retries go through the rate limiters (see call_with_retries), not the client
+    openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
     print("OpenAI client initialized successfully")
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}")
     openai_client = None
 
+# Concurrency limits for the async LLM client
+LLM_MAX_CONCURRENCY = int(os.getenv("STORYFORGE_LLM_CONCURRENCY", "8"))
+LLM_MAX_CONNECTIONS = int(os.getenv("STORYFORGE_LLM_MAX_CONNECTIONS", "20"))
+
+# Shared pooled HTTP client for all async completions. It is only ever used
+# from the StoryForge event loop thread (see run_on_llm_loop).
+try:
+    async_http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_CONNECTIONS
+        ),
+        timeout=httpx.Timeout(120.0, connect=10.0)
+    )
+    # Retries are handled by AsyncStoryForgeLLM so they go through the rate limiter
+    async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=async_http_client, max_retries=0)
+except Exception as e:
+    print(f"Error initializing async OpenAI client: {e}")
+    async_openai_client = None
+
+# Identical concurrent requests share one upstream call
+llm_flight = AsyncSingleFlight("llm")
+embedding_flight = SingleFlight("embeddings")
+
+# Embeddings come from OpenAI or a local model, cached and batched (see embedding_backends)
+embedding_backend = get_embedding_backend(openai_client)
+
+
+def embedding_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters of the embedding cache"""
+    cache = get_embedding_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+
+def embedding_backend_stats() -> Dict[str, Any]:
+    """Which embedding backend is in use, with its batching counters"""
+    if embedding_backend is None:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_backend.stats()}
+
+
+_llm_loop = None
+_llm_loop_thread = None
+_llm_loop_lock = threading.Lock()
+
+
+def get_llm_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop that owns the async OpenAI client"""
+    global _llm_loop, _llm_loop_thread
+    with _llm_loop_lock:
+        if _llm_loop is None:
+            _llm_loop = asyncio.new_event_loop()
+            _llm_loop_thread = threading.Thread(
+                target=_llm_loop.run_forever,
+                name="storyforge-llm-loop",
+                daemon=True
+            )
+            _llm_loop_thread.start()
+        return _llm_loop
+
+
+def run_on_llm_loop(coro):
+    """Run a coroutine on the StoryForge event loop and block until it finishes"""
+    loop = get_llm_loop()
+    if threading.current_thread() is _llm_loop_thread:
+        coro.close()
+        raise RuntimeError("Blocking call made from the StoryForge event loop; await the async method instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
 ## 1. LLM Initialization with robust error handling
-class StoryForgeLLM:
-    def __init__(self):
+class AsyncStoryForgeLLM:
+    """asyncio StoryForge client.
+
+    Completions run on a single shared event loop with a pooled HTTP client.
+    A semaphore caps the number of in-flight requests; instances created
+    without ``max_concurrency`` share the process-wide limit. Responses are
+    served from the content-addressed cache, and identical concurrent
+    requests are coalesced into one call, unless ``use_cache=False``.
+    """
+
+    _shared_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    def __init__(self, max_concurrency: Optional[int] = None, response_cache: Optional[LLMResponseCache] = None):
         # System prompt template
         self.system_prompt = """You are StoryForge AI, an advanced story generation assistant. 
         You specialize in creating rich, coherent narratives with well-developed characters, 
         compelling plots, and immersive worlds. Follow the instructions carefully and 
         generate high-quality story content."""
+        if max_concurrency:
+            self.semaphore = asyncio.Semaphore(max_concurrency)
+        else:
+            self.semaphore = AsyncStoryForgeLLM._shared_semaphore
+        self.response_cache = response_cache if response_cache is not None else get_llm_cache()
+
+    async def agenerate(self, prompt: str, model: str = "gpt-4o", temperature: float = 0.7,
+                        max_tokens: Optional[int] = None, use_cache: bool = True,
+                        stage: Optional[str] = None, stage_units: int = 1) -> str:
+        """Generate text using the LLM with the given prompt without blocking the caller's thread
+
+        When ``max_tokens`` is omitted it is taken from the token budget of
+        ``stage`` (see token_budget.STAGE_BUDGETS), scaled by ``stage_units``
+        for stages that produce several items in one call.
+        """
+        loop = get_llm_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        coro = self._agenerate(prompt, model, temperature, max_tokens, use_cache, stage, stage_units)
+        if running is not loop:
+            # The pooled client is bound to the StoryForge loop, so hop onto it
+            future = asyncio.run_coroutine_threadsafe(coro, loop)
+            return await asyncio.wrap_future(future)
+        return await coro
+
+    async def _agenerate(self, prompt: str, model: str, temperature: float, max_tokens: Optional[int],
+                         use_cache: bool, stage: Optional[str], stage_units: int) -> str:
+        # Budgeted calls are cached on the stage rather than on the tuned number,
+        # so budget adjustments don't invalidate earlier responses
+        budget_key = max_tokens if max_tokens is not None else f"stage:{stage}:{stage_units}"
+        if max_tokens is None:
+            max_tokens = get_token_budgeter().budget(stage, stage_units)
+
+        if not use_cache:
+            return await self._complete(prompt, model, temperature, max_tokens, stage, stage_units)
+
+        cache_key = make_cache_key(self.system_prompt, prompt, model, temperature, budget_key)
+        if self.response_cache is not None:
+            cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached is not None:
+                return cached
+
+        return await llm_flight.do(
+            cache_key,
+            lambda: self._complete(prompt, model, temperature, max_tokens, stage, stage_units, cache_key)
+        )
 
-    def generate(self, prompt: str, model: str = "gpt-4o", temperature: float = 0.7, max_tokens: int = 8000) -> str:
-        """Generate text using the LLM with the given prompt"""
-        if not openai_client:
+    def _reservation(self, prompt: str, model: str, max_tokens: int) -> int:
+        """Tokens to reserve from the chat rate limiter for one request"""
+        return count_tokens(self.system_prompt, model) + count_tokens(prompt, model) + max_tokens
+
+    async def _complete(self, prompt: str, model: str, temperature: float, max_tokens: int,
+                        stage: Optional[str] = None, stage_units: int = 1,
+                        cache_key: Optional[str] = None) -> str:
+        if not async_openai_client:
             print("OpenAI client not initialized properly.")
             return "Error: OpenAI client not initialized"
         
-        # Retry mechanism for API calls
+        # Retry mechanism for API calls; every attempt reserves its estimated
+        # cost from the shared chat rate limiter first
         max_retries = 3
-        retry_delay = 2  # seconds
+        limiter = get_rate_limiter("chat")
+        reserved = self._reservation(prompt, model, max_tokens)
         
         for attempt in range(max_retries):
             try:
-                response = openai_client.chat.completions.create(
+                await limiter.aacquire(reserved)
+                async with self.semaphore:
+                    response = await async_openai_client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": self.system_prompt},
+                            {"role": "user", "content": prompt}
+                        ],
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=0.9
+                    )
+                usage = getattr(response, "usage", None)
+                await asyncio.to_thread(limiter.settle, reserved, getattr(usage, "total_tokens", None))
+                finish_reason = response.choices[0].finish_reason
+                # The budgeter persists its state to disk, so keep it off the event loop
+                await asyncio.to_thread(
+                    get_token_budgeter().observe,
+                    stage, getattr(usage, "completion_tokens", None), stage_units, finish_reason
+                )
+                content = response.choices[0].message.content.strip()
+                # A truncated response would keep being served after the budget is raised
+                if cache_key is not None and self.response_cache is not None and finish_reason != "length":
+                    await asyncio.to_thread(self.response_cache.set, cache_key, content)
+                return content
+            except Exception as e:
+                print(f"Attempt {attempt+1}/{max_retries} - Error in LLM generation: {e}")
+                if attempt < max_retries - 1 and is_retryable_error(e):
+                    retry_after = retry_after_seconds(e)
+                    if is_rate_limit_error(e):
+                        # Hold back every waiting request, not just this one
+                        await asyncio.to_thread(
+                            limiter.penalize, retry_after if retry_after is not None else backoff_delay(attempt)
+                        )
+                    retry_delay = backoff_delay(attempt, retry_after)
+                    print(f"Retrying in {retry_delay:.1f} seconds...")
+                    await asyncio.sleep(retry_delay)
+                else:
+                    print("All retries failed." if is_retryable_error(e) else "Not retrying.")
+                    return f"Error generating content: {str(e)}"
+
+    def generate(self, prompt: str, model: str = "gpt-4o", temperature: float = 0.7,
+                 max_tokens: Optional[int] = None, use_cache: bool = True,
+                 stage: Optional[str] = None, stage_units: int = 1) -> str:
+        """Generate text using the LLM with the given prompt"""
+        return run_on_llm_loop(
+            self.agenerate(prompt, model, temperature, max_tokens, use_cache, stage, stage_units)
+        )
+
+    async def astream(self, prompt: str, model: str = "gpt-4o", temperature: float = 0.7,
+                      max_tokens: Optional[int] = None, stage: Optional[str] = None):
+        """Yield completion text as it is produced. Must run on the StoryForge event loop."""
+        if not async_openai_client:
+            raise RuntimeError("OpenAI client not initialized")
+
+        if max_tokens is None:
+            max_tokens = get_token_budgeter().budget(stage)
+        limiter = get_rate_limiter("chat")
+        reserved = self._reservation(prompt, model, max_tokens)
+        await limiter.aacquire(reserved)
+        # Refund the unused part of the reservation however the stream ends;
+        # the final chunk carries the real usage, a failed request spent nothing
+        used = 0
+        try:
+            async with self.semaphore:
+                stream = await async_openai_client.chat.completions.create(
                     model=model,
                     messages=[
                         {"role": "system", "content": self.system_prompt},
@@ -62,131 +291,783 @@ class StoryForgeLLM:
                     ],
                     max_tokens=max_tokens,
                     temperature=temperature,
-                    top_p=0.9
+                    top_p=0.9,
+                    stream=True,
+                    stream_options={"include_usage": True}
                 )
-                return response.choices[0].message.content.strip()
+                used = None
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None)
+                    if usage is not None:
+                        used = getattr(usage, "total_tokens", None)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            await asyncio.to_thread(limiter.settle, reserved, used)
+
+    def stream(self, prompt: str, model: str = "gpt-4o", temperature: float = 0.7,
+               max_tokens: Optional[int] = None, stage: Optional[str] = None):
+        """Blocking generator over ``astream`` for use from Flask threads"""
+        chunks = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for piece in self.astream(prompt, model, temperature, max_tokens, stage):
+                    chunks.put(piece)
             except Exception as e:
-                print(f"Attempt {attempt+1}/{max_retries} - Error in LLM generation: {e}")
-                if attempt < max_retries - 1:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    print("All retries failed.")
-                    return f"Error generating content: {str(e)}"
+                chunks.put(e)
+            finally:
+                chunks.put(finished)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), get_llm_loop())
+        try:
+            while True:
+                item = chunks.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stop the upstream request if the consumer goes away early
+            future.cancel()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the response cache"""
+        if self.response_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.response_cache.stats()}
+
+
+class StoryForgeLLM(AsyncStoryForgeLLM):
+    """Blocking StoryForge client used by the pipeline and the Flask routes.
+
+    ``generate`` is a thin wrapper over ``agenerate``, so every pipeline
+    function accepts either class.
+    """
+
+
+RETRIEVE_CHUNK_OVERFETCH = 4  # Chunks fetched per requested memory, since several may share a parent
+MAX_METADATA_CHARS = 200
+RETRIEVAL_MODE = os.getenv("STORYFORGE_RETRIEVAL_MODE", "hybrid")  # hybrid, vector or lexical
+PARENT_CONTENT_CACHE_SIZE = 512  # Full memory contents kept per story, so retrieve rarely needs MongoDB
+RETRIEVAL_CACHE_SIZE = int(os.getenv("STORYFORGE_RETRIEVAL_CACHE_SIZE", "256"))  # Per story; 0 disables
+RETRIEVAL_MMR = os.getenv("STORYFORGE_RETRIEVAL_MMR", "0") == "1"
+MMR_LAMBDA = float(os.getenv("STORYFORGE_MMR_LAMBDA", "0.5"))  # 1 is pure relevance, 0 pure diversity
+# A NumPy index is rewritten whole when saved, so writes only save it once its oldest unsaved row is this old
+VECTOR_INDEX_SAVE_SECONDS = float(os.getenv("STORYFORGE_VECTOR_INDEX_SAVE_SECONDS", "30"))
+
+
+def filterable_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """The small scalar fields of ``metadata``, as stored next to each vector"""
+    return {
+        k: v if isinstance(v, (int, float, bool)) else str(v)
+        for k, v in metadata.items()
+        if isinstance(v, (str, int, float, bool)) and len(str(v)) <= MAX_METADATA_CHARS
+    }
+
+
+def mean_embedding(vectors: List[List[float]]) -> List[float]:
+    """Unit-length mean of ``vectors`` (the vector itself when there is one)"""
+    if len(vectors) <= 1:
+        return vectors[0] if vectors else []
+    mean = [sum(values) / len(vectors) for values in zip(*vectors)]
+    norm = sum(value * value for value in mean) ** 0.5 or 1.0
+    return [value / norm for value in mean]
+
+
+def story_namespace(story_id: str) -> str:
+    """Short name for a story that is safe in collection and directory names"""
+    slug = model_slug(story_id)
+    if not slug or len(slug) > 24:
+        slug = hashlib.sha256(story_id.encode("utf-8")).hexdigest()[:16]
+    return slug
 
 
 class StoryMemory:
-    def __init__(self):
-        self.use_openai_embeddings = True if openai_client else False
+    def __init__(self, story_id: str, embedder: Optional[EmbeddingBackend] = None,
+                 vector_index: str = VECTOR_INDEX_BACKEND, service: Optional[MemoryService] = None,
+                 write_behind: bool = MEMORY_WRITE_BEHIND):
+        """
+        Args:
+            story_id: Story whose memories this instance stores and retrieves.
+                Each story gets its own vector collection and its Mongo documents
+                are tagged with it, so retrieval never sees other stories.
+                Required: there is no shared, unscoped memory.
+            embedder: Embedding backend (defaults to the configured one)
+            vector_index: "chroma" for a persistent Chroma collection, or "numpy"
+                for the in-process index in vector_index.py
+            service: Where the MongoDB and Chroma clients come from (defaults to
+                the process-wide one, see get_story_memory)
+            write_behind: Have store() return immediately and write in batches
+                from a background thread (see memory_writer.py)
+        """
+        if not story_id:
+            raise ValueError("StoryMemory needs a story_id; memories are never shared between stories")
+        self.story_id = story_id
+        self.embedder = embedder or embedding_backend
+        self.vector_index = vector_index
+        self.service = service or get_memory_service()
+        self._collection = None
+        self._collection_lock = threading.Lock()
+        self._unsaved_since = None  # When the oldest vector not yet saved to disk was added
+        self._lexical = None
+        self._contents = OrderedDict()  # parent id -> full content, most recently used last
+        self._contents_lock = threading.Lock()
+        # Retrieval results per (query, options, version); bumping the version on every write invalidates them
+        self._version = 0
+        self._results = OrderedDict()
+        self._results_lock = threading.Lock()
+        self.retrieval_counters = {"cache_hits": 0, "cache_misses": 0}
+        # The Chroma client is shared by every StoryMemory; NumpyVectorIndex locks itself
+        self._vector_lock = self.service.chroma_lock if vector_index == "chroma" else nullcontext()
+        self._writer = WriteBehindQueue(self._write_batch) if write_behind else None
+
+    @property
+    def chroma_client(self):
+        return self.service.chroma_client() if self.vector_index == "chroma" else None
+
+    @property
+    def db(self):
+        return self.service.mongo_db()
+
+    @property
+    def memory_collection(self):
+        """MongoDB collection for memory documents, or None while MongoDB is unreachable"""
+        db = self.db
+        return db['memory'] if db is not None else None
+
+    def collection_name(self) -> str:
+        """Vector collection for this story and backend
         
-        # Initialize ChromaDB client
+        The OpenAI default keeps the original "story_memory" prefix; the story
+        namespace is appended after a double underscore.
+        """
+        if self.embedder is None or self.embedder.model_id == "text-embedding-3-small":
+            name = "story_memory"
+        else:
+            name = f"story_memory_{model_slug(self.embedder.model_id)}"
+        suffix = f"__{story_namespace(self.story_id)}"
+        return name[:63 - len(suffix)] + suffix  # Chroma names are at most 63 characters
+
+    def _lexical_path(self, archived: bool = False) -> str:
+        """Where this story's BM25 index is saved; unlike vectors it doesn't depend on the model"""
+        name = story_namespace(self.story_id)
+        return os.path.join(VECTOR_INDEX_DIR, "archive" if archived else "", "lexical", f"{name}.jsonl")
+
+    def _get_lexical(self) -> BM25Index:
+        """Open this story's BM25 index, building it from the vector index the first time"""
+        with self._collection_lock:
+            if self._lexical is None:
+                path = self._lexical_path()
+                lexical = BM25Index.open(path)
+                if not os.path.exists(path):
+                    # Memories stored before the lexical index existed
+                    existing = self._existing_records()
+                    if existing["ids"]:
+                        lexical.add(existing["ids"], existing["documents"], existing["metadatas"])
+                self._lexical = lexical
+            return self._lexical
+
+    def _existing_records(self) -> Dict[str, List[Any]]:
+        """Ids, documents and metadata already in the vector index, without opening it for writes"""
+        name = self.collection_name()
         try:
-            self.chroma_client = chromadb.PersistentClient(path=".chromadb")
-            self.collection = self.chroma_client.get_or_create_collection(
-                name="story_memory",
-                metadata={"hnsw:space": "cosine"}  # Keep cosine similarity
-            )
-        except Exception as e:
-            print(f"Error initializing ChromaDB: {e}")
-            self.chroma_client = None
-            self.collection = None
+            if self.vector_index == "numpy":
+                path = os.path.join(VECTOR_INDEX_DIR, name)
+                if os.path.exists(os.path.join(path, "index.json")):
+                    return NumpyVectorIndex.open(path, 0).get()
+            elif self.chroma_client is not None:
+                with self._vector_lock:
+                    return self.chroma_client.get_collection(name=name).get(include=["documents", "metadatas"])
+        except Exception:
+            pass  # Nothing stored yet
+        return {"ids": [], "documents": [], "metadatas": []}
+
+    def _remember_content(self, parent_id: str, content: str) -> None:
+        with self._contents_lock:
+            self._contents[parent_id] = content
+            self._contents.move_to_end(parent_id)
+            while len(self._contents) > PARENT_CONTENT_CACHE_SIZE:
+                self._contents.popitem(last=False)
+
+    def _get_collection(self, dimension: int):
+        """Open the vector collection, recording which model and vector size it holds
         
-        # Initialize MongoDB for document storage
-        try:
-            self.mongo_client = MongoClient('mongodb://localhost:27017/', serverSelectionTimeoutMS=5000)
-            if self.mongo_client is not None:
-                self.mongo_client.admin.command('ping')
-                self.db = self.mongo_client['storyforge']
-                self.memory_collection = self.db['memory']
-        except Exception as e:
-            print(f"Error initializing MongoDB: {e}")
+        Returns a Chroma collection or a NumpyVectorIndex, which take the same
+        add and query calls.
+        """
+        if self.embedder is None or not dimension:
+            return None
+        chroma_client = self.chroma_client
+        if self.vector_index == "chroma" and chroma_client is None:
+            return None
+        with self._collection_lock:
+            if self._collection is None:
+                name = self.collection_name()
+                model_id = self.embedder.model_id
+                metadata = {"embedding_model": model_id, "embedding_dim": dimension}
+                try:
+                    if self.vector_index == "numpy":
+                        collection = NumpyVectorIndex.open(os.path.join(VECTOR_INDEX_DIR, name), dimension,
+                                                           metadata=metadata)
+                    else:
+                        with self._vector_lock:
+                            collection = chroma_client.get_or_create_collection(
+                                name=name,
+                                metadata={"hnsw:space": "cosine", **metadata}  # Keep cosine similarity
+                            )
+                except Exception as e:
+                    print(f"Error opening {self.vector_index} collection {name}: {e}")
+                    return None
+                # Collections made before models were recorded only ever held the default model
+                recorded = collection.metadata or {}
+                if (recorded.get("embedding_model", model_id) != model_id
+                        or recorded.get("embedding_dim", dimension) != dimension):
+                    print(f"Vector collection {name} holds {recorded.get('embedding_model')} vectors "
+                          f"({recorded.get('embedding_dim')} dims), not {model_id} ({dimension} dims); not using it")
+                    return None
+                self._collection = collection
+            return self._collection
 
     def _get_embedding(self, text: str) -> List[float]:
-        """Get embedding using OpenAI's API"""
-        if not self.use_openai_embeddings or not openai_client:
+        """Get an embedding from the configured backend (OpenAI or local)"""
+        if self.embedder is None:
             return []
-            
+        
+        key = embedding_key(self.embedder.model_id, str(text))
         try:
-            response = openai_client.embeddings.create(
-                input=text,
-                model="text-embedding-3-small"
-            )
-            return response.data[0].embedding
+            return embedding_flight.do(key, lambda: self.embedder.embed(text))
         except Exception as e:
-            print(f"Error getting OpenAI embedding: {e}")
+            print(f"Error getting embedding: {e}")
             return []
 
+    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings of ``texts`` in one batch; an empty list for each if the backend failed"""
+        if self.embedder is None or not texts:
+            return [[] for _ in texts]
+        try:
+            return self.embedder.embed_many(texts)
+        except Exception as e:
+            print(f"Error getting embeddings: {e}")
+            return [[] for _ in texts]
+
+    def prefetch_embeddings(self, texts: List[str]) -> None:
+        """Start embedding the chunks of texts that are about to be stored, so they share a request"""
+        if self.embedder is not None:
+            self.embedder.prefetch([chunk for text in texts for chunk in chunk_text(text) or [text]])
+
     def store(self, content: str, metadata: dict = None) -> str:
-        """Store content in memory with optional metadata"""
+        """Store content in memory with optional metadata
+        
+        With write-behind on, the content is queued and its id returned at
+        once; the embedding and both writes happen in the background. The id
+        is final either way (it becomes the MongoDB _id). Content that isn't a
+        string (e.g. a perspective dict) is stored as JSON.
+        """
         if metadata is None:
             metadata = {}
-            
-        doc_id = str(datetime.now().timestamp())
-        embedding = self._get_embedding(content)
+        if not isinstance(content, str):
+            content = json.dumps(content, default=str)
+        
+        item = {
+            "id": str(ObjectId()),
+            "content": content,
+            "metadata": metadata,
+            "timestamp": datetime.utcnow()
+        }
+        self._remember_content(item["id"], content)
+        if self._writer is None:
+            self._write_batch([item])
+        else:
+            self._writer.submit(item)  # Its chunks are embedded with the rest of its batch
+        return item["id"]
+
+    def _write_batch(self, items: List[Dict[str, Any]]) -> None:
+        try:
+            self._write_items(items)
+        finally:
+            self._bump_version()
+
+    def _bump_version(self) -> None:
+        with self._results_lock:
+            self._version += 1
+            self._results.clear()
+
+    def _write_items(self, items: List[Dict[str, Any]]) -> None:
+        """Embed items and write them to MongoDB and the vector index, one call each
+        
+        Each item is split into chunks (see text_chunker) and every chunk gets
+        its own vector, with the item's id as ``parent_id``. The MongoDB
+        document keeps the full content and the mean of its chunk vectors.
+        
+        An item that can't be prepared is reported and skipped; the rest of
+        the batch is still written.
+        """
+        prepared, chunks = [], []
+        for item in items:
+            try:
+                chunks.append(chunk_text(item["content"]) or [item["content"]])
+                prepared.append(item)
+            except Exception as e:
+                print(f"Error preparing memory {item['id']}, not storing it: {e}")
+        items = prepared
+        vectors = iter(self._get_embeddings([chunk for item_chunks in chunks for chunk in item_chunks]))
+        embeddings = [[next(vectors) for _ in item_chunks] for item_chunks in chunks]
         
         # MongoDB Storage
-        if self.memory_collection is not None:
+        memory_collection = self.memory_collection
+        if memory_collection is not None:
+            docs = []
+            for item, item_embeddings in zip(items, embeddings):
+                try:
+                    docs.append({
+                        "_id": ObjectId(item["id"]),
+                        "story_id": self.story_id,
+                        "content": item["content"],
+                        **encode_embedding(mean_embedding([e for e in item_embeddings if e])),
+                        "embedding_model": self.embedder.model_id if self.embedder else None,
+                        "chunks": len(item_embeddings),
+                        "metadata": item["metadata"],
+                        "timestamp": item["timestamp"]
+                    })
+                except Exception as e:
+                    print(f"Error preparing MongoDB document for memory {item['id']}: {e}")
             try:
-                doc = {
-                    "content": content,
-                    "embedding": embedding,
-                    "metadata": metadata,
-                    "timestamp": datetime.utcnow()
-                }
-                result = self.memory_collection.insert_one(doc)
-                doc_id = str(result.inserted_id)
+                if docs:
+                    memory_collection.insert_many(docs, ordered=False)
             except Exception as e:
                 print(f"Error storing in MongoDB: {e}")
 
-        # ChromaDB Storage
-        if self.collection is not None and embedding:  # Only store if we have an embedding
+        records = []  # (id, chunk, metadata, embedding) for every chunk
+        for item, item_chunks, item_embeddings in zip(items, chunks, embeddings):
+            metadata = filterable_metadata(item["metadata"])
+            for i, (chunk, embedding) in enumerate(zip(item_chunks, item_embeddings)):
+                chunk_metadata = {**metadata, "parent_id": item["id"], "chunk": i, "chunks": len(item_chunks)}
+                records.append((f"{item['id']}:{i}", chunk, chunk_metadata, embedding))
+        
+        # Lexical index, including chunks whose embedding failed
+        try:
+            lexical = self._get_lexical()
+            lexical.add([r[0] for r in records], [r[1] for r in records], [r[2] for r in records])
+        except Exception as e:
+            print(f"Error updating lexical index: {e}")
+        
+        # ChromaDB Storage, only for chunks that got an embedding
+        records = [record for record in records if record[3]]
+        if not records:
+            return
+        collection = self._get_collection(len(records[0][3]))
+        if collection is not None:
             try:
-                # Prepare metadata for ChromaDB (only simple types)
-                chroma_metadata = {
-                    k: str(v) for k, v in metadata.items() 
-                    if isinstance(v, (str, int, float, bool))
-                }
-                
-                # Ensure we have at least some metadata
-                if not chroma_metadata:
-                    chroma_metadata = {"timestamp": datetime.now().isoformat()}
-                
-                self.collection.add(
-                    ids=[doc_id],
-                    embeddings=[embedding],
-                    documents=[content],
-                    metadatas=[chroma_metadata]
-                )
+                with self._vector_lock:
+                    collection.add(
+                        ids=[r[0] for r in records],
+                        embeddings=[r[3] for r in records],
+                        documents=[r[1] for r in records],
+                        metadatas=[r[2] for r in records]
+                    )
+                if isinstance(collection, NumpyVectorIndex):
+                    self._vectors_added()
             except Exception as e:
-                print(f"Error storing in ChromaDB: {e}")
+                print(f"Error storing in {self.vector_index}: {e}")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait for queued stores to be written; False if ``timeout`` ran out first"""
+        return self._writer.flush(timeout) if self._writer is not None else True
+
+    def pending(self) -> int:
+        """Stores queued but not yet written"""
+        return self._writer.pending() if self._writer is not None else 0
+
+    def _vectors_added(self) -> None:
+        """Note unsaved NumPy rows, saving them if the oldest has waited VECTOR_INDEX_SAVE_SECONDS"""
+        now = time.monotonic()
+        with self._collection_lock:
+            if self._unsaved_since is None:
+                self._unsaved_since = now
+            due = now - self._unsaved_since >= VECTOR_INDEX_SAVE_SECONDS
+        if due:
+            self.persist()
+
+    def persist(self) -> None:
+        """Save the NumPy vector index if it has rows that are not on disk yet
         
-        return doc_id
-
-    def retrieve(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
-        """Retrieve relevant memories using OpenAI embeddings"""
-        if not self.collection or not self.use_openai_embeddings:
-            print("Retrieval services not available")
-            return []
+        Called at the end of a pipeline run and when the process exits; the
+        Chroma backend persists on every write by itself.
+        """
+        with self._collection_lock:
+            collection = self._collection
+            if self._unsaved_since is None or not isinstance(collection, NumpyVectorIndex):
+                return
+            self._unsaved_since = None
+        collection.save()
+
+    def retrieve(self, query: str, k: int = 3, where: Optional[Dict[str, Any]] = None,
+                 mode: str = RETRIEVAL_MODE, mmr: bool = RETRIEVAL_MMR,
+                 mmr_lambda: float = MMR_LAMBDA) -> List[Dict[str, Any]]:
+        """Retrieve the ``k`` most relevant memories
+        
+        Args:
+            query: What to look for
+            k: Number of memories to return
+            where: Chroma-style metadata filter, e.g. {"type": "scene"} or
+                {"$and": [{"type": "scene"}, {"episode": {"$in": [...]}}]}
+            mode: "vector" (embedding similarity), "lexical" (BM25, no
+                embedding call) or "hybrid" (both, fused by reciprocal rank).
+                Hybrid falls back to lexical when embeddings are unavailable.
+            mmr: Re-rank the candidates by maximal marginal relevance, so
+                near-duplicates (a perspective and its flash cards, overlapping
+                chunks) don't fill the top k
+            mmr_lambda: Relevance/diversity trade-off for mmr
+        
+        Chunks are ranked and then grouped by the memory they came from; each
+        memory appears once, at its best chunk, with its full content and the
+        text of that chunk as ``match``. ``score`` is the cosine similarity,
+        the BM25 score or the fused score, depending on what was used.
         
+        Results are cached until the next write to this story's memory.
+        """
+        # Read your own writes: anything stored before this call is searched
+        self.flush()
+        with self._results_lock:
+            version = self._version
+            key = (query, k, json.dumps(where, sort_keys=True, default=str), mode, mmr, mmr_lambda if mmr else None)
+            cached = self._results.get(key)
+            if cached is not None:
+                self._results.move_to_end(key)
+                self.retrieval_counters["cache_hits"] += 1
+                return [dict(memory, metadata=dict(memory["metadata"])) for memory in cached]
+            self.retrieval_counters["cache_misses"] += 1
+        
+        memories = self._retrieve(query, k, where, mode, mmr, mmr_lambda)
+        if RETRIEVAL_CACHE_SIZE > 0 and memories:
+            with self._results_lock:
+                if version == self._version:  # Nothing was written while we searched
+                    self._results[key] = [dict(memory, metadata=dict(memory["metadata"])) for memory in memories]
+                    while len(self._results) > RETRIEVAL_CACHE_SIZE:
+                        self._results.popitem(last=False)
+        return memories
+
+    def _retrieve(self, query: str, k: int, where: Optional[Dict[str, Any]], mode: str,
+                  mmr: bool, mmr_lambda: float) -> List[Dict[str, Any]]:
         try:
-            query_embedding = self._get_embedding(query)
-            if not query_embedding:
+            n_results = k * RETRIEVE_CHUNK_OVERFETCH
+            chunks = {}  # chunk id -> (document, metadata)
+            vectors = {} if mmr else None  # chunk id -> embedding, for MMR
+            rankings = []  # (ranking, scores) per retriever
+            
+            if mode in ("vector", "hybrid") and self.embedder is not None:
+                ranking, scores = self._vector_search(query, n_results, where, chunks, vectors)
+                if ranking is not None:
+                    rankings.append((ranking, scores))
+            if mode in ("lexical", "hybrid"):
+                results = self._get_lexical().query(query, n_results, where)
+                for chunk_id, document, metadata in zip(results["ids"], results["documents"], results["metadatas"]):
+                    chunks.setdefault(chunk_id, (document, metadata))
+                rankings.append((results["ids"], dict(zip(results["ids"], results["scores"]))))
+            if not rankings:
+                print("Retrieval services not available")
                 return []
-                
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=k
-            )
             
-            return [{
-                "content": results['documents'][0][i],
-                "metadata": results['metadatas'][0][i],
-                "score": 1 - results['distances'][0][i]  # Convert cosine distance to similarity
-            } for i in range(len(results['ids'][0]))]
+            scores = rankings[0][1] if len(rankings) == 1 else reciprocal_rank_fusion([r for r, _ in rankings])
+            
+            # Best chunk per parent, in score order; MMR picks from a wider pool
+            best = {}
+            pool = n_results if mmr else k
+            for chunk_id in sorted(scores, key=scores.get, reverse=True):
+                document, metadata = chunks[chunk_id]
+                metadata = dict(metadata or {})
+                parent_id = metadata.pop("parent_id", chunk_id)  # Entries stored before chunking have no parent
+                metadata.pop("chunk", None)
+                metadata.pop("chunks", None)
+                if parent_id not in best:
+                    best[parent_id] = {
+                        "id": parent_id,
+                        "content": document,
+                        "match": document,
+                        "metadata": metadata,
+                        "score": scores[chunk_id],
+                        "_chunk": chunk_id
+                    }
+                if len(best) == pool:
+                    break
+            
+            memories = list(best.values())
+            if mmr and len(memories) > k:
+                # Cosine similarities are already on the right scale; BM25 and fused scores are not
+                memories = self._mmr(memories, vectors, k, mmr_lambda, normalize=mode != "vector")
+            memories = memories[:k]
+            for memory in memories:
+                del memory["_chunk"]
+            for memory, content in zip(memories, self._parent_contents([m["id"] for m in memories])):
+                if content is not None:
+                    memory["content"] = content
+            return memories
         except Exception as e:
             print(f"Error during retrieval: {e}")
             return []
+
+    def _mmr(self, memories: List[Dict[str, Any]], vectors: Dict[str, List[float]], k: int,
+             mmr_lambda: float, normalize: bool) -> List[Dict[str, Any]]:
+        """The ``k`` memories picked by maximal marginal relevance
+        
+        Similarity is the cosine of the vectors the search returned. If any
+        match came without one (lexical matches), token overlap of the
+        matched chunks is used instead, so MMR never costs an embedding call.
+        """
+        embeddings = [vectors.get(memory["_chunk"]) for memory in memories]
+        similarity = None
+        if not all(embeddings):
+            similarity = token_jaccard([memory["match"] for memory in memories])
+        top = max(memory["score"] for memory in memories) if normalize else 1.0
+        relevance = [memory["score"] / (top or 1.0) for memory in memories]  # Onto the 0-1 scale of cosine similarity
+        return [memories[i] for i in mmr_select(embeddings, relevance, k, mmr_lambda, similarity)]
+
+    def _vector_search(self, query: str, n_results: int, where: Optional[Dict[str, Any]],
+                       chunks: Dict[str, Any], vectors: Optional[Dict[str, List[float]]] = None):
+        """Chunk ids by embedding similarity and their similarities, or (None, None) if unavailable
+        
+        Fills ``chunks`` with each match's document and metadata, and
+        ``vectors`` (if given) with its embedding.
+        """
+        if self.vector_index == "chroma" and self.chroma_client is None:
+            return None, None
+        query_embedding = self._get_embedding(query)
+        collection = self._get_collection(len(query_embedding))
+        if not query_embedding or collection is None:
+            return None, None
+        
+        with self._vector_lock:
+            n_results = min(n_results, collection.count())
+            if n_results == 0:
+                return [], {}
+            query_args = {"where": where} if where else {}  # Chroma rejects an empty filter
+            if vectors is not None:
+                query_args["include"] = ["documents", "metadatas", "distances", "embeddings"]
+            results = collection.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results,
+                **query_args
+            )
+        
+        ranking, scores = [], {}
+        for chunk_id, document, metadata, distance in zip(
+                results['ids'][0], results['documents'][0], results['metadatas'][0], results['distances'][0]):
+            chunks.setdefault(chunk_id, (document, metadata))
+            ranking.append(chunk_id)
+            scores[chunk_id] = 1 - distance  # Convert cosine distance to similarity
+        if vectors is not None:
+            for chunk_id, embedding in zip(results['ids'][0], results['embeddings'][0]):
+                vectors[chunk_id] = list(embedding)
+        return ranking, scores
+
+    def _parent_contents(self, parent_ids: List[str]) -> List[Optional[str]]:
+        """Full content of each memory, from the local cache or MongoDB (None where unavailable)"""
+        with self._contents_lock:
+            contents = {pid: self._contents[pid] for pid in parent_ids if pid in self._contents}
+        missing = [ObjectId(pid) for pid in parent_ids if pid not in contents and ObjectId.is_valid(pid)]
+        memory_collection = self.memory_collection if missing else None
+        if memory_collection is not None:
+            try:
+                for doc in memory_collection.find({"_id": {"$in": missing}}, {"content": 1}):
+                    if doc.get("content") is not None:
+                        contents[str(doc["_id"])] = doc["content"]
+                        self._remember_content(str(doc["_id"]), doc["content"])
+            except Exception as e:
+                print(f"Error loading memories from MongoDB: {e}")
+        return [contents.get(pid) for pid in parent_ids]
+
+    def _remove_vectors(self, archive_path: Optional[str] = None) -> int:
+        """Delete this story's vector collection, first copying it to ``archive_path`` if given
+        
+        Archived vectors are kept as a NumpyVectorIndex whatever the backend;
+        the lexical index goes along with them. Returns the number of vectors
+        removed.
+        """
+        name = self.collection_name()
+        with self._collection_lock:
+            self._collection = None
+            self._lexical = None
+            self._bump_version()
+            with self._contents_lock:
+                self._contents.clear()
+            lexical_path = self._lexical_path()
+            if os.path.exists(lexical_path):
+                if archive_path:
+                    archived_path = self._lexical_path(archived=True)
+                    os.makedirs(os.path.dirname(archived_path), exist_ok=True)
+                    os.replace(lexical_path, archived_path)
+                else:
+                    os.remove(lexical_path)
+            
+            if self.vector_index == "numpy":
+                path = os.path.join(VECTOR_INDEX_DIR, name)
+                if not os.path.exists(path):
+                    return 0
+                count = NumpyVectorIndex.open(path, 0).count()
+                if archive_path:
+                    shutil.rmtree(archive_path, ignore_errors=True)
+                    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+                    shutil.move(path, archive_path)
+                else:
+                    shutil.rmtree(path)
+                return count
+            
+            chroma_client = self.chroma_client
+            if chroma_client is None:
+                return 0
+            with self._vector_lock:
+                try:
+                    collection = chroma_client.get_collection(name=name)
+                except Exception:
+                    return 0  # Nothing was ever stored for this story
+                count = collection.count()
+                if archive_path and count:
+                    records = collection.get(include=["embeddings", "documents", "metadatas"])
+                    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+                    archive = NumpyVectorIndex(len(records["embeddings"][0]), "float32", archive_path, metadata)
+                    archive.add(records["ids"], records["embeddings"], records["documents"], records["metadatas"])
+                    archive.save()
+                chroma_client.delete_collection(name=name)
+            return count
+
+    def drop(self) -> Dict[str, int]:
+        """Delete every memory of this story, in both the vector index and MongoDB"""
+        self.flush()
+        dropped = {"vectors": 0, "documents": 0}
+        try:
+            dropped["vectors"] = self._remove_vectors()
+        except Exception as e:
+            print(f"Error dropping vectors for story {self.story_id}: {e}")
+        memory_collection = self.memory_collection
+        if memory_collection is not None:
+            try:
+                dropped["documents"] = memory_collection.delete_many({"story_id": self.story_id}).deleted_count
+            except Exception as e:
+                print(f"Error dropping MongoDB memories for story {self.story_id}: {e}")
+        return dropped
+
+    def archive(self) -> Dict[str, int]:
+        """Move this story's memories out of the live indexes
+        
+        Vectors go to ``<VECTOR_INDEX_DIR>/archive/<collection>`` and MongoDB
+        documents to the ``memory_archive`` collection, so retrieval for other
+        stories no longer pays for them but nothing is lost.
+        """
+        self.flush()
+        self.persist()  # The archive is moved from disk
+        archived = {"vectors": 0, "documents": 0}
+        try:
+            archive_path = os.path.join(VECTOR_INDEX_DIR, "archive", self.collection_name())
+            archived["vectors"] = self._remove_vectors(archive_path)
+        except Exception as e:
+            print(f"Error archiving vectors for story {self.story_id}: {e}")
+        memory_collection = self.memory_collection
+        if memory_collection is not None:
+            try:
+                docs = list(memory_collection.find({"story_id": self.story_id}))
+                if docs:
+                    self.db['memory_archive'].insert_many(docs)
+                    memory_collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+                archived["documents"] = len(docs)
+            except Exception as e:
+                print(f"Error archiving MongoDB memories for story {self.story_id}: {e}")
+        return archived
+
+
+STORY_MEMORY_CACHE_SIZE = int(os.getenv("STORYFORGE_STORY_MEMORY_CACHE_SIZE", "32"))
+
+_story_memories = OrderedDict()  # story_id -> StoryMemory, least recently used first
+_story_memory_holds = {}  # story_id -> pipeline runs using that story's memory
+_story_memories_lock = threading.Lock()
+
+
+def _evict_idle_memories() -> None:
+    """Drop least recently used instances beyond the cache size (caller holds the lock)
+    
+    Instances held by a run or with stores still queued are skipped, so the
+    cache may stay over its size until they are done; dropping them would let
+    a second instance for the same story open the index alongside them.
+    """
+    for story_id in list(_story_memories):
+        if len(_story_memories) <= STORY_MEMORY_CACHE_SIZE:
+            return
+        memory = _story_memories[story_id]
+        if _story_memory_holds.get(story_id) or memory.pending():
+            continue
+        memory.persist()
+        del _story_memories[story_id]
+
+
+def get_story_memory(story_id: str) -> StoryMemory:
+    """Shared StoryMemory for a story, built on the process-wide memory service
+    
+    Reusing the instance keeps its vector collection open between runs and
+    requests; for the NumPy backend it also means one in-memory index per
+    story rather than several copies overwriting each other's saves.
+    """
+    if not story_id:
+        raise ValueError("get_story_memory needs a story_id")
+    with _story_memories_lock:
+        memory = _story_memories.get(story_id)
+        if memory is None:
+            memory = StoryMemory(story_id)
+            _story_memories[story_id] = memory
+        _story_memories.move_to_end(story_id)
+        _evict_idle_memories()
+        return memory
+
+
+def hold_story_memory(story_id: str) -> StoryMemory:
+    """get_story_memory, keeping the instance cached until release_story_memory"""
+    memory = get_story_memory(story_id)
+    with _story_memories_lock:
+        _story_memory_holds[story_id] = _story_memory_holds.get(story_id, 0) + 1
+    return memory
+
+
+def release_story_memory(story_id: str) -> None:
+    with _story_memories_lock:
+        holds = _story_memory_holds.pop(story_id, 0) - 1
+        if holds > 0:
+            _story_memory_holds[story_id] = holds
+        _evict_idle_memories()
+
+
+def story_memory_stats() -> Dict[str, Any]:
+    """Retrieval cache counters summed over the shared StoryMemory instances"""
+    with _story_memories_lock:
+        memories = list(_story_memories.values())
+    stats = {"stories": len(memories), "cache_hits": 0, "cache_misses": 0}
+    for memory in memories:
+        for key, value in memory.retrieval_counters.items():
+            stats[key] += value
+    lookups = stats["cache_hits"] + stats["cache_misses"]
+    stats["hit_rate"] = stats["cache_hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def persist_memories() -> None:
+    """Write out and save every shared StoryMemory (registered with atexit)"""
+    with _story_memories_lock:
+        memories = list(_story_memories.values())
+    for memory in memories:
+        if not memory.flush(timeout=30):
+            print(f"Memory writes for story {memory.story_id} are still pending")
+        memory.persist()
+
+
+atexit.register(persist_memories)
+
+
+def close_memory() -> None:
+    """Forget the shared StoryMemory instances and close the database clients"""
+    persist_memories()
+    with _story_memories_lock:
+        _story_memories.clear()
+    get_memory_service().close()
         
 # ## 3. Query Processing Module with improved error handling
 # def process_user_query(llm: StoryForgeLLM, query: str) -> List[str]:
@@ -366,7 +1247,7 @@ Format each of the 4 perspectives clearly with this exact structure and only out
 ]
 """
 
-    response = llm.generate(prompt)
+    response = llm.generate(prompt, stage="perspectives")
     if response.startswith("Error:"):
         print(f"Failed to generate perspectives: {response}")
         return get_fallback_perspectives(query)
@@ -421,7 +1302,8 @@ def get_fallback_perspectives(query: str) -> List[dict]:
     ]
 
 
-def generate_flash_cards(llm: StoryForgeLLM, memory: StoryMemory, perspective: str) -> Dict[str, Any]:
+def generate_flash_cards(llm: StoryForgeLLM, memory: StoryMemory,
+                         perspective: Union[str, Dict[str, Any]]) -> Dict[str, Any]:
     """Generate flash cards for a given perspective with robust error handling"""
     prompt = f"""Create detailed flash cards for the following story perspective:
 
@@ -448,7 +1330,7 @@ def generate_flash_cards(llm: StoryForgeLLM, memory: StoryMemory, perspective: s
     }}
     """
 
-    response = llm.generate(prompt, temperature=0.3)
+    response = llm.generate(prompt, temperature=0.3, stage="flash_cards")
     if response.startswith("Error:"):
         print(f"Failed to generate flash cards: {response}")
         # Provide default flash cards as fallback
@@ -476,15 +1358,18 @@ def generate_flash_cards(llm: StoryForgeLLM, memory: StoryMemory, perspective: s
             "timestamp": datetime.now().isoformat()
         }
         
-        memory_id = memory.store(perspective, metadata)
+        # The pipeline passes the perspective dict from process_user_query
+        perspective_text = perspective if isinstance(perspective, str) else json.dumps(perspective)
+        flash_cards_text = json.dumps(flash_cards)
+        memory.prefetch_embeddings([perspective_text, flash_cards_text])
+        memory_id = memory.store(perspective_text, metadata)
         
         # Store flash cards separately
         flash_card_metadata = {
             "type": "flash_cards",
-            "related_to": memory_id,
-            "perspective": perspective
+            "related_to": memory_id
         }
-        memory.store(json.dumps(flash_cards), flash_card_metadata)
+        memory.store(flash_cards_text, flash_card_metadata)
         
         return flash_cards
     except Exception as e:
@@ -537,7 +1422,8 @@ def default_flash_cards(perspective: str) -> Dict[str, List[str]]:
     }
 
 ## 5. Story Bible Generator with improved parsing
-def generate_story_bible(llm: StoryForgeLLM, perspective: dict, parameters: dict, importance: dict, original_query: str = '') -> dict:
+def generate_story_bible(llm: StoryForgeLLM, perspective: dict, parameters: dict, importance: dict, original_query: str = '',
+                         use_cache: bool = True) -> dict:
     """Generate a comprehensive story bible based on the perspective and user parameters
     
     Args:
@@ -546,6 +1432,7 @@ def generate_story_bible(llm: StoryForgeLLM, perspective: dict, parameters: dict
         parameters: User-specified parameters for the story
         importance: Importance weights for different story elements
         original_query: The original user query that started the story
+        use_cache: Whether an identical earlier completion may be reused
         
     Returns:
         A detailed story bible as a dictionary
@@ -654,7 +1541,7 @@ Format your response EXACTLY as a valid JSON object that strictly follows the st
 """
 
     # Generate the story bible
-    response = llm.generate(prompt, temperature=0.7, max_tokens=4000)
+    response = llm.generate(prompt, temperature=0.7, use_cache=use_cache, stage="story_bible")
     
     if response.startswith("Error:"):
         print(f"Failed to generate story bible: {response}")
@@ -806,17 +1693,38 @@ def get_default_story_bible(perspective, parameters):
     }
 
 ## 6. Episode Breakdown with improved parsing
-def generate_episode_outlines(llm: StoryForgeLLM, memory: StoryMemory, story_bible: Dict[str, Any], num_episodes: int = 3) -> List[Dict[str, Any]]:
+def episode_memory_text(number: int, episode: Dict[str, Any]) -> str:
+    """Episode outline as prose for StoryMemory, so its vectors cover the whole outline"""
+    lines = [f"Episode {number}: {episode.get('title', 'Untitled')}."]
+    if episode.get("objective"):
+        lines.append(f"Objective: {episode['objective']}")
+    if episode.get("character_focus"):
+        lines.append(f"Characters: {', '.join(str(c) for c in episode['character_focus'])}.")
+    for event in episode.get("key_events", []):
+        lines.append(f"Key event: {event}")
+    if episode.get("connection_to_arc"):
+        lines.append(f"Connection to the arc: {episode['connection_to_arc']}")
+    return "\n".join(lines)
+
+def generate_episode_outlines(llm: StoryForgeLLM, memory: StoryMemory, story_bible: Dict[str, Any], num_episodes: int = 3,
+                              model: str = DEFAULT_OUTLINE_MODEL) -> List[Dict[str, Any]]:
     """Break the story into episodes with robust error handling"""
     # Validate story_bible
-    if not story_bible or "synopsis" not in story_bible:
+    synopsis = story_bible.get("premise") or story_bible.get("synopsis") if story_bible else None
+    if not synopsis:
         print("Invalid story bible for episode generation")
         return default_episodes(num_episodes)
     
     # Simplify story bible if it's too complex (to prevent token limits)
+    plot = story_bible.get("plot") if isinstance(story_bible.get("plot"), dict) else {}
     simplified_bible = {
-        "synopsis": story_bible.get("synopsis", ""),
-        "narrative_arc": story_bible.get("narrative_arc", {"beginning": "", "middle": "", "end": ""}),
+        "synopsis": synopsis,
+        "narrative_arc": story_bible.get("narrative_arc") or {
+            "beginning": plot.get("act1", ""),
+            "middle": plot.get("act2", ""),
+            "end": plot.get("act3", "")
+        },
+        "key_events": plot.get("keyEvents", [])[:7],
         "characters": story_bible.get("characters", [])[:3],  # Limit to 3 characters
         "conflicts": story_bible.get("conflicts", [])[:3]     # Limit to 3 conflicts
     }
@@ -840,7 +1748,7 @@ def generate_episode_outlines(llm: StoryForgeLLM, memory: StoryMemory, story_bib
     - "connection_to_arc"
     """
 
-    response = llm.generate(prompt, max_tokens=4000)
+    response = llm.generate(prompt, model=model, stage="episode_outlines", stage_units=num_episodes)
     if response.startswith("Error:"):
         print(f"Failed to generate episodes: {response}")
         return default_episodes(num_episodes)
@@ -857,6 +1765,7 @@ def generate_episode_outlines(llm: StoryForgeLLM, memory: StoryMemory, story_bib
         
         # Validate each episode
         valid_episodes = []
+        memories = []
         for i, episode in enumerate(episodes):
             if not isinstance(episode, dict):
                 continue
@@ -876,12 +1785,15 @@ def generate_episode_outlines(llm: StoryForgeLLM, memory: StoryMemory, story_bib
                     episode[key] = [episode[key]]
             
             valid_episodes.append(episode)
-            
-            # Store each episode in memory
-            memory.store(
-                f"Episode {i+1}: {episode.get('title', 'Untitled')}",
-                {"type": "episode", "content": json.dumps(episode)}
-            )
+            memories.append((
+                episode_memory_text(i + 1, episode),
+                {"type": "episode", "episode": i + 1, "title": str(episode.get('title', 'Untitled'))}
+            ))
+        
+        # Store each episode in memory, embedding them all in one request
+        memory.prefetch_embeddings([content for content, _ in memories])
+        for content, metadata in memories:
+            memory.store(content, metadata)
         
         # If we lost episodes in validation, create defaults to make up the difference
         while len(valid_episodes) < num_episodes:
@@ -928,7 +1840,8 @@ def default_episodes(num_episodes: int) -> List[Dict[str, Any]]:
     return episodes
 
 ## 7. Scene Generation with improved parsing
-def generate_scene_outline(llm: StoryForgeLLM, episode: Dict[str, Any], scene_number: int) -> Dict[str, Any]:
+def generate_scene_outline(llm: StoryForgeLLM, episode: Dict[str, Any], scene_number: int,
+                           model: str = DEFAULT_OUTLINE_MODEL) -> Dict[str, Any]:
     """Generate outline for a single scene with robust error handling"""
     # Validate episode
     if not episode or not isinstance(episode, dict):
@@ -962,7 +1875,7 @@ def generate_scene_outline(llm: StoryForgeLLM, episode: Dict[str, Any], scene_nu
     - "key_beats" (array of beat descriptions)
     """
 
-    response = llm.generate(prompt)
+    response = llm.generate(prompt, model=model, stage="scene_outline")
     if response.startswith("Error:"):
         print(f"Failed to generate scene outline: {response}")
         return default_scene_outline(scene_number)
@@ -971,27 +1884,108 @@ def generate_scene_outline(llm: StoryForgeLLM, episode: Dict[str, Any], scene_nu
     json_str = clean_json_string(response)
     
     try:
-        scene_outline = json.loads(json_str)
-        
-        # Validate structure
-        required_keys = ["setting", "characters", "purpose", "tone", "key_beats"]
-        for key in required_keys:
-            if key not in scene_outline:
-                if key in ["characters", "key_beats"]:
-                    scene_outline[key] = []
-                else:
-                    scene_outline[key] = f"Default {key} for scene {scene_number}"
-        
-        # Ensure lists are lists
-        for key in ["characters", "key_beats"]:
-            if not isinstance(scene_outline[key], list):
-                scene_outline[key] = [scene_outline[key]]
-                
+        scene_outline = repair_scene_outline(json.loads(json_str), scene_number)
+        if scene_outline is None:
+            raise ValueError("Scene outline should be a JSON object")
         return scene_outline
     except Exception as e:
         print(f"Error parsing scene outline: {e}\nOriginal response: {response}")
         return default_scene_outline(scene_number)
 
+def repair_scene_outline(scene_outline: Any, scene_number: int) -> Optional[Dict[str, Any]]:
+    """Fill in missing keys of a parsed scene outline; None if it isn't an outline at all"""
+    if not isinstance(scene_outline, dict):
+        return None
+    
+    # Validate structure
+    required_keys = ["setting", "characters", "purpose", "tone", "key_beats"]
+    for key in required_keys:
+        if key not in scene_outline:
+            if key in ["characters", "key_beats"]:
+                scene_outline[key] = []
+            else:
+                scene_outline[key] = f"Default {key} for scene {scene_number}"
+    
+    # Ensure lists are lists
+    for key in ["characters", "key_beats"]:
+        if not isinstance(scene_outline[key], list):
+            scene_outline[key] = [scene_outline[key]]
+            
+    return scene_outline
+
+def clean_json_array_string(json_str: str) -> str:
+    """Clean and prepare a string holding a JSON array for parsing"""
+    json_str = re.sub(r'```json|```', '', json_str).strip()
+    
+    start_idx = json_str.find('[')
+    end_idx = json_str.rfind(']') + 1
+    if start_idx >= 0 and end_idx > start_idx:
+        json_str = json_str[start_idx:end_idx]
+    
+    return json_str
+
+def generate_scene_outlines_batch(llm: StoryForgeLLM, episode: Dict[str, Any], num_scenes: int = 3,
+                                  model: str = DEFAULT_OUTLINE_MODEL) -> List[Dict[str, Any]]:
+    """Outline every scene of an episode in a single completion
+    
+    The model returns all outlines as one JSON array. Each entry is validated
+    and repaired like a single-scene outline; only entries that are missing or
+    unusable are regenerated with generate_scene_outline.
+    """
+    if not episode or not isinstance(episode, dict):
+        print("Invalid episode for scene generation")
+        return [default_scene_outline(i+1) for i in range(num_scenes)]
+    
+    title = episode.get('title', 'Untitled')
+    objective = episode.get('objective', '')
+    key_events = episode.get('key_events', [])
+    key_events_str = ', '.join(key_events) if isinstance(key_events, list) else str(key_events)
+    
+    prompt = f"""Create detailed outlines for all {num_scenes} scenes of the following episode, in order:
+
+    Episode Title: {title}
+    Objective: {objective}
+    Key Events: {key_events_str}
+
+    Together the scenes should cover the key events, each one building on the scene before it.
+    Each scene outline should include:
+    1. Setting (where and when the scene takes place)
+    2. Characters Present (who is in the scene)
+    3. Purpose (what this scene accomplishes)
+    4. Emotional Tone (the mood of the scene)
+    5. Key Beats (3-5 important moments in the scene)
+
+    Format the output as a JSON array of exactly {num_scenes} objects, one per scene in order, with these keys:
+    - "setting"
+    - "characters" (array of character names)
+    - "purpose"
+    - "tone"
+    - "key_beats" (array of beat descriptions)
+    """
+    
+    entries = []
+    response = llm.generate(prompt, model=model, stage="scene_outline", stage_units=num_scenes)
+    if response.startswith("Error:"):
+        print(f"Failed to generate scene outlines: {response}")
+    else:
+        try:
+            entries = json.loads(clean_json_array_string(response))
+            if not isinstance(entries, list):
+                raise ValueError("Scene outlines should be a list")
+        except Exception as e:
+            print(f"Error parsing scene outlines: {e}\nOriginal response: {response}")
+            entries = []
+    
+    outlines = []
+    for i in range(num_scenes):
+        outline = repair_scene_outline(entries[i], i+1) if i < len(entries) else None
+        if outline is None:
+            print(f"Scene {i+1} missing from batched outlines, outlining it separately")
+            outline = generate_scene_outline(llm, episode, i+1, model)
+        outlines.append(outline)
+    
+    return outlines
+
 def default_scene_outline(scene_number: int) -> Dict[str, Any]:
     """Generate a default scene outline when parsing fails"""
     return {
@@ -1006,8 +2000,15 @@ def default_scene_outline(scene_number: int) -> Dict[str, Any]:
         ]
     }
 
-def generate_full_scene(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[str, Any], scene_outline: Dict[str, Any]) -> str:
-    """Generate the full narrative text for a scene with robust error handling"""
+def generate_full_scene(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[str, Any], scene_outline: Dict[str, Any],
+                        episode_outlines: Optional[List[Dict[str, Any]]] = None, scene_number: Optional[int] = None,
+                        target_words: int = SCENE_TARGET_WORDS) -> str:
+    """Generate the full narrative text for a scene with robust error handling
+    
+    When ``episode_outlines`` (the outlines of every scene in the episode) and
+    ``scene_number`` are given, the other outlines are included in the prompt
+    so scenes written concurrently still line up with each other.
+    """
     # Validate inputs
     if not episode or not isinstance(episode, dict) or not scene_outline or not isinstance(scene_outline, dict):
         print("Invalid inputs for scene generation")
@@ -1027,10 +2028,21 @@ def generate_full_scene(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[s
     - Emotional depth
     - Smooth transitions between beats
 
-    The scene should be approximately 500 words.
+    The scene should be approximately {target_words} words.
+    """
+    if episode_outlines and scene_number:
+        prompt += f"""
+    For continuity, this is scene {scene_number} of {len(episode_outlines)}. The scenes around it are:
+    {format_scene_context(episode_outlines, scene_number)}
+    Pick up where the previous scene leaves off and set up the next one, without retelling them.
     """
 
-    scene = llm.generate(prompt, max_tokens=2000)
+    if target_words == SCENE_TARGET_WORDS:
+        scene = llm.generate(prompt, stage="scene")
+    else:
+        # Scale the tuned budget instead of teaching it the shorter length
+        max_tokens = get_token_budgeter().budget("scene") * target_words // SCENE_TARGET_WORDS
+        scene = llm.generate(prompt, max_tokens=max_tokens)
     if scene.startswith("Error:"):
         print(f"Failed to generate scene: {scene}")
         return "The scene unfolds with characters navigating their circumstances, moving the story forward."
@@ -1038,12 +2050,12 @@ def generate_full_scene(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[s
     # Store scene in memory
     try:
         memory.store(
-            f"Scene from {title}",
+            scene,
             {
                 "type": "scene", 
                 "episode": title, 
-                "outline": json.dumps(scene_outline), 
-                "content": scene
+                "scene": scene_number or 0,
+                "scene_title": str(scene_outline.get("title", ""))
             }
         )
     except Exception as e:
@@ -1051,17 +2063,49 @@ def generate_full_scene(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[s
 
     return scene
 
-def generate_all_scenes(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[str, Any], num_scenes: int = 3) -> List[Dict[str, Any]]:
-    """Generate all scenes for an episode with robust error handling"""
+def format_scene_context(outlines: List[Dict[str, Any]], scene_number: int) -> str:
+    """Summarize the other scene outlines of an episode for a scene prompt"""
+    lines = []
+    for i, outline in enumerate(outlines, start=1):
+        if i == scene_number or not isinstance(outline, dict):
+            continue
+        beats = outline.get('key_beats', [])
+        beats_str = '; '.join(str(b) for b in beats) if isinstance(beats, list) else str(beats)
+        lines.append(f"- Scene {i} ({outline.get('setting', '')}): {outline.get('purpose', '')} Beats: {beats_str}")
+    return '\n    '.join(lines)
+
+SCENE_MAX_CONCURRENCY = int(os.getenv("STORYFORGE_SCENE_CONCURRENCY", "3"))
+
+def generate_all_scenes(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[str, Any], num_scenes: int = 3,
+                        parallel: bool = False, max_concurrency: int = SCENE_MAX_CONCURRENCY,
+                        on_scene: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+                        outline_model: str = DEFAULT_OUTLINE_MODEL,
+                        scene_words: int = SCENE_TARGET_WORDS) -> List[Dict[str, Any]]:
+    """Generate all scenes for an episode with robust error handling
+    
+    By default each scene is outlined and then written before moving on to the
+    next. With ``parallel=True`` every scene is outlined first, in a single
+    batched call (generate_scene_outlines_batch), and the prose for all
+    scenes is then written concurrently (at most ``max_concurrency`` at a
+    time), with the shared outlines providing continuity.
+    
+    ``on_scene(index, scene)`` is called as soon as each scene is written,
+    which in parallel mode may be out of order. ``outline_model`` and
+    ``scene_words`` let a deadline-bound run trade quality for speed.
+    """
     if not episode or not isinstance(episode, dict):
         print("Invalid episode for scene generation")
         return [{"outline": default_scene_outline(i+1), "content": "Default scene content."} for i in range(num_scenes)]
     
+    if parallel:
+        return generate_all_scenes_parallel(llm, memory, episode, num_scenes, max_concurrency, on_scene,
+                                            outline_model, scene_words)
+    
     scenes = []
     for i in range(num_scenes):
         try:
-            outline = generate_scene_outline(llm, episode, i+1)
-            full_scene = generate_full_scene(llm, memory, episode, outline)
+            outline = generate_scene_outline(llm, episode, i+1, outline_model)
+            full_scene = generate_full_scene(llm, memory, episode, outline, target_words=scene_words)
             scenes.append({
                 "outline": outline,
                 "content": full_scene
@@ -1072,75 +2116,46 @@ def generate_all_scenes(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[s
                 "outline": default_scene_outline(i+1),
                 "content": "An unexpected error occurred in scene generation."
             })
+        if on_scene is not None:
+            on_scene(i, scenes[-1])
     
     return scenes
 
-def compile_story(episodes_with_scenes: List[Dict[str, Any]]) -> str:
-    """Compile all episodes and scenes into a complete story with error handling"""
-    if not episodes_with_scenes:
-        return "No story content available."
-    
-    story = "# COMPLETE STORY\n\n"
-    
+def generate_all_scenes_parallel(llm: StoryForgeLLM, memory: StoryMemory, episode: Dict[str, Any], num_scenes: int = 3,
+                                 max_concurrency: int = SCENE_MAX_CONCURRENCY,
+                                 on_scene: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+                                 outline_model: str = DEFAULT_OUTLINE_MODEL,
+                                 scene_words: int = SCENE_TARGET_WORDS) -> List[Dict[str, Any]]:
+    """Outline every scene of an episode in one call, then write all of the scenes concurrently"""
     try:
-        for i, episode_data in enumerate(episodes_with_scenes):
-            # Skip invalid episode data
-            if not isinstance(episode_data, dict):
-                continue
-                
-            episode = episode_data.get("episode", {})
-            scenes = episode_data.get("scenes", [])
-            
-            if not isinstance(episode, dict) or not isinstance(scenes, list):
-                continue
-            
-            # Episode title
-            title = episode.get('title', f'Episode {i+1}')
-            story += f"\n\nEPISODE {i+1}: {title}\n"
-            story += f"{'=' * 50}\n\n"
-            
-            # Episode objective
-            objective = episode.get('objective', '')
-            if objective:
-                story += f"Objective: {objective}\n\n"
-            
-            # Scenes
-            for j, scene in enumerate(scenes):
-                if not isinstance(scene, dict):
-                    continue
-                    
-                outline = scene.get('outline', {})
-                content = scene.get('content', '')
-                
-                story += f"\nScene {j+1}\n"
-                story += f"{'-' * 30}\n"
-                
-                # Scene details from outline
-                if isinstance(outline, dict):
-                    setting = outline.get('setting', '')
-                    characters = outline.get('characters', [])
-                    tone = outline.get('tone', '')
-                    
-                    if setting:
-                        story += f"Setting: {setting}\n"
-                    if characters:
-                        story += f"Characters: {', '.join(characters)}\n"
-                    if tone:
-                        story += f"Tone: {tone}\n"
-                
-                story += "\n"
-                
-                # Scene content
-                if content:
-                    story += content + "\n"
-                else:
-                    story += "[Scene content missing]\n"
-    
+        outlines = generate_scene_outlines_batch(llm, episode, num_scenes, outline_model)
     except Exception as e:
-        print(f"Error compiling story: {e}")
-        story += "\n\n[Error occurred during story compilation. Partial content shown.]"
+        print(f"Error outlining scenes: {e}")
+        outlines = [default_scene_outline(i+1) for i in range(num_scenes)]
+    
+    def write_scene(i):
+        try:
+            content = generate_full_scene(llm, memory, episode, outlines[i], outlines, i+1, scene_words)
+        except Exception as e:
+            print(f"Error generating scene {i+1}: {e}")
+            content = "An unexpected error occurred in scene generation."
+        scene = {"outline": outlines[i], "content": content}
+        if on_scene is not None:
+            on_scene(i, scene)
+        return scene
     
-    return story
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="storyforge-scene") as pool:
+        return list(pool.map(write_scene, range(num_scenes)))
+
+def compile_story(episodes_with_scenes: List[Dict[str, Any]]) -> str:
+    """Compile all episodes and scenes into a complete story with error handling
+    
+    Builds the plain-text story in memory. Callers that don't need a string
+    should use story_writer.write_story to stream it to a file or response.
+    """
+    story = StringIO()
+    write_story(episodes_with_scenes, text=story)
+    return story.getvalue()
 
 ## 9. Image Generation Module
 def generate_story_image(prompt: str, size: str = "1024x1024", model: str = "dall-e-3") -> str:
@@ -1150,13 +2165,13 @@ def generate_story_image(prompt: str, size: str = "1024x1024", model: str = "dal
         return ""
     
     try:
-        response = openai_client.images.generate(
+        response = call_with_retries("images", lambda: openai_client.images.generate(
             model=model,
             prompt=f"A high-quality illustration for a story: {prompt}",
             size=size,
             quality="hd",
             n=1
-        )
+        ))
         return response.data[0].url
     except Exception as e:
         print(f"Error generating image: {e}")
@@ -1164,120 +2179,520 @@ def generate_story_image(prompt: str, size: str = "1024x1024", model: str = "dal
 
 
 ## 10. Main Pipeline with comprehensive error handling
-def storyforge_pipeline(user_query: str) -> Dict[str, Any]:
-    """Complete StoryForge pipeline from query to finished story with robust error handling"""
+PIPELINE_MAX_WORKERS = int(os.getenv("STORYFORGE_PIPELINE_WORKERS", "6"))
+
+SCENE_FALLBACK_CONTENT = {
+    "The scene unfolds with characters navigating their circumstances, moving the story forward.",
+    "An unexpected error occurred in scene generation.",
+    "Default scene content.",
+    "Scene generation failed"
+}
+
+
+def new_stage_report() -> Dict[str, List[str]]:
+    """Which stages were reused from earlier runs and which were computed"""
+    return {"reused": [], "recomputed": []}
+
+
+def memoized_stage(stage: str, inputs: Dict[str, Any], compute, report: Optional[Dict[str, List[str]]] = None,
+                   label: Optional[str] = None, is_valid=None, max_age: Optional[float] = None,
+                   refresh: bool = False, recompute=None) -> Any:
+    """Return the output of ``stage`` for ``inputs``, computing it only if these inputs are new
+    
+    Args:
+        stage: Stage kind the memo is keyed under (e.g. "story_bible")
+        inputs: Everything the stage's output depends on
+        compute: Zero-argument function producing the output
+        report: Optional stage report to record "reused"/"recomputed" in
+        label: Name to record in the report (defaults to ``stage``)
+        is_valid: Optional predicate; outputs failing it (e.g. fallbacks after an
+            API error) are returned but not memoized
+        max_age: Only reuse outputs memoized less than this many seconds ago
+        refresh: Always recompute (the new output replaces the memoized one)
+        recompute: Used instead of ``compute`` when replacing a refreshed or
+            expired output, e.g. to skip the LLM response cache that would
+            hand back the same completion
+    """
+    label = label or stage
+    memo = get_stage_memo()
+    replacing = refresh
+    if memo is not None and not refresh:
+        found, value = memo.lookup(stage, inputs, max_age)
+        if found:
+            if report is not None:
+                report["reused"].append(label)
+            return value
+        replacing = max_age is not None and memo.lookup(stage, inputs)[0]  # Expired rather than new
+    
+    value = recompute() if replacing and recompute is not None else compute()
+    if report is not None:
+        report["recomputed"].append(label)
+    if memo is not None and (is_valid is None or is_valid(value)):
+        memo.save(stage, inputs, value)
+    return value
+
+
+
+def iter_storyforge_pipeline(user_query: str, parameters: dict = None, importance: dict = None,
+                             num_episodes: int = 3, num_scenes: int = 3,
+                             max_workers: int = PIPELINE_MAX_WORKERS, parallel_scenes: bool = True,
+                             scene_concurrency: int = SCENE_MAX_CONCURRENCY, run_id: Optional[str] = None,
+                             resume: bool = False, checkpoint_store: Optional[CheckpointStore] = None,
+                             episodes: Optional[List[Dict[str, Any]]] = None,
+                             deadline_s: Optional[float] = None,
+                             story_path: Optional[str] = None,
+                             story_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Run the StoryForge pipeline, yielding each result as soon as it is ready
+
+    The stages form a dependency graph and independent stages run in
+    parallel (up to ``max_workers`` at a time):
+
+        perspectives -> flash_cards:<i>  (one per perspective)
+        perspectives -> story_bible -> episodes -> scenes:<i> (one per episode) -> full_story
+        cover_image                      (independent of all text)
+        full_story + flash_cards -> consistency_check
+
+    With ``parallel_scenes`` the scenes inside each episode are also written
+    concurrently (see generate_all_scenes).
+
+    Every stage's output is checkpointed under ``run_id`` (by default derived
+    from the inputs; while another run in this process holds that id, a
+    unique variant of it, reported in "done"). With ``resume=True`` stages already checkpointed for the
+    same inputs are restored instead of regenerated, so a run that failed part
+    way only pays for what is missing.
+
+    Independently of run ids, each stage is memoized on a hash of its actual
+    inputs, so a run that changes one input only recomputes the stages
+    downstream of it: changing ``num_episodes`` reuses the story bible, and
+    passing edited ``episodes`` (instead of generating outlines) reuses the
+    scenes of every episode that wasn't edited.
+
+    With ``deadline_s`` the run is planned to finish within that many seconds,
+    using per-stage latencies learned from earlier runs (see stage_latency).
+    If the full run wouldn't fit, it is degraded step by step: a faster model
+    for outlines, shorter scenes, fewer scenes per episode, no cover image.
+    The plan is made again, with the time actually left, before any scenes
+    are written.
+
+    With ``story_path`` the compiled story is streamed to ``<story_path>.txt``
+    and ``<story_path>.md`` instead of being built in memory, and a
+    "story_files" event with both paths takes the place of "full_story".
+
+    Memories are stored under ``story_id`` (by default derived from the query,
+    parameters and importance, so runs of the same story that only change
+    counts or settings share one memory) and retrieval only searches them.
+
+    Yields dicts with a "type" key, in the order the pieces finish:
+
+        {"type": "perspectives", "perspectives": [...]}
+        {"type": "flash_cards", "index": i, "flash_cards": {...}}
+        {"type": "story_bible", "story_bible": {...}}
+        {"type": "episode_outline", "index": i, "episode": {...}}
+        {"type": "scene", "episode_index": i, "scene_index": j, "scene": {"outline": ..., "content": ...}}
+        {"type": "full_story", "full_story": "..."}  (or "story_files": {"text": path, "markdown": path})
+        {"type": "cover_image", "cover_image_url": "..."}
+        {"type": "consistency_check", "consistency_check": [...]}
+        {"type": "done", "run_id": ..., "story_id": ..., "success": ..., "error": ..., "timings": {...},
+         "restored_stages": [...], "stages": {"reused": [...], "recomputed": [...]},
+         "degradations": {...}, "deadline": {...} or None}
+
+    "degradations" maps each setting a deadline changed (num_scenes,
+    scene_words, outline_model, cover_image) to the value used.
+
+    "done" is always last, including when a stage fails. Closing the
+    generator early stops the pipeline from starting any further stages.
+    """
     print("Starting StoryForge pipeline...")
     
     # Initialize components
     llm = StoryForgeLLM()
-    memory = StoryMemory()
-    
-    result = {
-        "success": False,
-        "error": None,
-        "perspectives": [],
-        "flash_cards": [],
-        "story_bible": {},
-        "episodes": [],
-        "full_story": "",
-        "cover_image_url": "",
-        "consistency_check": []
-    }
+    parameters = parameters or {}
+    importance = importance or {}
+    story_id = story_id or input_hash({
+        "query": user_query, "parameters": parameters, "importance": importance
+    })[:16]
+    memory = hold_story_memory(story_id)  # Released when the run finishes
     
+    claimed = None
     try:
+        inputs_digest = input_hash({
+            "query": user_query, "parameters": parameters, "importance": importance,
+            "num_episodes": num_episodes, "num_scenes": num_scenes
+        })
+        run_id = claimed = claim_run(run_id or inputs_digest[:16])  # Released when the run finishes
+        checkpoints = checkpoint_store if checkpoint_store is not None else get_checkpoint_store()
+        if checkpoints is not None:
+            resume = checkpoints.begin(run_id, inputs_digest, resume)
+        else:
+            resume = False
+        
+        report = new_stage_report()
+        
+        # Plan against the deadline before anything runs
+        started = time.monotonic()
+        latency = get_stage_latency_model()
+        measured = {}  # stage -> (latency key, units) for stages that actually ran
+        requested = {
+            "num_scenes": num_scenes,
+            "scene_words": SCENE_TARGET_WORDS,
+            "outline_model": DEFAULT_OUTLINE_MODEL,
+            "cover_image": True
+        }
+        settings = dict(requested)
+        
+        def plan(done=()):
+            remaining = deadline_s - (time.monotonic() - started)
+            planned, estimate = plan_for_deadline(
+                latency, remaining, settings, len(episodes) if episodes is not None else num_episodes,
+                max_workers, parallel_scenes, scene_concurrency, done
+            )
+            settings.update(planned)
+            changes = applied_degradations(requested, settings)
+            print(f"Deadline plan: {estimate:.0f}s estimated for {remaining:.0f}s left"
+                  + (f", degraded {changes}" if changes else ""))
+        
+        if deadline_s is not None:
+            plan()
+        
+        events = queue.Queue()
+        streamed_scenes = set()  # (episode index, scene index) already yielded
+        streamed_lock = threading.Lock()
+        
+        def emit_scene(episode_index, scene_index, scene):
+            with streamed_lock:
+                if (episode_index, scene_index) in streamed_scenes:
+                    return
+                streamed_scenes.add((episode_index, scene_index))
+            events.put({"type": "scene", "episode_index": episode_index, "scene_index": scene_index, "scene": scene})
+        
+        def on_stage_done(name, value):
+            kind, _, index = name.partition(":")
+            if name == "perspectives":
+                events.put({"type": "perspectives", "perspectives": value})
+            elif kind == "flash_cards" and index:
+                events.put({"type": "flash_cards", "index": int(index), "flash_cards": value})
+            elif name == "story_bible":
+                events.put({"type": "story_bible", "story_bible": value})
+            elif name == "episodes":
+                for i, episode in enumerate(value):
+                    events.put({"type": "episode_outline", "index": i, "episode": episode})
+            elif kind == "scenes":
+                # Restored or memoized scenes never went through on_scene
+                for j, scene in enumerate(value["scenes"]):
+                    emit_scene(int(index), j, scene)
+            elif name == "full_story":
+                if story_path is not None:
+                    events.put({"type": "story_files", "story_files": value})
+                else:
+                    events.put({"type": "full_story", "full_story": value})
+            elif name == "cover_image":
+                events.put({"type": "cover_image", "cover_image_url": value})
+            elif name == "consistency_check":
+                events.put({"type": "consistency_check", "consistency_check": value})
+        
+        dag = DAGExecutor(max_workers=max_workers, on_stage_done=on_stage_done,
+                          checkpoints=checkpoints, run_id=run_id, resume=resume)
+        
         # 1. Process user query
-        print("\n1. Generating perspectives...")
-        perspectives = process_user_query(llm, user_query)
-        result["perspectives"] = perspectives
-
-        print(f"Generated {len(perspectives)} perspectives:")
-        for i, p in enumerate(perspectives, start=1):
-            print(f"\nPerspective {i}:")
-            print(f"  Type   : {p['type']}")
-            print(f"  Icon   : {p['icon']}")
-            print(f"  Title  : {p['title']}")
-            print(f"  Preview: {p['preview']}")
-
-        # 2. Generate flash cards for each perspective
-        print("\n2. Creating flash cards...")
-        flash_cards_list = []
-        for perspective in perspectives:
+        def perspectives_stage(results):
+            print("\n1. Generating perspectives...")
+            perspectives = memoized_stage(
+                "perspectives", {"query": user_query},
+                lambda: process_user_query(llm, user_query), report,
+                is_valid=lambda value: value != get_fallback_perspectives(user_query)
+            )
+        
+            print(f"Generated {len(perspectives)} perspectives:")
+            for i, p in enumerate(perspectives, start=1):
+                print(f"\nPerspective {i}:")
+                print(f"  Type   : {p['type']}")
+                print(f"  Icon   : {p['icon']}")
+                print(f"  Title  : {p['title']}")
+                print(f"  Preview: {p['preview']}")
+            return perspectives
+        
+        # 2. Generate flash cards for each perspective, all at once
+        def expand_perspectives(perspectives):
+            print("\n2. Creating flash cards...")
+            for i, perspective in enumerate(perspectives):
+                dag.add(f"flash_cards:{i}", lambda results, i=i, perspective=perspective: memoized_stage(
+                    "flash_cards", {"perspective": perspective},
+                    lambda: flash_cards_stage(perspective), report, label=f"flash_cards:{i}",
+                    is_valid=lambda value: value != default_flash_cards(perspective)
+                ), deps=["perspectives"])
+            dag.add("flash_cards", lambda results: [results[f"flash_cards:{i}"] for i in range(len(perspectives))],
+                    deps=[f"flash_cards:{i}" for i in range(len(perspectives))])
+        
+        def flash_cards_stage(perspective):
             try:
-                flash_cards = generate_flash_cards(llm, memory, perspective)
-                flash_cards_list.append(flash_cards)
+                return generate_flash_cards(llm, memory, perspective)
             except Exception as e:
-                print(f"Error generating flash cards for perspective '{perspective[:50]}...': {e}")
-                flash_cards_list.append(default_flash_cards(perspective))
-        result["flash_cards"] = flash_cards_list
-        print(flash_cards_list)
-        exit()
-        # 3. Generate story bible
-        print("\n3. Creating Story Bible...")
-        story_bible = generate_story_bible(llm, memory, flash_cards_list, user_query)
-        result["story_bible"] = story_bible
-        print("Story Bible created with:")
-        print(f"- Synopsis: {story_bible.get('synopsis', '')[:100]}...")
-        print(f"- {len(story_bible.get('characters', []))} characters")
-        print(f"- {len(story_bible.get('settings', []))} settings")
+                print(f"Error generating flash cards for perspective '{str(perspective)[:50]}...': {e}")
+                return default_flash_cards(perspective)
+        
+        # 3. Generate story bible from the first perspective
+        def story_bible_stage(results):
+            print("\n3. Creating Story Bible...")
+            perspective = results["perspectives"][0] if results["perspectives"] else {}
+            story_bible = memoized_stage(
+                "story_bible",
+                {"perspective": perspective, "parameters": parameters, "importance": importance, "query": user_query},
+                lambda: generate_story_bible(llm, perspective, parameters, importance, user_query), report,
+                is_valid=lambda value: value != get_default_story_bible(perspective, parameters)
+            )
+            print("Story Bible created with:")
+            print(f"- Synopsis: {(story_bible.get('premise') or story_bible.get('synopsis', ''))[:100]}...")
+            print(f"- {len(story_bible.get('characters', []))} characters")
+            print(f"- {len(story_bible.get('settings', []))} settings")
+            return story_bible
         
         # 4. Break into episodes
-        print("\n4. Breaking story into episodes...")
-        episodes = generate_episode_outlines(llm, memory, story_bible)
-        result["episodes"] = episodes
-        print(f"Generated {len(episodes)} episodes:")
-        for ep in episodes:
-            print(f"- {ep.get('title', 'Untitled')}")
-        
-        # 5. Generate scenes for each episode
-        print("\n5. Generating scenes for each episode...")
-        episodes_with_scenes = []
-        for episode in episodes:
+        def episodes_stage(results):
+            if episodes is not None:
+                print("\n4. Using the provided episode outlines...")
+                return episodes
+            print("\n4. Breaking story into episodes...")
+            model = settings["outline_model"]
+            
+            def compute():
+                measured["episodes"] = (latency_key("episodes", model), num_episodes)
+                return generate_episode_outlines(llm, memory, results["story_bible"], num_episodes, model)
+            
+            outlines = memoized_stage(
+                "episodes", {"story_bible": results["story_bible"], "num_episodes": num_episodes, "model": model},
+                compute, report,
+                is_valid=lambda value: value != default_episodes(num_episodes)
+            )
+            print(f"Generated {len(outlines)} episodes:")
+            for ep in outlines:
+                print(f"- {ep.get('title', 'Untitled')}")
+            return outlines
+        
+        # 5. Generate scenes for every episode in parallel
+        def expand_episodes(episodes):
+            print("\n5. Generating scenes for each episode...")
+            if deadline_s is not None:
+                # Scenes are most of the work, so re-plan with the time actually left. Stages
+                # already started are committed: the plan can no longer drop them.
+                started = dag.started_stages()
+                plan(["perspectives", "story_bible", "episodes"] +
+                     [name for name in ("flash_cards", "cover_image") if name in started])
+            scene_settings = dict(settings)
+            for i, episode in enumerate(episodes):
+                dag.add(f"scenes:{i}", lambda results, i=i, episode=episode: memoized_stage(
+                    "scenes",
+                    {"episode": episode, "num_scenes": scene_settings["num_scenes"], "parallel": parallel_scenes,
+                     "outline_model": scene_settings["outline_model"], "scene_words": scene_settings["scene_words"]},
+                    lambda: scenes_stage(i, episode, scene_settings), report, label=f"scenes:{i}",
+                    is_valid=lambda value: not any(
+                        scene.get("content") in SCENE_FALLBACK_CONTENT for scene in value["scenes"]
+                    )
+                ), deps=["episodes"])
+            dag.add("full_story", lambda results: compile_stage([results[f"scenes:{i}"] for i in range(len(episodes))]),
+                    deps=[f"scenes:{i}" for i in range(len(episodes))])
+        
+        def scenes_stage(index, episode, scene_settings):
+            measured[f"scenes:{index}"] = (
+                latency_key("scenes", scene_settings["outline_model"]),
+                scene_units(scene_settings["num_scenes"], scene_settings["scene_words"], parallel_scenes, scene_concurrency)
+            )
             try:
-                scenes = generate_all_scenes(llm, memory, episode)
-                episodes_with_scenes.append({
-                    "episode": episode,
-                    "scenes": scenes
-                })
+                scenes = generate_all_scenes(llm, memory, episode, scene_settings["num_scenes"],
+                                             parallel=parallel_scenes, max_concurrency=scene_concurrency,
+                                             on_scene=lambda j, scene: emit_scene(index, j, scene),
+                                             outline_model=scene_settings["outline_model"],
+                                             scene_words=scene_settings["scene_words"])
                 print(f"- Generated {len(scenes)} scenes for {episode.get('title', 'Untitled')}")
+                return {"episode": episode, "scenes": scenes}
             except Exception as e:
                 print(f"Error generating scenes for episode: {e}")
-                episodes_with_scenes.append({
+                return {
                     "episode": episode,
                     "scenes": [{"outline": default_scene_outline(1), "content": "Scene generation failed"}]
-                })
+                }
         
         # 6. Compile final story
-        print("\n6. Compiling final story...")
-        full_story = compile_story(episodes_with_scenes)
-        result["full_story"] = full_story
-        
-        # 7. Generate cover image
-        print("\n7. Generating cover image...")
-        cover_prompt = f"Cover art for a story about: {user_query}"
-        cover_image_url = generate_story_image(cover_prompt)
-        result["cover_image_url"] = cover_image_url
-        
-        # 8. Retrieve relevant memories for consistency check
-        print("\n8. Performing consistency check...")
-        consistency_check = memory.retrieve("character traits", k=5)
-        result["consistency_check"] = consistency_check
-        print(f"Retrieved {len(consistency_check)} relevant memories for consistency")
-        
-        result["success"] = True
-    
-    except Exception as e:
-        print(f"\nFatal error in StoryForge pipeline: {e}")
-        result["error"] = str(e)
-        traceback.print_exc()
-    
+        def compile_stage(episodes_with_scenes):
+            print("\n6. Compiling final story...")
+            if story_path is None:
+                return compile_story(episodes_with_scenes)
+            
+            files = {"text": f"{story_path}.txt", "markdown": f"{story_path}.md"}
+            if os.path.dirname(story_path):
+                os.makedirs(os.path.dirname(story_path), exist_ok=True)
+            with open(files["text"], "w", encoding="utf-8") as text, \
+                    open(files["markdown"], "w", encoding="utf-8") as markdown:
+                write_story(episodes_with_scenes, text=text, markdown=markdown)
+            print(f"Story written to {files['text']} and {files['markdown']}")
+            return files
+        
+        # 7. Generate cover image (only needs the query, so it runs alongside the text)
+        def cover_image_stage(results):
+            if not settings["cover_image"]:
+                return ""  # Dropped by a re-plan before it got a worker
+            print("\n7. Generating cover image...")
+            cover_prompt = f"Cover art for a story about: {user_query}"
+            # Not memoized: image URLs expire about an hour after they are issued
+            report["recomputed"].append("cover_image")
+            return generate_story_image(cover_prompt)
+        
+        # 8. Retrieve relevant memories for consistency check once everything is stored
+        def consistency_stage(results):
+            print("\n8. Performing consistency check...")
+            consistency_check = memory.retrieve("character traits", k=5)
+            print(f"Retrieved {len(consistency_check)} relevant memories for consistency")
+            return consistency_check
+        
+        dag.add("perspectives", perspectives_stage, expand=expand_perspectives)
+        dag.add("story_bible", story_bible_stage, deps=["perspectives"])
+        dag.add("episodes", episodes_stage, deps=["story_bible"], expand=expand_episodes)
+        if settings["cover_image"]:
+            # Never restored: the URL of a checkpointed image may have expired
+            dag.add("cover_image", cover_image_stage, checkpoint=False)
+        dag.add("consistency_check", consistency_stage, deps=["full_story", "flash_cards"])
+        
+        def record_latencies():
+            # Only stages that really ran say anything about how long they take
+            for name, seconds in dag.timings.items():
+                if name not in dag.results:
+                    continue
+                if name in measured:
+                    key, units = measured[name]
+                    latency.observe(key, seconds, units)
+                elif name in report["recomputed"] or name == "consistency_check":
+                    latency.observe(name.partition(":")[0], seconds)
+            latency.save()
+        
+        def run_dag():
+            done = {"type": "done", "run_id": run_id, "story_id": story_id, "success": False, "error": None}
+            try:
+                dag.run()
+                done["success"] = True
+                if checkpoints is not None:
+                    checkpoints.finish(run_id, inputs_digest)
+            except Exception as e:
+                print(f"\nFatal error in StoryForge pipeline: {e}")
+                done["error"] = str(e)
+                traceback.print_exc()
+        
+            if dag.restored:
+                print(f"Restored {len(dag.restored)} stages from checkpoints for run {run_id}")
+            done["restored_stages"] = sorted(dag.restored)
+            done["stages"] = {
+                "reused": sorted(report["reused"] + dag.restored),
+                "recomputed": sorted(report["recomputed"])
+            }
+            done["timings"] = {
+                "stages": dict(dag.timings),
+                "sum_of_stages": sum(dag.timings.values()),
+                "critical_path": dag.critical_path_seconds()
+            }
+            record_latencies()
+            if not memory.flush(timeout=30):
+                print(f"Memory writes for story {story_id} are still pending")
+            memory.persist()
+            done["degradations"] = applied_degradations(requested, settings)
+            elapsed = time.monotonic() - started
+            done["deadline"] = None if deadline_s is None else {
+                "deadline_s": deadline_s,
+                "elapsed_s": elapsed,
+                "met": elapsed <= deadline_s
+            }
+            release_run(run_id)
+            release_story_memory(story_id)
+            events.put(done)
+        
+        runner = threading.Thread(target=run_dag, name="storyforge-pipeline", daemon=True)
+        runner.start()
+    except BaseException:
+        # The runner releases these when it finishes, but it never started
+        if claimed is not None:
+            release_run(claimed)
+        release_story_memory(story_id)
+        raise
+    try:
+        while True:
+            event = events.get()
+            yield event
+            if event["type"] == "done":
+                break
+    finally:
+        # Only has an effect if the caller stopped listening early
+        dag.cancel()
+
+
+def new_pipeline_result() -> Dict[str, Any]:
+    """Empty result of storyforge_pipeline, for use with apply_pipeline_event"""
+    return {
+        "run_id": None,
+        "story_id": None,
+        "success": False,
+        "error": None,
+        "perspectives": [],
+        "flash_cards": [],
+        "story_bible": {},
+        "episodes": [],
+        "full_story": "",
+        "story_files": {},
+        "cover_image_url": "",
+        "consistency_check": [],
+        "timings": {},
+        "restored_stages": [],
+        "stages": {},
+        "degradations": {},
+        "deadline": None
+    }
+
+
+def apply_pipeline_event(result: Dict[str, Any], event: Dict[str, Any]) -> None:
+    """Fold one event from iter_storyforge_pipeline into a storyforge_pipeline result"""
+    kind = event["type"]
+    if kind in ("flash_cards", "episode_outline"):
+        items = result["flash_cards" if kind == "flash_cards" else "episodes"]
+        index = event["index"]
+        items.extend([None] * (index + 1 - len(items)))
+        items[index] = event["flash_cards" if kind == "flash_cards" else "episode"]
+    elif kind != "scene":  # Scenes only reach the result through full_story
+        result.update({key: value for key, value in event.items() if key != "type"})
+
+
+def storyforge_pipeline(user_query: str, parameters: dict = None, importance: dict = None,
+                        num_episodes: int = 3, num_scenes: int = 3,
+                        max_workers: int = PIPELINE_MAX_WORKERS, parallel_scenes: bool = True,
+                        scene_concurrency: int = SCENE_MAX_CONCURRENCY, run_id: Optional[str] = None,
+                        resume: bool = False, checkpoint_store: Optional[CheckpointStore] = None,
+                        episodes: Optional[List[Dict[str, Any]]] = None,
+                        deadline_s: Optional[float] = None, story_path: Optional[str] = None,
+                        story_id: Optional[str] = None) -> Dict[str, Any]:
+    """Complete StoryForge pipeline from query to finished story with robust error handling
+
+    Runs iter_storyforge_pipeline (see there for the stages and arguments) and
+    returns everything at once. On failure the result keeps whatever finished
+    before it, with ``success`` False and the ``error``. ``result["stages"]``
+    lists which stages were reused and which were recomputed, and
+    ``result["degradations"]`` what was cut to meet ``deadline_s``. With
+    ``story_path`` the story goes to ``result["story_files"]`` rather than
+    ``result["full_story"]``.
+    """
+    result = new_pipeline_result()
+    for event in iter_storyforge_pipeline(
+            user_query, parameters, importance, num_episodes, num_scenes, max_workers,
+            parallel_scenes, scene_concurrency, run_id, resume, checkpoint_store, episodes, deadline_s,
+            story_path, story_id):
+        apply_pipeline_event(result, event)
     return result
 
-def generate_episode(prompt):
+EPISODE_HOOK_PHRASES = ["to be continued", "what happens next", "little did they know", "but that was just the beginning"]
+
+
+def generate_episode(prompt, use_cache=False):
     """
     Generate a detailed story episode using GPT.
     
     Args:
         prompt: A detailed prompt for episode generation
+        use_cache: Reuse a cached episode for an identical prompt. Off by default
+            so that "try again" produces a fresh episode.
         
     Returns:
         str: The full episode text with title and content
@@ -1289,7 +2704,8 @@ def generate_episode(prompt):
         response = llm.generate(
             prompt=prompt,
             temperature=0.7,  # Creative but not too random
-            max_tokens=4000   # Enough for a detailed episode
+            stage="episode",  # Budgeted for the 1500-2000 word target
+            use_cache=use_cache
         )
         
         if not response or response.startswith("Error:"):
@@ -1297,7 +2713,7 @@ def generate_episode(prompt):
             return "EPISODE TITLE: Error Episode\n\nUnable to generate episode content. Please try again."
             
         # Ensure the episode ends with a hook
-        if not any(hook_phrase in response.lower() for hook_phrase in ["to be continued", "what happens next", "little did they know", "but that was just the beginning"]):
+        if not any(hook_phrase in response.lower() for hook_phrase in EPISODE_HOOK_PHRASES):
             # Add a hook if one isn't present
             response += "\n\n[To be continued...]"
             
@@ -1306,4 +2722,40 @@ def generate_episode(prompt):
     except Exception as e:
         print(f"Error in generate_episode: {str(e)}")
         traceback.print_exc()  # More detailed error information
-        return f"EPISODE TITLE: Error Occurred\n\nAn error occurred during episode generation: {str(e)}"
\ No newline at end of file
+        return f"EPISODE TITLE: Error Occurred\n\nAn error occurred during episode generation: {str(e)}"
+
+def generate_episode_stream(prompt):
+    """
+    Stream a story episode as it is generated.
+    
+    Args:
+        prompt: A detailed prompt for episode generation
+        
+    Yields:
+        str: Pieces of the episode text, in order. Joined together they match
+        what generate_episode would have returned.
+    
+    Raises:
+        Exception: Whatever stopped the stream, if some text was already
+        yielded; the caller reports it rather than ending the episode there.
+    """
+    llm = StoryForgeLLM()
+    received = []
+    
+    try:
+        print(f"Streaming episode with prompt length: {len(prompt)} characters")
+        for piece in llm.stream(prompt=prompt, temperature=0.7, stage="episode"):
+            received.append(piece)
+            yield piece
+    except Exception as e:
+        print(f"Error in generate_episode_stream: {str(e)}")
+        traceback.print_exc()
+        if received:
+            raise
+        yield f"EPISODE TITLE: Error Occurred\n\nAn error occurred during episode generation: {str(e)}"
+        return
+    
+    # Ensure the episode ends with a hook
+    response = ''.join(received).lower()
+    if not any(hook_phrase in response for hook_phrase in EPISODE_HOOK_PHRASES):
+        yield "\n\n[To be continued...]"
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""Split long memory content into overlapping, token-bounded chunks.
+
+A single embedding of a 500-word scene blurs everything in it together, so
+StoryMemory embeds scenes and episodes a few sentences at a time. Chunks are
+packed from whole sentences up to ``max_tokens``; each chunk starts with the
+last ``overlap`` tokens' worth of sentences from the one before, so a fact
+that straddles a boundary is still found. A sentence longer than a whole
+chunk is split on word boundaries.
+"""
+import os
+import re
+from typing import Callable, List
+
+from token_budget import count_tokens
+
+MEMORY_CHUNK_TOKENS = int(os.getenv("STORYFORGE_MEMORY_CHUNK_TOKENS", "256"))
+MEMORY_CHUNK_OVERLAP = int(os.getenv("STORYFORGE_MEMORY_CHUNK_OVERLAP", "48"))
+
+_SENTENCE_END = re.compile(r'(?<=[.!?"”])\s+|\n+')
+
+
+def _split_long(sentence: str, max_tokens: int, count: Callable[[str], int]) -> List[str]:
+    """Break one over-long sentence into word runs of at most ``max_tokens``"""
+    pieces, words = [], []
+    for word in sentence.split():
+        if words and count(" ".join(words + [word])) > max_tokens:
+            pieces.append(" ".join(words))
+            words = []
+        words.append(word)
+    if words:
+        pieces.append(" ".join(words))
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int = MEMORY_CHUNK_TOKENS, overlap: int = MEMORY_CHUNK_OVERLAP,
+               count: Callable[[str], int] = count_tokens) -> List[str]:
+    """Overlapping chunks of ``text`` of at most about ``max_tokens`` tokens each
+
+    Text that already fits is returned as a single chunk, unchanged.
+    """
+    text = text.strip()
+    if not text or count(text) <= max_tokens:
+        return [text] if text else []
+
+    sentences = []  # (sentence, tokens)
+    for sentence in _SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        tokens = count(sentence)
+        if tokens > max_tokens:
+            sentences.extend((piece, count(piece)) for piece in _split_long(sentence, max_tokens, count))
+        else:
+            sentences.append((sentence, tokens))
+
+    chunks, current, current_tokens = [], [], 0
+    for sentence, tokens in sentences:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(s for s, _ in current))
+            # Carry trailing sentences into the next chunk, up to ``overlap`` tokens
+            carried, carried_tokens = [], 0
+            for previous in reversed(current):
+                if carried_tokens + previous[1] > overlap or carried_tokens + previous[1] + tokens > max_tokens:
+                    break
+                carried.insert(0, previous)
+                carried_tokens += previous[1]
+            current, current_tokens = carried, carried_tokens
+        current.append((sentence, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append(" ".join(s for s, _ in current))
+    return chunks
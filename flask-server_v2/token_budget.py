@@ -0,0 +1,165 @@
+"""max_tokens budgets for each stage of the StoryForge pipeline.
+
+Every stage starts from a static budget derived from how much text its prompt
+asks for (e.g. a ~500 word scene). As completions come back the observed
+lengths are recorded, and once a stage has enough history its budget follows
+the 95th percentile of what it actually produces instead. Truncated
+completions (finish_reason == "length") push the budget back up.
+"""
+import json
+import math
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+from rate_limiter import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKEN_BUDGETS_PATH = os.getenv("STORYFORGE_TOKEN_BUDGETS_PATH", ".token_budgets.json")
+
+DEFAULT_MAX_TOKENS = 8000  # Used for calls that don't name a stage
+MIN_BUDGET = 256
+MAX_BUDGET = 8000
+HEADROOM = 1.3        # Static budgets allow 30% over the requested length
+TUNED_HEADROOM = 1.2  # Tuned budgets allow 20% over the observed p95
+MIN_OBSERVATIONS = 5
+HISTORY_SIZE = 50
+
+# Target lengths used in the prompts themselves
+SCENE_TARGET_WORDS = 500
+EPISODE_TARGET_WORDS = (1500, 2000)
+
+# stage -> (target words per unit, fixed tokens per unit for JSON keys and formatting)
+STAGE_BUDGETS = {
+    "perspectives": (450, 250),       # 4 perspectives of 3-4 sentences, as a JSON list
+    "flash_cards": (400, 150),        # 14 short flash card entries
+    "story_bible": (1800, 600),       # Nested JSON story bible
+    "episode_outlines": (150, 80),    # Per episode
+    "scene_outline": (200, 80),       # Per scene
+    "scene": (SCENE_TARGET_WORDS, 50),
+    "episode": (EPISODE_TARGET_WORDS[1], 150),
+}
+
+_encoders = {}
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Count tokens locally with tiktoken, falling back to a character estimate"""
+    if tiktoken is None:
+        return estimate_tokens(text)
+    encoder = _encoders.get(model)
+    if encoder is None:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except Exception:
+            encoder = tiktoken.get_encoding("o200k_base")
+        _encoders[model] = encoder
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def words_to_tokens(words: float) -> int:
+    """English prose runs at roughly 1.35 tokens per word"""
+    return int(math.ceil(words * 1.35))
+
+
+def _round_budget(tokens: float) -> int:
+    # Round up to a multiple of 64 so small shifts in history don't change every request
+    tokens = int(math.ceil(tokens / 64.0)) * 64
+    return max(MIN_BUDGET, min(MAX_BUDGET, tokens))
+
+
+class TokenBudgeter:
+    """Static per-stage budgets, tuned from observed completion lengths"""
+
+    def __init__(self, path: Optional[str] = TOKEN_BUDGETS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._history = {}  # stage -> deque of completion tokens per unit
+        self._unsaved = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    for stage, values in json.load(f).items():
+                        self._history[stage] = deque(values, maxlen=HISTORY_SIZE)
+            except Exception as e:
+                print(f"Error loading token budgets from {path}: {e}")
+
+    def static_budget(self, stage: str) -> int:
+        words, overhead = STAGE_BUDGETS.get(stage, (0, 0))
+        if not words:
+            return DEFAULT_MAX_TOKENS
+        return words_to_tokens(words) * HEADROOM + overhead
+
+    def _per_unit(self, stage: str) -> float:
+        history = self._history.get(stage)
+        if history and len(history) >= MIN_OBSERVATIONS:
+            ordered = sorted(history)
+            p95 = ordered[min(len(ordered) - 1, int(math.ceil(0.95 * len(ordered))) - 1)]
+            return p95 * TUNED_HEADROOM
+        return self.static_budget(stage)
+
+    def budget(self, stage: Optional[str], units: int = 1) -> int:
+        """max_tokens to request for ``units`` items of ``stage``"""
+        if not stage or stage not in STAGE_BUDGETS:
+            return DEFAULT_MAX_TOKENS
+        with self._lock:
+            return _round_budget(self._per_unit(stage) * max(1, units))
+
+    def observe(self, stage: Optional[str], completion_tokens: Optional[int], units: int = 1,
+                finish_reason: Optional[str] = None) -> None:
+        """Record how long a completion for ``stage`` actually was"""
+        if not stage or stage not in STAGE_BUDGETS or not completion_tokens:
+            return
+        units = max(1, units)
+        per_unit = completion_tokens / units
+        if finish_reason == "length":
+            # The budget was too small; remember a longer length than we saw
+            per_unit *= 1.5
+        with self._lock:
+            self._history.setdefault(stage, deque(maxlen=HISTORY_SIZE)).append(per_unit)
+            self._unsaved += 1
+            if self._unsaved >= 10:
+                self._save()
+
+    def _save(self) -> None:
+        self._unsaved = 0
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump({stage: list(values) for stage, values in self._history.items()}, f)
+        except Exception as e:
+            print(f"Error saving token budgets to {self.path}: {e}")
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                stage: {
+                    "static": _round_budget(self.static_budget(stage)),
+                    "current": _round_budget(self._per_unit(stage)),
+                    "observations": len(self._history.get(stage, ())),
+                }
+                for stage in STAGE_BUDGETS
+            }
+
+
+_budgeter = None
+_budgeter_lock = threading.Lock()
+
+
+def get_token_budgeter() -> TokenBudgeter:
+    """Return the process-wide budgeter"""
+    global _budgeter
+    with _budgeter_lock:
+        if _budgeter is None:
+            _budgeter = TokenBudgeter()
+        return _budgeter
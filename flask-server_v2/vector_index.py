@@ -0,0 +1,272 @@
+"""In-process vector index backed by a NumPy matrix.
+
+A lighter alternative to a Chroma collection for the small per-story
+memories StoryMemory keeps (hundreds to a few thousand vectors). Rows are
+L2-normalised and kept in one contiguous matrix, either as float32 or as int8
+with a per-row scale (4x smaller, with a negligible effect on ranking).
+Queries are a single matrix-vector product followed by ``argpartition`` for
+the top k. The matrix grows by doubling, so appends are amortised O(1).
+
+``add`` and ``query`` take and return the same shapes as a Chroma
+collection, so StoryMemory can use either. Indexes are saved with
+``np.save`` and loaded memory-mapped; the first append after loading copies
+the rows into memory.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+VECTOR_INDEX_BACKEND = os.getenv("STORYFORGE_VECTOR_INDEX", "chroma")  # chroma or numpy
+VECTOR_INDEX_DIR = os.getenv("STORYFORGE_VECTOR_INDEX_DIR", ".vector_index")
+VECTOR_INDEX_DTYPE = os.getenv("STORYFORGE_VECTOR_INDEX_DTYPE", "float32")  # float32 or int8
+
+INITIAL_CAPACITY = 256
+INT8_BLOCK_ROWS = 2048  # int8 rows are widened to float32 this many at a time
+
+
+def metadata_matches(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """Whether ``metadata`` passes a Chroma-style ``where`` filter
+
+    Supports field equality (``{"type": "scene"}``), the operators $eq, $ne,
+    $in and $nin on a field, and $and / $or over a list of filters.
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(metadata_matches(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(metadata_matches(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, operand in condition.items():
+                if op == "$eq" and value != operand:
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$nin" and value in operand:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def mmr_select(embeddings: List[List[float]], relevance: List[float], k: int, lambda_: float = 0.5,
+               similarity: Optional[List[List[float]]] = None) -> List[int]:
+    """Indices of ``k`` items picked by maximal marginal relevance
+
+    Each pick maximises ``lambda_ * relevance - (1 - lambda_) * similarity``
+    to the closest item already picked, so near-duplicates of earlier picks
+    lose out to slightly less relevant but different items. Relevance should
+    be on the same 0-1 scale as cosine similarity.
+
+    ``similarity`` is a precomputed pairwise matrix on that scale (e.g. token
+    overlap) to use instead of the cosine similarity of ``embeddings``.
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    if similarity is None:
+        embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+        similarity = embeddings @ embeddings.T
+    else:
+        similarity = np.asarray(similarity, dtype=np.float32)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    selected = [int(np.argmax(relevance))]
+    closest = similarity[selected[0]].copy()  # Highest similarity of each item to anything picked
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * closest, -np.inf)
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        available[pick] = False
+        np.maximum(closest, similarity[pick], out=closest)
+    return selected
+
+
+class NumpyVectorIndex:
+    """Append-only cosine-similarity index over normalised vectors"""
+
+    def __init__(self, dimension: int, dtype: str = VECTOR_INDEX_DTYPE, path: Optional[str] = None,
+                 metadata: Optional[Dict[str, Any]] = None):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported vector dtype '{dtype}', expected float32 or int8")
+        self.dimension = dimension
+        self.dtype = dtype
+        self.path = path
+        self.metadata = dict(metadata or {})  # Same role as a Chroma collection's metadata
+
+        self._lock = threading.Lock()
+        self._size = 0
+        self._rows = np.empty((INITIAL_CAPACITY, dimension), dtype=np.float32 if dtype == "float32" else np.int8)
+        self._scales = np.empty(INITIAL_CAPACITY, dtype=np.float32)  # int8 only: value of one step per row
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._id_positions = {}
+
+    @classmethod
+    def open(cls, path: str, dimension: int, dtype: str = VECTOR_INDEX_DTYPE,
+             metadata: Optional[Dict[str, Any]] = None) -> "NumpyVectorIndex":
+        """Load the index saved at ``path``, or start an empty one there"""
+        info_path = os.path.join(path, "index.json")
+        if not os.path.exists(info_path):
+            return cls(dimension, dtype, path, metadata)
+
+        with open(info_path) as f:
+            info = json.load(f)
+        index = cls(info["dimension"], info["dtype"], path, info.get("metadata"))
+        size = info["size"]
+        if size:
+            index._rows = np.load(os.path.join(path, "rows.npy"), mmap_mode="r")
+            index._scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        index._size = size
+        index._ids = info["ids"]
+        index._documents = info["documents"]
+        index._metadatas = info["metadatas"]
+        index._id_positions = {doc_id: i for i, doc_id in enumerate(index._ids)}
+        return index
+
+    def count(self) -> int:
+        return self._size
+
+    def _reserve(self, extra: int) -> None:
+        """Make room for ``extra`` more rows, doubling capacity as needed"""
+        needed = self._size + extra
+        # Memory-mapped rows from open() are read-only, so copy them out first
+        if needed <= len(self._rows) and not isinstance(self._rows, np.memmap):
+            return
+        capacity = max(INITIAL_CAPACITY, len(self._rows))
+        while capacity < needed:
+            capacity *= 2
+        rows = np.empty((capacity, self.dimension), dtype=self._rows.dtype)
+        rows[:self._size] = self._rows[:self._size]
+        scales = np.empty(capacity, dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+        self._rows, self._scales = rows, scales
+
+    def add(self, ids: List[str], embeddings: List[List[float]], documents: Optional[List[str]] = None,
+            metadatas: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Append vectors; ids that are already present are skipped"""
+        documents = documents or [""] * len(ids)
+        metadatas = metadatas or [{}] * len(ids)
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-dimensional vectors, got {vectors.shape[1]}")
+
+        with self._lock:
+            fresh = [i for i, doc_id in enumerate(ids) if doc_id not in self._id_positions]
+            if not fresh:
+                return
+            vectors = _normalize(vectors[fresh])
+            self._reserve(len(fresh))
+            start, end = self._size, self._size + len(fresh)
+            if self.dtype == "int8":
+                scales = np.abs(vectors).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                self._rows[start:end] = np.round(vectors / scales[:, None]).astype(np.int8)
+                self._scales[start:end] = scales
+            else:
+                self._rows[start:end] = vectors
+                self._scales[start:end] = 1.0
+            for i in fresh:
+                self._id_positions[ids[i]] = len(self._ids)
+                self._ids.append(ids[i])
+                self._documents.append(documents[i])
+                self._metadatas.append(metadatas[i])
+            self._size = end
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10,
+              where: Optional[Dict[str, Any]] = None, include: Optional[List[str]] = None) -> Dict[str, List[List[Any]]]:
+        """Nearest rows by cosine similarity, as {ids, documents, metadatas, distances} per query
+
+        ``where`` restricts the search to rows whose metadata passes it (see
+        metadata_matches). With "embeddings" in ``include`` the (normalised)
+        row vectors are returned too, like Chroma's ``include``.
+        """
+        with_embeddings = include is not None and "embeddings" in include
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        with self._lock:
+            positions = None  # Rows to search, all of them without a filter
+            if where:
+                positions = np.array([i for i in range(self._size) if metadata_matches(self._metadatas[i], where)],
+                                     dtype=np.int64)
+            size = self._size if positions is None else len(positions)
+            rows, scales = self._rows[:self._size], self._scales[:self._size]
+            if positions is not None:
+                rows, scales = rows[positions], scales[positions]
+            result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            if with_embeddings:
+                result["embeddings"] = []
+            for query in queries:
+                if size == 0:
+                    top = np.empty(0, dtype=np.int64)
+                    similarities = np.empty(0, dtype=np.float32)
+                else:
+                    similarities = rows @ query if self.dtype == "float32" else self._int8_scores(rows, scales, query)
+                    k = min(n_results, size)
+                    top = np.argpartition(-similarities, k - 1)[:k] if k < size else np.arange(size)
+                    top = top[np.argsort(-similarities[top])]
+                found = top if positions is None else positions[top]
+                result["ids"].append([self._ids[i] for i in found])
+                result["documents"].append([self._documents[i] for i in found])
+                result["metadatas"].append([self._metadatas[i] for i in found])
+                result["distances"].append([float(1.0 - similarities[i]) for i in top])
+                if with_embeddings:
+                    vectors = rows[top].astype(np.float32) * scales[top][:, None]
+                    result["embeddings"].append(vectors.tolist())
+            return result
+
+    def get(self) -> Dict[str, List[Any]]:
+        """Every stored entry as {ids, documents, metadatas}, like a Chroma collection's get()"""
+        with self._lock:
+            return {"ids": list(self._ids), "documents": list(self._documents), "metadatas": list(self._metadatas)}
+
+    @staticmethod
+    def _int8_scores(rows: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # BLAS has no int8 kernel and widening the whole matrix at once is slow,
+        # so widen it in blocks that stay in cache
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), INT8_BLOCK_ROWS):
+            block = rows[start:start + INT8_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores * scales
+
+    def save(self) -> None:
+        """Write the index to ``path`` (rows, scales and a JSON sidecar)"""
+        if not self.path:
+            return
+        with self._lock:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                if self._size:
+                    # Write fresh arrays next to the old ones, then swap them in
+                    for name, array in (("rows", self._rows[:self._size]), ("scales", self._scales[:self._size])):
+                        tmp_path = os.path.join(self.path, f"{name}.tmp.npy")
+                        np.save(tmp_path, np.ascontiguousarray(array))
+                        os.replace(tmp_path, os.path.join(self.path, f"{name}.npy"))
+                info = {
+                    "dimension": self.dimension, "dtype": self.dtype, "size": self._size,
+                    "metadata": self.metadata, "ids": self._ids,
+                    "documents": self._documents, "metadatas": self._metadatas
+                }
+                tmp_path = os.path.join(self.path, "index.json.tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(info, f)
+                os.replace(tmp_path, os.path.join(self.path, "index.json"))
+            except Exception as e:
+                print(f"Error saving vector index to {self.path}: {e}")